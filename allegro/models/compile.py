@@ -0,0 +1,105 @@
+from typing import Callable, Optional, Set, Tuple
+
+import torch
+from diffusers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+class BucketedCompile:
+    r"""
+    A `torch.compile`d replacement for `module.forward`, installed as an instance attribute so that calls through
+    `module(...)` go to the compiled graph while everything around them, e.g. the per-block `.to()` placement of the
+    transformer's low VRAM mode, stays eager.
+
+    The graph is compiled with `dynamic=False`, so dynamo specializes it on the input shapes and keeps one graph per
+    shape bucket, which for the transformer blocks is (frames, height, width, batch) and for the VAE decoder the tile
+    shape. `bucket_fn` derives the bucket from the call arguments; the first call of each bucket is logged, as it pays
+    the compilation.
+    """
+
+    def __init__(
+        self,
+        module: torch.nn.Module,
+        bucket_fn: Callable[..., Tuple],
+        seen: Set[Tuple],
+        backend: str = "inductor",
+        mode: Optional[str] = None,
+    ):
+        self.name = type(module).__name__
+        self.bucket_fn = bucket_fn
+        self.seen = seen
+        self.compiled = torch.compile(module.forward, backend=backend, mode=mode, dynamic=False)
+
+    def __call__(self, *args, **kwargs):
+        bucket = self.bucket_fn(*args, **kwargs)
+        if bucket not in self.seen:
+            self.seen.add(bucket)
+            logger.info(f"Compiling {self.name} for shape bucket {bucket}, later calls with this shape reuse the graph")
+        return self.compiled(*args, **kwargs)
+
+
+def is_compiled(module: torch.nn.Module) -> bool:
+    return isinstance(module.__dict__.get("forward"), BucketedCompile)
+
+
+def uncompile(module: torch.nn.Module) -> None:
+    if is_compiled(module):
+        del module.forward
+
+
+def _raise_cache_limits(entries: int) -> None:
+    # every block shares the code of `BasicTransformerBlock.forward`, and each block, bucket and device (low VRAM mode
+    # moves blocks back and forth) needs its own guarded entry; past the limits dynamo silently falls back to eager
+    config = torch._dynamo.config
+    config.cache_size_limit = max(config.cache_size_limit, entries)
+    if hasattr(config, "accumulated_cache_size_limit"):
+        config.accumulated_cache_size_limit = max(config.accumulated_cache_size_limit, entries)
+
+
+def _block_bucket(hidden_states, *args, frame=None, height=None, width=None, **kwargs):
+    return ("block", frame, height, width, hidden_states.shape[0])
+
+
+def _decoder_bucket(z):
+    return ("decoder", *z.shape)
+
+
+def compile_transformer(transformer: torch.nn.Module, backend: str = "inductor", mode: Optional[str] = None, max_buckets: int = 4) -> None:
+    r"""
+    Compile every `BasicTransformerBlock` of an Allegro transformer with `torch.compile`. The block loop, step cache,
+    sequence sharding and device placement in `forward` stay eager.
+
+    Args:
+        backend (`str`, *optional*, defaults to `"inductor"`):
+            The `torch.compile` backend, inductor generates C++ on CPU and Triton on CUDA.
+        mode (`str`, *optional*):
+            The `torch.compile` mode, e.g. `"max-autotune"`.
+        max_buckets (`int`, *optional*, defaults to 4):
+            Resolutions (frames, height, width, batch) that get their own graphs, further ones run eagerly.
+    """
+    blocks = transformer.transformer_blocks
+    _raise_cache_limits(len(blocks) * max_buckets * 2)
+    seen = set()
+    for block in blocks:
+        if not is_compiled(block):
+            block.forward = BucketedCompile(block, _block_bucket, seen, backend=backend, mode=mode)
+
+
+def compile_vae(vae: torch.nn.Module, backend: str = "inductor", mode: Optional[str] = None) -> None:
+    r"""
+    Compile the tile forward of the VAE `Decoder3D`. Tiles all have the kernel shape and the decoder only sees batches
+    of `local_batch_size` tiles, so a single graph per batch size serves every resolution.
+    """
+    if not is_compiled(vae.decoder):
+        _raise_cache_limits(8)
+        vae.decoder.forward = BucketedCompile(vae.decoder, _decoder_bucket, set(), backend=backend, mode=mode)
+
+
+def uncompile_transformer(transformer: torch.nn.Module) -> None:
+    for block in transformer.transformer_blocks:
+        uncompile(block)
+
+
+def uncompile_vae(vae: torch.nn.Module) -> None:
+    uncompile(vae.decoder)
@@ -0,0 +1,119 @@
+import glob
+import json
+import os
+import sys
+import time
+from typing import Optional, Union
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors import safe_open
+
+from diffusers.configuration_utils import ConfigMixin
+from diffusers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+def peak_rss_mib() -> Optional[float]:
+    """
+    Peak resident set size of the current process in MiB, or `None` where `resource` is not available (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def _safetensors_files(pretrained_path):
+    index_files = sorted(glob.glob(os.path.join(pretrained_path, "*.safetensors.index.json")))
+    if index_files:
+        with open(index_files[0], "r") as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(pretrained_path, name) for name in sorted(set(weight_map.values()))]
+    return sorted(glob.glob(os.path.join(pretrained_path, "*.safetensors")))
+
+
+def _build_empty_model(model_cls, pretrained_path):
+    with init_empty_weights():
+        if issubclass(model_cls, ConfigMixin):
+            # diffusers models, e.g. AllegroTransformer3DModel or AllegroAutoencoderKL3D
+            model = model_cls.from_config(model_cls.load_config(pretrained_path))
+        else:
+            # transformers models, e.g. T5EncoderModel
+            model = model_cls(model_cls.config_class.from_pretrained(pretrained_path))
+    return model
+
+
+def load_pretrained(
+    model_cls,
+    pretrained_path: Union[str, os.PathLike],
+    torch_dtype: torch.dtype = torch.float32,
+    device: Union[str, torch.device] = "cpu",
+):
+    r"""
+    Load a model from a local folder of safetensors shards without materializing a full float32 copy on the CPU first.
+
+    The module tree is built on the meta device, then every tensor is read from the memory-mapped shards and placed
+    directly on `device` in `torch_dtype`, so peak host memory stays close to the largest single tensor. Folders without
+    safetensors fall back to `from_pretrained`.
+
+    Args:
+        model_cls:
+            A diffusers `ModelMixin` or transformers `PreTrainedModel` class.
+        pretrained_path (`str` or `os.PathLike`):
+            Local folder holding the config and weights, e.g. `models/transformer`.
+        torch_dtype (`torch.dtype`, *optional*, defaults to `torch.float32`):
+            Dtype of the floating point weights. When it is `torch.float16`, modules listed in
+            `model_cls._keep_in_fp32_modules` stay in float32, as with `from_pretrained`.
+        device (`str` or `torch.device`, *optional*, defaults to `"cpu"`):
+            Device the weights are materialized on.
+    """
+    start = time.perf_counter()
+    files = _safetensors_files(pretrained_path)
+    if not files:
+        logger.warning(f"No safetensors found under {pretrained_path}, falling back to from_pretrained.")
+        model = model_cls.from_pretrained(pretrained_path, torch_dtype=torch_dtype).to(device)
+        model.eval()
+        return model
+
+    model = _build_empty_model(model_cls, pretrained_path)
+    # like from_pretrained, only float16 keeps these modules (e.g. the T5 feed-forward `wo`) in float32, bfloat16 has
+    # the range of float32
+    keep_in_fp32 = (getattr(model_cls, "_keep_in_fp32_modules", None) or []) if torch_dtype == torch.float16 else []
+    expected = set(model.state_dict().keys())
+    unexpected = []
+    for file in files:
+        # safe_open memory-maps the shard, get_tensor only pages in the bytes of the requested tensor
+        with safe_open(file, framework="pt", device="cpu") as f:
+            for name in f.keys():
+                if name not in expected:
+                    unexpected.append(name)
+                    continue
+                value = f.get_tensor(name)
+                dtype = None
+                if value.is_floating_point():
+                    dtype = torch.float32 if any(m in name.split(".") for m in keep_in_fp32) else torch_dtype
+                set_module_tensor_to_device(model, name, device, value=value, dtype=dtype)
+                expected.discard(name)
+
+    if hasattr(model, "tie_weights"):
+        # e.g. T5EncoderModel shares `shared.weight` with `encoder.embed_tokens.weight`
+        model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+    if missing:
+        raise ValueError(f"Missing weights for {model_cls.__name__} in {pretrained_path}: {missing}")
+    if unexpected:
+        logger.warning(f"Ignored {len(unexpected)} unexpected weights in {pretrained_path}: {unexpected[:8]}")
+
+    model.eval()
+    rss = peak_rss_mib()
+    logger.info(
+        f"Loaded {model_cls.__name__} from {pretrained_path} to {device} as {torch_dtype} in {time.perf_counter() - start:.1f}s"
+        + (f", peak RSS {rss:.0f} MiB" if rss is not None else "")
+    )
+    return model
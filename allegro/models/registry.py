@@ -0,0 +1,74 @@
+import os
+import threading
+import weakref
+from typing import Any, Callable, Hashable, Iterable
+
+import torch
+
+from diffusers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+def component_key(kind: str, path: str, dtype: torch.dtype = None, *extra) -> tuple:
+    """
+    Registry key of a pipeline component. Paths are resolved so that symlinked folders, as suggested for
+    ti2v_models/vae, ti2v_models/text_encoder and ti2v_models/tokenizer, map to the same entry.
+    """
+    return (kind, os.path.realpath(path), str(dtype)) + tuple(extra)
+
+
+class ModelRegistry:
+    r"""
+    Process-wide store of loaded pipeline components, shared by every loader node that asks for the same key.
+
+    Each `acquire` increments a reference count, `release` decrements it and drops the registry's reference once no
+    owner is left, so the weights can be garbage collected. `bind` releases on behalf of an owner (e.g. a pipeline) when
+    that owner is garbage collected.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}
+
+    def acquire(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [factory(), 0]
+            else:
+                logger.info(f"Reusing loaded {key[0]} from {key[1]}")
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, key: Hashable) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._entries[key]
+
+    def release_all(self, keys: Iterable[Hashable]) -> None:
+        for key in keys:
+            self.release(key)
+
+    def bind(self, owner: Any, keys: Iterable[Hashable]) -> None:
+        weakref.finalize(owner, self.release_all, tuple(keys))
+
+    def refcount(self, key: Hashable) -> int:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None else 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+registry = ModelRegistry()
@@ -46,6 +46,9 @@ from torch import nn
 
 from allegro.models.transformers.rope import RoPE3D, PositionGetter3D
 from allegro.models.transformers.embedding import CombinedTimestepSizeEmbeddings
+from allegro.models.transformers.chunked_attention import chunked_attention
+from allegro.models.transformers.sequence_parallel import ring_attention
+from allegro.models.transformers.modulation import compiled_layer_norm_modulate, gated_residual, layer_norm_modulate
 
 if is_xformers_available():
     import xformers
@@ -64,6 +67,34 @@ def to_2tuple(x):
     return (x, x)
 
 
+def _chunked_feed_forward(ff: nn.Module, hidden_states: torch.Tensor, chunk_dim: int, chunk_size: int):
+    # slices are written into a preallocated output instead of concatenated, which would briefly hold both
+    ff_output = None
+    start = 0
+    for hid_slice in hidden_states.split(chunk_size, dim=chunk_dim):
+        out_slice = ff(hid_slice)
+        if ff_output is None:
+            shape = list(out_slice.shape)
+            shape[chunk_dim] = hidden_states.shape[chunk_dim]
+            ff_output = out_slice.new_empty(shape)
+        ff_output.narrow(chunk_dim, start, out_slice.shape[chunk_dim]).copy_(out_slice)
+        start += out_slice.shape[chunk_dim]
+    return ff_output
+
+
+def _chunked_out_projection(attn: nn.Module, hidden_states: torch.Tensor, chunk_size: int, dtype: torch.dtype):
+    # hidden_states is the (batch, heads, tokens, head_dim) output of sdpa
+    batch_size, heads, tokens, head_dim = hidden_states.shape
+    output = None
+    for start in range(0, tokens, chunk_size):
+        hid_slice = hidden_states[:, :, start : start + chunk_size].transpose(1, 2).reshape(batch_size, -1, heads * head_dim)
+        out_slice = attn.to_out[0](hid_slice.to(dtype))
+        if output is None:
+            output = out_slice.new_empty(batch_size, tokens, out_slice.shape[-1])
+        output[:, start : start + out_slice.shape[1]] = out_slice
+    return output
+
+
 @maybe_allow_in_graph
 class Attention(nn.Module):
     r"""
@@ -146,6 +177,7 @@ class Attention(nn.Module):
         super().__init__()
         self.inner_dim = dim_head * heads
         self.cross_attention_dim = cross_attention_dim if cross_attention_dim is not None else query_dim
+        self.is_cross_attention = cross_attention_dim is not None
         self.upcast_attention = upcast_attention
         self.upcast_softmax = upcast_softmax
         self.rescale_output_factor = rescale_output_factor
@@ -227,6 +259,10 @@ class Attention(nn.Module):
         self.to_out = nn.ModuleList([])
         self.to_out.append(linear_cls(self.inner_dim, query_dim, bias=out_bias))
         self.to_out.append(nn.Dropout(dropout))
+        # tokens per slice of the output projection, see `set_chunk_out_projection`
+        self._out_chunk_size = None
+        # `to_qkv` or `to_kv` replace the separate projections, see `fuse_projections`
+        self.fused_projections = False
 
         # set attention processor
         # We use the AttnProcessor2_0 by default when torch 2.x is used which uses
@@ -403,6 +439,45 @@ class Attention(nn.Module):
 
         self.set_processor(processor)
 
+    def set_chunk_out_projection(self, chunk_size: Optional[int]) -> None:
+        r"""
+        Run the head merge and output projection over slices of `chunk_size` tokens, written into a preallocated
+        output, instead of materializing the merged heads of the whole sequence at once.
+
+        Args:
+            chunk_size (`int`, *optional*):
+                The number of tokens per slice. `None` or 0 disables chunking.
+        """
+        self._out_chunk_size = chunk_size or None
+
+    @torch.no_grad()
+    def fuse_projections(self) -> None:
+        r"""
+        Concatenate the weights of `to_q`, `to_k` and `to_v` into a single `to_qkv` linear for self-attention, or of
+        `to_k` and `to_v` into `to_kv` for cross-attention, so the processor runs one GEMM instead of three or two and
+        splits views of its output. The separate linears are removed so that the weights are not held twice, which also
+        means that fused attention does not support the legacy LoRA attention processors, as those read their LoRA layers
+        from `to_q`, `to_k` and `to_v`.
+        """
+        if self.fused_projections or self.to_k is None:
+            return
+        parts = (self.to_k, self.to_v) if self.is_cross_attention else (self.to_q, self.to_k, self.to_v)
+        weight = parts[0].weight
+        fused = nn.Linear(
+            parts[0].in_features, sum(part.out_features for part in parts), bias=parts[0].bias is not None,
+            device=weight.device, dtype=weight.dtype,
+        )
+        fused.weight.copy_(torch.cat([part.weight for part in parts]))
+        if fused.bias is not None:
+            fused.bias.copy_(torch.cat([part.bias for part in parts]))
+        if self.is_cross_attention:
+            self.to_kv = fused
+        else:
+            self.to_qkv = fused
+            del self.to_q
+        del self.to_k, self.to_v
+        self.fused_projections = True
+
     def set_processor(self, processor: "AttnProcessor", _remove_lora: bool = False) -> None:
         r"""
         Set the attention processor to use.
@@ -411,9 +486,16 @@ class Attention(nn.Module):
             processor (`AttnProcessor`):
                 The attention processor to use.
             _remove_lora (`bool`, *optional*, defaults to `False`):
-                Set to `True` to remove LoRA layers from the model.
+                Set to `True` to remove LoRA layers from the model. Fused projections hold no LoRA layers, so this is a
+                no-op once [`~Attention.fuse_projections`] has been called.
         """
-        if not USE_PEFT_BACKEND and hasattr(self, "processor") and _remove_lora and self.to_q.lora_layer is not None:
+        if (
+            not USE_PEFT_BACKEND
+            and hasattr(self, "processor")
+            and _remove_lora
+            and not self.fused_projections
+            and self.to_q.lora_layer is not None
+        ):
             deprecate(
                 "set_processor to offload LoRA",
                 "0.26.0",
@@ -465,6 +547,12 @@ class Attention(nn.Module):
         if not any(is_lora_activated.values()):
             return self.processor
 
+        if self.fused_projections:
+            raise ValueError(
+                "The legacy LoRA attention processors are not supported with fused projections, since `to_q`, `to_k` and"
+                " `to_v` have been merged. Load the LoRA through the PEFT backend or leave the projections unfused."
+            )
+
         # If doesn't apply LoRA do `add_k_proj` or `add_v_proj`
         is_lora_activated.pop("add_k_proj", None)
         is_lora_activated.pop("add_v_proj", None)
@@ -730,6 +818,9 @@ class Attention(nn.Module):
         self.norm = nn.LayerNorm(self.inner_dim)
 
 
+ATTENTION_MODES = ("flash", "xformers", "chunked")
+
+
 class AttnProcessor2_0(nn.Module):
     r"""
     Processor for implementing scaled dot-product attention (enabled by default if you're using PyTorch 2.0).
@@ -743,6 +834,8 @@ class AttnProcessor2_0(nn.Module):
 
         if self.use_rope:
             self._init_rope(interpolation_scale_thw)
+        # set by `AllegroTransformer3DModel.enable_sequence_parallel` on self-attention processors
+        self.sequence_parallel = None
 
         if not hasattr(F, "scaled_dot_product_attention"):
             raise ImportError("AttnProcessor2_0 requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0.")
@@ -761,9 +854,12 @@ class AttnProcessor2_0(nn.Module):
         frame: int = 8, 
         height: int = 16, 
         width: int = 16, 
+        token_index: Optional[torch.LongTensor] = None,
     ) -> torch.FloatTensor:
 
         residual = hidden_states
+        # the local slice of a sequence sharded across ranks attends to all of it, see `ring_attention`
+        sequence_parallel = self.sequence_parallel if encoder_hidden_states is None else None
 
         if attn.spatial_norm is not None:
             hidden_states = attn.spatial_norm(hidden_states, temb)
@@ -779,7 +875,14 @@ class AttnProcessor2_0(nn.Module):
             hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
         )
         
-        if attention_mask is not None and self.attention_mode == 'xformers':
+        if attention_mask is None or attention_mask.ndim == 4:
+            # no mask, or a bias that already broadcasts over heads and query tokens, e.g. `(batch, 1, 1, key_tokens)`
+            # as built once per step by the transformer, instead of a copy per head
+            pass
+        elif sequence_parallel is not None:
+            # a bias over the keys of the full sequence, sliced per key shard inside `ring_attention`
+            attention_mask = attention_mask.view(batch_size, 1, 1, attention_mask.shape[-1])
+        elif self.attention_mode == 'xformers':
             attention_heads = attn.heads
             attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size, head_size=attention_heads)
             attention_mask = attention_mask.view(batch_size, attention_heads, -1, attention_mask.shape[-1])
@@ -792,15 +895,22 @@ class AttnProcessor2_0(nn.Module):
         if attn.group_norm is not None:
             hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = attn.to_q(hidden_states)
+        if attn.fused_projections and not attn.is_cross_attention:
+            # one GEMM for all three projections, split into views of its output
+            query, key, value = attn.to_qkv(hidden_states).chunk(3, dim=-1)
+        else:
+            query = attn.to_q(hidden_states)
 
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+            if encoder_hidden_states is None:
+                encoder_hidden_states = hidden_states
+            elif attn.norm_cross:
+                encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
 
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+            if attn.fused_projections:
+                key, value = attn.to_kv(encoder_hidden_states).chunk(2, dim=-1)
+            else:
+                key = attn.to_k(encoder_hidden_states)
+                value = attn.to_v(encoder_hidden_states)
 
        
        
@@ -817,17 +927,28 @@ class AttnProcessor2_0(nn.Module):
         if self.use_rope:
             # require the shape of (batch_size x nheads x ntokens x dim)
             pos_thw = self.position_getter(batch_size, t=frame, h=height, w=width, device=query.device)
+            if sequence_parallel is not None:
+                pos_thw = sequence_parallel.shard_positions(pos_thw, frame * height * width)
+            if token_index is not None:
+                # tokens left after merging keep the positions they have in the full sequence
+                poses, max_poses = pos_thw
+                pos_thw = tuple(pos.gather(1, token_index) for pos in poses), max_poses
             query = self.rope(query, pos_thw)
             key = self.rope(key, pos_thw)
 
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
         # TODO: add support for attn.scale when we move to Torch 2.1
-        if self.attention_mode == 'flash':
+        if sequence_parallel is not None:
+            hidden_states = ring_attention(query, key, value, attention_mask, sequence_parallel, frame * height * width)
+        elif self.attention_mode == 'flash':
                 # assert attention_mask is None, 'flash-attn do not support attention_mask'
                 with sdp_kernel(enable_flash=True, enable_math=True, enable_mem_efficient=True, enable_cudnn=True): #sdpa_kernel(SDPBackend.FLASH_ATTENTION):
                     hidden_states = F.scaled_dot_product_attention(
                         query, key, value, attn_mask=attention_mask
                     )
+        elif self.attention_mode == 'chunked':
+            # bounded memory reference path, e.g. for CPU where sdpa with a bias mask materializes all scores
+            hidden_states = chunked_attention(query, key, value, attn_mask=attention_mask)
         elif self.attention_mode == 'xformers':
             with sdpa_kernel(SDPBackend.EFFICIENT_ATTENTION):
                 hidden_states = F.scaled_dot_product_attention(
@@ -835,11 +956,15 @@ class AttnProcessor2_0(nn.Module):
                 )
         
 
-        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn_heads * head_dim)
-        hidden_states = hidden_states.to(query.dtype)
-        
-        # linear proj
-        hidden_states = attn.to_out[0](hidden_states)
+        if attn._out_chunk_size is not None and hidden_states.shape[2] > attn._out_chunk_size:
+            # merge heads and project one token slice at a time, see `Attention.set_chunk_out_projection`
+            hidden_states = _chunked_out_projection(attn, hidden_states, attn._out_chunk_size, query.dtype)
+        else:
+            hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn_heads * head_dim)
+            hidden_states = hidden_states.to(query.dtype)
+
+            # linear proj
+            hidden_states = attn.to_out[0](hidden_states)
         # dropout
         hidden_states = attn.to_out[1](hidden_states)
 
@@ -1053,6 +1178,55 @@ class BasicTransformerBlock(nn.Module):
         if self.use_ada_layer_norm_single:
             self.scale_shift_table = nn.Parameter(torch.randn(6, dim) / dim**0.5)
 
+        # let chunk size default to None
+        self._chunk_size = None
+        self._chunk_dim = 1
+        # set by `AllegroTransformer3DModel.enable_token_merging`
+        self.token_merging = None
+        # see `set_compiled_modulation`
+        self._compiled_modulation = False
+
+    def set_chunk_feed_forward(self, chunk_size: Optional[int], dim: int = 1) -> None:
+        r"""
+        Run the feed-forward over slices of `chunk_size` along `dim` (tokens by default), so that only one slice of its
+        4x wide intermediate activation is alive at a time. `None` or 0 disables chunking.
+        """
+        self._chunk_size = chunk_size or None
+        self._chunk_dim = dim
+
+    def set_compiled_modulation(self, enabled: bool) -> None:
+        r"""
+        Run the adaLN-single LayerNorm and modulation through [`compiled_layer_norm_modulate`] instead of the eager
+        [`layer_norm_modulate`]. Not needed when the whole block is compiled, see `compile_transformer`.
+        """
+        self._compiled_modulation = enabled
+
+    def _layer_norm_modulate(self, norm, hidden_states, shift, scale):
+        fn = compiled_layer_norm_modulate if self._compiled_modulation else layer_norm_modulate
+        return fn(hidden_states, norm.normalized_shape, norm.weight, norm.bias, norm.eps, shift, scale)
+
+    def fuse_projections(self) -> None:
+        r"""
+        Fuse the q/k/v projections of `attn1` and the k/v projections of `attn2`, see [`Attention.fuse_projections`].
+        """
+        self.attn1.fuse_projections()
+        if self.attn2 is not None:
+            self.attn2.fuse_projections()
+
+    def modulated_input(self, hidden_states: torch.FloatTensor, timestep: torch.FloatTensor) -> torch.FloatTensor:
+        r"""
+        The normalized and timestep-modulated input of the self-attention (`ada_norm_single` only), as computed at the
+        start of `forward`. Works while the block itself still sits on another device, as in low VRAM mode.
+        """
+        batch_size = hidden_states.shape[0]
+        device, dtype = hidden_states.device, hidden_states.dtype
+        shift_msa, scale_msa = (
+            self.scale_shift_table[None, :2].to(device, dtype) + timestep.reshape(batch_size, 6, -1)[:, :2]
+        ).chunk(2, dim=1)
+        weight = self.norm1.weight.to(device, dtype) if self.norm1.weight is not None else None
+        bias = self.norm1.bias.to(device, dtype) if self.norm1.bias is not None else None
+        return layer_norm_modulate(hidden_states, self.norm1.normalized_shape, weight, bias, self.norm1.eps, shift_msa, scale_msa)
+
 
     def forward(
         self,
@@ -1085,30 +1259,48 @@ class BasicTransformerBlock(nn.Module):
             shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (
                 self.scale_shift_table[None] + timestep.reshape(batch_size, 6, -1)
             ).chunk(6, dim=1)
-            norm_hidden_states = self.norm1(hidden_states)
-            norm_hidden_states = norm_hidden_states * (1 + scale_msa) + shift_msa
+            norm_hidden_states = self._layer_norm_modulate(self.norm1, hidden_states, shift_msa, scale_msa)
             norm_hidden_states = norm_hidden_states.squeeze(1)
         else:
             raise ValueError("Incorrect norm used")
 
         if self.pos_embed is not None:
             norm_hidden_states = self.pos_embed(norm_hidden_states)
-        
-        attn_output = self.attn1(
-            norm_hidden_states,
-            encoder_hidden_states=encoder_hidden_states if self.only_cross_attention else None,
-            attention_mask=attention_mask, 
-            frame=frame,
-            height=height,
-            width=width, 
-            **cross_attention_kwargs,
-        )
+
+        merge_plan = None
+        if self.token_merging is not None:
+            merge_plan = self.token_merging.plan(norm_hidden_states, frame, height, width)
+        if merge_plan is not None:
+            attn_output = self.attn1(
+                merge_plan.merge(norm_hidden_states),
+                encoder_hidden_states=encoder_hidden_states if self.only_cross_attention else None,
+                attention_mask=merge_plan.merge_mask(attention_mask),
+                frame=frame,
+                height=height,
+                width=width,
+                token_index=merge_plan.kept,
+                **cross_attention_kwargs,
+            )
+            attn_output = merge_plan.unmerge(attn_output)
+        else:
+            attn_output = self.attn1(
+                norm_hidden_states,
+                encoder_hidden_states=encoder_hidden_states if self.only_cross_attention else None,
+                attention_mask=attention_mask, 
+                frame=frame,
+                height=height,
+                width=width, 
+                **cross_attention_kwargs,
+            )
         if self.use_ada_layer_norm_zero:
             attn_output = gate_msa.unsqueeze(1) * attn_output
-        elif self.use_ada_layer_norm_single:
-            attn_output = gate_msa * attn_output
 
-        hidden_states = attn_output + hidden_states
+        if self.use_ada_layer_norm_single:
+            # one pass, into a new tensor that the later residuals of this block update in place; the block input
+            # itself is left alone, e.g. for the step cache's residual
+            hidden_states = torch.addcmul(hidden_states, gate_msa, attn_output)
+        else:
+            hidden_states = attn_output + hidden_states
         if hidden_states.ndim == 4:
             hidden_states = hidden_states.squeeze(1)
 
@@ -1135,7 +1327,10 @@ class BasicTransformerBlock(nn.Module):
                 attention_mask=encoder_attention_mask,
                 **cross_attention_kwargs,
             )
-            hidden_states = attn_output + hidden_states
+            if self.use_ada_layer_norm_single:
+                hidden_states = gated_residual(hidden_states, attn_output)
+            else:
+                hidden_states = attn_output + hidden_states
 
 
         # 2. Feed-forward
@@ -1146,18 +1341,25 @@ class BasicTransformerBlock(nn.Module):
             norm_hidden_states = norm_hidden_states * (1 + scale_mlp[:, None]) + shift_mlp[:, None]
 
         if self.use_ada_layer_norm_single:
-            norm_hidden_states = self.norm2(hidden_states)
-            norm_hidden_states = norm_hidden_states * (1 + scale_mlp) + shift_mlp
+            norm_hidden_states = self._layer_norm_modulate(self.norm2, hidden_states, shift_mlp, scale_mlp)
 
-        ff_output = self.ff(norm_hidden_states)
+        if merge_plan is not None:
+            # the plan of the self-attention is reused, the tokens barely moved since
+            norm_hidden_states = merge_plan.merge(norm_hidden_states)
+        if self._chunk_size is not None and norm_hidden_states.shape[self._chunk_dim] > self._chunk_size:
+            ff_output = _chunked_feed_forward(self.ff, norm_hidden_states, self._chunk_dim, self._chunk_size)
+        else:
+            ff_output = self.ff(norm_hidden_states)
+        if merge_plan is not None:
+            ff_output = merge_plan.unmerge(ff_output)
 
         if self.use_ada_layer_norm_zero:
             ff_output = gate_mlp.unsqueeze(1) * ff_output
-        elif self.use_ada_layer_norm_single:
-            ff_output = gate_mlp * ff_output
 
-
-        hidden_states = ff_output + hidden_states
+        if self.use_ada_layer_norm_single:
+            hidden_states = gated_residual(hidden_states, ff_output, gate_mlp)
+        else:
+            hidden_states = ff_output + hidden_states
         if hidden_states.ndim == 4:
             hidden_states = hidden_states.squeeze(1)
 
@@ -0,0 +1,78 @@
+from typing import Optional
+
+import torch
+
+
+def chunked_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attn_mask: Optional[torch.Tensor] = None,
+    query_chunk_size: int = 1024,
+    key_chunk_size: Optional[int] = 4096,
+    return_lse: bool = False,
+):
+    r"""
+    Scaled dot product attention over query and key chunks with an online softmax, the reference path of
+    `attention_mode='chunked'`.
+
+    Scores are only ever held for `query_chunk_size` queries against `key_chunk_size` keys, in float32. For every query
+    chunk the key chunks are visited in turn, keeping the running maximum, the running softmax denominator and the
+    unnormalized output, which are rescaled whenever a later chunk raises the maximum. The result matches
+    `F.scaled_dot_product_attention` up to accumulation order, without materializing the `queries x keys` matrix.
+
+    Args:
+        query, key, value (`torch.Tensor` of shape `(batch, heads, tokens, head_dim)`):
+            As for `F.scaled_dot_product_attention`.
+        attn_mask (`torch.Tensor`, *optional*):
+            Additive bias broadcastable to `(batch, heads, query_tokens, key_tokens)`; its query dimension may be 1.
+        query_chunk_size (`int`, *optional*, defaults to 1024):
+            Queries per chunk.
+        key_chunk_size (`int`, *optional*, defaults to 4096):
+            Keys per chunk, `None` attends to all keys at once.
+        return_lse (`bool`, *optional*, defaults to `False`):
+            Also return the log-sum-exp of the scores per query, `(batch, heads, query_tokens, 1)`, so that results
+            over disjoint key sets can be merged exactly. The output is then kept in float32.
+    """
+    batch_size, heads, query_tokens, _ = query.shape
+    key_tokens = key.shape[2]
+    key_chunk_size = key_chunk_size or key_tokens
+    scale = query.shape[-1] ** -0.5
+    output = torch.empty(
+        batch_size, heads, query_tokens, value.shape[-1], device=query.device,
+        dtype=torch.float32 if return_lse else query.dtype,
+    )
+    lse = query.new_empty(batch_size, heads, query_tokens, 1, dtype=torch.float32) if return_lse else None
+
+    for q_start in range(0, query_tokens, query_chunk_size):
+        q_end = min(q_start + query_chunk_size, query_tokens)
+        q = query[:, :, q_start:q_end].float() * scale
+        bias = None
+        if attn_mask is not None:
+            bias = attn_mask if attn_mask.shape[-2] == 1 else attn_mask[..., q_start:q_end, :]
+        running_max, denominator, accumulator = None, None, None
+        for k_start in range(0, key_tokens, key_chunk_size):
+            k_end = min(k_start + key_chunk_size, key_tokens)
+            scores = torch.matmul(q, key[:, :, k_start:k_end].float().transpose(-1, -2))
+            if bias is not None:
+                scores = scores + bias[..., k_start:k_end].float()
+            chunk_max = scores.amax(dim=-1, keepdim=True)
+            if running_max is None:
+                running_max = chunk_max
+                probs = torch.exp(scores - running_max)
+                denominator = probs.sum(dim=-1, keepdim=True)
+                accumulator = torch.matmul(probs, value[:, :, k_start:k_end].float())
+            else:
+                new_max = torch.maximum(running_max, chunk_max)
+                correction = torch.exp(running_max - new_max)
+                probs = torch.exp(scores - new_max)
+                denominator = denominator * correction + probs.sum(dim=-1, keepdim=True)
+                accumulator = accumulator * correction + torch.matmul(probs, value[:, :, k_start:k_end].float())
+                running_max = new_max
+        output[:, :, q_start:q_end] = accumulator / denominator
+        if return_lse:
+            lse[:, :, q_start:q_end] = running_max + torch.log(denominator)
+
+    if return_lse:
+        return output, lse
+    return output
@@ -0,0 +1,47 @@
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+def layer_norm_modulate(
+    hidden_states: torch.Tensor,
+    normalized_shape: Tuple[int, ...],
+    weight: Optional[torch.Tensor],
+    bias: Optional[torch.Tensor],
+    eps: float,
+    shift: torch.Tensor,
+    scale: torch.Tensor,
+) -> torch.Tensor:
+    r"""
+    `layer_norm(hidden_states) * (1 + scale) + shift`, the adaLN-single modulation, with the scale and shift applied
+    in one `addcmul` pass over the normalized tokens instead of a multiply and an add with a temporary in between.
+    `shift` and `scale` are `(batch, 1, dim)`, so `1 + scale` is per sample and cheap.
+    """
+    norm_hidden_states = F.layer_norm(hidden_states, normalized_shape, weight, bias, eps)
+    return torch.addcmul(shift, norm_hidden_states, 1 + scale)
+
+
+_compiled_layer_norm_modulate = None
+
+
+def compiled_layer_norm_modulate(*args) -> torch.Tensor:
+    r"""
+    [`layer_norm_modulate`] through `torch.compile`, which fuses the normalization and the modulation into a single
+    kernel reading the tokens once. Inductor generates C++ on CPU, so no Triton is needed there. The graph is compiled
+    with dynamic shapes on first use and shared by all blocks.
+    """
+    global _compiled_layer_norm_modulate
+    if _compiled_layer_norm_modulate is None:
+        _compiled_layer_norm_modulate = torch.compile(layer_norm_modulate, dynamic=True)
+    return _compiled_layer_norm_modulate(*args)
+
+
+def gated_residual(hidden_states: torch.Tensor, update: torch.Tensor, gate: Optional[torch.Tensor] = None) -> torch.Tensor:
+    r"""
+    `hidden_states + gate * update`, or `hidden_states + update` without a gate, in one pass. Without autograd the sum
+    is written into `hidden_states`, which must then be a tensor the caller owns, not the input of the block.
+    """
+    if torch.is_grad_enabled():
+        return hidden_states + update if gate is None else torch.addcmul(hidden_states, gate, update)
+    return hidden_states.add_(update) if gate is None else hidden_states.addcmul_(gate, update)
@@ -0,0 +1,185 @@
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from diffusers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+QUANTIZATION_MODES = ("none", "int8", "fp8", "w8a8")
+# modes storing the weight as int8
+INT8_MODES = ("int8", "w8a8")
+
+
+def fp8_available() -> bool:
+    return hasattr(torch, "float8_e4m3fn")
+
+
+class QuantizedLinear(nn.Module):
+    r"""
+    Quantized replacement of `nn.Linear`.
+
+    The weight is stored as int8 or float8_e4m3fn with one float32 scale per output channel, bias stays in the compute
+    dtype. Since the scale is per output channel it commutes with the matmul and is applied to the output
+    (`(x @ q.T) * scale`).
+
+    `"int8"` and `"fp8"` are weight-only: activations stay in the compute dtype and the weight is dequantized to it
+    for the matmul, one slice of output channels of at most `dequantize_chunk_elements` at a time, so the transient
+    full precision copy stays bounded by the slice size. `"w8a8"` additionally quantizes the activations to int8 per
+    token on the fly and multiplies with `torch._int_mm` on CUDA, which reads the weight as int8 in the matmul itself
+    at the cost of the activation rounding error. Where `_int_mm` is not available or does not take the shapes it
+    falls back to the weight-only path.
+
+    Parameters:
+        in_features (`int`): The number of input features.
+        out_features (`int`): The number of output features.
+        bias (`bool`, *optional*, defaults to `True`): Whether the layer has a bias.
+        mode (`str`, *optional*, defaults to `"int8"`): `"int8"`, `"fp8"` or `"w8a8"`.
+    """
+
+    # elements of the dequantized weight slice the fallback path materializes at once
+    dequantize_chunk_elements = 1 << 24
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True, mode: str = "int8"):
+        super().__init__()
+        if mode in INT8_MODES:
+            weight_dtype = torch.int8
+        elif mode == "fp8":
+            if not fp8_available():
+                raise ValueError("fp8 quantization requires a PyTorch build with torch.float8_e4m3fn (2.1 or newer).")
+            weight_dtype = torch.float8_e4m3fn
+        else:
+            raise ValueError(f"Unknown quantization mode {mode}, expected one of {QUANTIZATION_MODES[1:]}")
+        self.in_features = in_features
+        self.out_features = out_features
+        self.mode = mode
+        self.register_buffer("weight", torch.zeros(out_features, in_features, dtype=weight_dtype))
+        self.register_buffer("weight_scale", torch.ones(out_features, dtype=torch.float32))
+        self.bias = nn.Parameter(torch.zeros(out_features)) if bias else None
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, mode: str = "int8") -> "QuantizedLinear":
+        quantized = cls(linear.in_features, linear.out_features, bias=linear.bias is not None, mode=mode).to(
+            linear.weight.device
+        )
+        weight = linear.weight.detach().float()
+        # symmetric per output channel absmax scaling onto the range of the storage dtype
+        qmax = 127.0 if mode in INT8_MODES else torch.finfo(torch.float8_e4m3fn).max
+        scale = weight.abs().amax(dim=1).clamp(min=1e-12) / qmax
+        weight = weight / scale[:, None]
+        if mode in INT8_MODES:
+            weight = weight.round().clamp(-127, 127)
+        quantized.weight.copy_(weight.to(quantized.weight.dtype))
+        quantized.weight_scale.copy_(scale)
+        if linear.bias is not None:
+            quantized.bias = nn.Parameter(linear.bias.detach().clone(), requires_grad=False)
+        return quantized
+
+    def dequantize(self, dtype: Optional[torch.dtype] = None) -> torch.Tensor:
+        dtype = dtype if dtype is not None else torch.float32
+        return self.weight.to(dtype) * self.weight_scale.to(dtype)[:, None]
+
+    def _apply(self, fn, *args, **kwargs):
+        # keep the storage dtypes when the whole model is cast, e.g. by `transformer.to(dtype=torch.bfloat16)`,
+        # while still following device moves
+        stored = {name: self._buffers[name] for name in ("weight", "weight_scale")}
+        super()._apply(fn, *args, **kwargs)
+        for name, tensor in stored.items():
+            if self._buffers[name].dtype != tensor.dtype:
+                self._buffers[name] = tensor.to(self._buffers[name].device)
+        return self
+
+    def _int_mm_supported(self, hidden_states: torch.Tensor) -> bool:
+        # only w8a8 quantizes activations, and only where the cuBLASLt int8 GEMM of `torch._int_mm` takes the shapes
+        return (
+            self.mode == "w8a8"
+            and hidden_states.is_cuda
+            and hasattr(torch, "_int_mm")
+            and hidden_states.numel() // self.in_features > 16
+            and self.in_features % 8 == 0
+            and self.out_features % 8 == 0
+        )
+
+    def _int8_matmul(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        # symmetric per token activation scales, so that int8 x int8 accumulates exactly in int32
+        x = hidden_states.reshape(-1, self.in_features)
+        x_scale = x.abs().amax(dim=1, keepdim=True).clamp(min=1e-6) / 127.0
+        x_int8 = (x / x_scale).round_().clamp_(-127, 127).to(torch.int8)
+        output = torch._int_mm(x_int8, self.weight.t()).to(hidden_states.dtype)
+        output = output.mul_(x_scale).mul_(self.weight_scale.to(hidden_states.dtype))
+        return output.reshape(*hidden_states.shape[:-1], self.out_features)
+
+    def _dequantized_matmul(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        # int8 and e4m3 values are exact in bfloat16/float16, so the cast is lossless and the only rounding is the
+        # scale applied to the matmul output
+        dtype = hidden_states.dtype
+        rows = max(self.dequantize_chunk_elements // self.in_features, 1)
+        if rows >= self.out_features:
+            return F.linear(hidden_states, self.weight.to(dtype)).mul_(self.weight_scale.to(dtype))
+        output = hidden_states.new_empty((*hidden_states.shape[:-1], self.out_features))
+        for start in range(0, self.out_features, rows):
+            end = min(start + rows, self.out_features)
+            chunk = F.linear(hidden_states, self.weight[start:end].to(dtype))
+            output[..., start:end] = chunk.mul_(self.weight_scale[start:end].to(dtype))
+        return output
+
+    def matmul_path(self, hidden_states: torch.Tensor) -> str:
+        """`"int_mm"` or `"dequantized"`, the branch `forward` takes for `hidden_states`."""
+        return "int_mm" if self._int_mm_supported(hidden_states) else "dequantized"
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        if self._int_mm_supported(hidden_states):
+            output = self._int8_matmul(hidden_states)
+        else:
+            output = self._dequantized_matmul(hidden_states)
+        if self.bias is not None:
+            output = output + self.bias.to(hidden_states.dtype)
+        return output
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, mode={self.mode}"
+
+
+def _quantize_children(module: nn.Module, mode: str) -> int:
+    count = 0
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, QuantizedLinear.from_linear(child, mode))
+            count += 1
+        else:
+            count += _quantize_children(child, mode)
+    return count
+
+
+@torch.no_grad()
+def quantize_transformer(transformer: nn.Module, mode: str = "int8") -> nn.Module:
+    r"""
+    Replace the linears of every `BasicTransformerBlock` (`to_q`, `to_k`, `to_v` or their fused `to_qkv`/`to_kv`,
+    `to_out` of both attentions and the FeedForward projections) and of the shared adaLN-single modulation with weight-only quantized ones, in place.
+
+    Embeddings (including the timestep MLP of adaLN-single), the caption projection and the output projection are left
+    in full precision since they are small and sensitive.
+
+    Args:
+        transformer (`nn.Module`):
+            An `AllegroTransformer3DModel` or `AllegroTransformerTI2V3DModel`.
+        mode (`str`, *optional*, defaults to `"int8"`):
+            One of `"none"`, `"int8"`, `"fp8"` or `"w8a8"`, see [`QuantizedLinear`].
+    """
+    if mode == "none":
+        return transformer
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode {mode}, expected one of {QUANTIZATION_MODES}")
+    count = 0
+    for block in transformer.transformer_blocks:
+        for module in (block.attn1, block.attn2, block.ff):
+            if module is not None:
+                count += _quantize_children(module, mode)
+    if getattr(transformer, "adaln_single", None) is not None:
+        transformer.adaln_single.linear = QuantizedLinear.from_linear(transformer.adaln_single.linear, mode)
+        count += 1
+    logger.info(f"Quantized {count} linears of {transformer.__class__.__name__} to {mode}")
+    return transformer
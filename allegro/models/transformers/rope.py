@@ -15,7 +15,7 @@ class PositionGetter3D(object):
         self.cache_positions = {}
         
     def __call__(self, b, t, h, w, device):
-        if not (b, t,h,w) in self.cache_positions:
+        if not (b, t, h, w, device) in self.cache_positions:
             x = torch.arange(w, device=device)
             y = torch.arange(h, device=device)
             z = torch.arange(t, device=device)
@@ -23,10 +23,11 @@ class PositionGetter3D(object):
            
             pos = pos.reshape(t * h * w, 3).transpose(0, 1).reshape(3, 1, -1).contiguous().expand(3, b, -1).clone()
             poses = (pos[0].contiguous(), pos[1].contiguous(), pos[2].contiguous())
-            max_poses = (int(poses[0].max()), int(poses[1].max()), int(poses[2].max()))
+            # known from the grid, reading them back from the device would synchronize with it
+            max_poses = (t - 1, h - 1, w - 1)
 
-            self.cache_positions[b, t, h, w] = (poses, max_poses)
-        pos = self.cache_positions[b, t, h, w]
+            self.cache_positions[b, t, h, w, device] = (poses, max_poses)
+        pos = self.cache_positions[b, t, h, w, device]
 
         return pos
     
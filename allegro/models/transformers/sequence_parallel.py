@@ -0,0 +1,124 @@
+from typing import List, Optional, Tuple
+
+import torch
+import torch.distributed as dist
+
+from allegro.models.transformers.chunked_attention import chunked_attention
+
+
+class SequenceParallel:
+    r"""
+    Shards the patched token sequence of the transformer across the ranks of a `torch.distributed` process group.
+
+    Every rank keeps a contiguous slice of the tokens through the whole block stack. Norms, the feed-forward and the
+    cross-attention are token-local and run on the slice unchanged; the self-attention is computed by
+    [`ring_attention`], which passes the key/value slices around the ring of ranks. The slices are gathered again
+    before the output projection, so every rank returns the full prediction. Works with any backend that supports
+    point-to-point communication, including gloo on CPU.
+
+    Parameters:
+        group (`torch.distributed.ProcessGroup`, *optional*):
+            The ranks that share one sample, defaults to the default (world) group.
+        query_chunk_size (`int`, *optional*, defaults to 1024):
+            Queries per chunk of the partial attentions, see [`chunked_attention`].
+    """
+
+    def __init__(self, group: Optional[dist.ProcessGroup] = None, query_chunk_size: int = 1024):
+        if not dist.is_available() or not dist.is_initialized():
+            raise RuntimeError("Sequence parallelism requires an initialized torch.distributed process group")
+        self.group = group
+        self.rank = dist.get_rank(group)
+        self.world_size = dist.get_world_size(group)
+        # point-to-point calls take global ranks
+        self.global_ranks = dist.get_process_group_ranks(group) if group is not None else list(range(self.world_size))
+        self.query_chunk_size = query_chunk_size
+
+    def bounds(self, tokens: int, rank: Optional[int] = None) -> Tuple[int, int]:
+        """Token range `[start, end)` held by `rank`, the first `tokens % world_size` ranks hold one extra token."""
+        rank = self.rank if rank is None else rank
+        size, extra = divmod(tokens, self.world_size)
+        start = rank * size + min(rank, extra)
+        return start, start + size + (1 if rank < extra else 0)
+
+    def shard(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        start, end = self.bounds(hidden_states.shape[1])
+        return hidden_states[:, start:end]
+
+    def shard_positions(self, positions, tokens: int):
+        """Slices the `PositionGetter3D` output of the full sequence down to the local tokens."""
+        poses, max_poses = positions
+        start, end = self.bounds(tokens)
+        return tuple(pos[:, start:end] for pos in poses), max_poses
+
+    def gather(self, hidden_states: torch.Tensor, tokens: int) -> torch.Tensor:
+        # all_gather needs equally sized buffers, pad every slice to the longest one and trim afterwards
+        bounds = [self.bounds(tokens, rank) for rank in range(self.world_size)]
+        longest = max(end - start for start, end in bounds)
+        padding = longest - hidden_states.shape[1]
+        if padding > 0:
+            hidden_states = torch.cat([hidden_states, hidden_states.new_zeros(hidden_states.shape[0], padding, *hidden_states.shape[2:])], dim=1)
+        parts: List[torch.Tensor] = [torch.empty_like(hidden_states) for _ in range(self.world_size)]
+        dist.all_gather(parts, hidden_states.contiguous(), group=self.group)
+        return torch.cat([part[:, : end - start] for part, (start, end) in zip(parts, bounds)], dim=1)
+
+
+def ring_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attention_mask: Optional[torch.Tensor],
+    sequence_parallel: SequenceParallel,
+    tokens: int,
+) -> torch.Tensor:
+    r"""
+    Self-attention of the local query slice over the keys and values of all ranks.
+
+    Each of the `world_size` steps attends to the key/value slice currently held while that slice is sent on to the
+    next rank and the previous rank's slice is received, so communication overlaps compute. Partial results are merged
+    with their log-sum-exp, which gives the same result as attending to the whole sequence at once.
+
+    Args:
+        query, key, value (`torch.Tensor` of shape `(batch, heads, local_tokens, head_dim)`):
+            RoPE is expected to be applied already, with the positions of the local slice.
+        attention_mask (`torch.Tensor`, *optional*):
+            Bias over the keys of the full sequence, broadcastable to `(batch, heads, 1, tokens)`.
+        sequence_parallel (`SequenceParallel`):
+            The process group the sequence is sharded across.
+        tokens (`int`):
+            Length of the full sequence.
+    """
+    sp = sequence_parallel
+    send_to = sp.global_ranks[(sp.rank + 1) % sp.world_size]
+    recv_from = sp.global_ranks[(sp.rank - 1) % sp.world_size]
+    key_value = torch.stack([key, value]).contiguous()
+    output, lse = None, None
+    for step in range(sp.world_size):
+        source = (sp.rank - step) % sp.world_size
+        requests = []
+        if step < sp.world_size - 1:
+            start, end = sp.bounds(tokens, (source - 1) % sp.world_size)
+            received = key_value.new_empty(2, *key.shape[:2], end - start, key.shape[3])
+            requests = [
+                dist.isend(key_value, send_to, group=sp.group),
+                dist.irecv(received, recv_from, group=sp.group),
+            ]
+
+        bias = None
+        if attention_mask is not None:
+            start, end = sp.bounds(tokens, source)
+            bias = attention_mask[..., start:end].float()
+        block_output, block_lse = chunked_attention(
+            query, key_value[0], key_value[1], bias, query_chunk_size=sp.query_chunk_size, return_lse=True
+        )
+        if output is None:
+            output, lse = block_output, block_lse
+        else:
+            merged_lse = torch.logaddexp(lse, block_lse)
+            output = output * torch.exp(lse - merged_lse) + block_output * torch.exp(block_lse - merged_lse)
+            lse = merged_lse
+
+        for request in requests:
+            request.wait()
+        if requests:
+            key_value = received
+    return output.to(query.dtype)
@@ -0,0 +1,67 @@
+from typing import Hashable, Optional
+
+import torch
+
+
+class StepCache:
+    r"""
+    Cross-step cache of the transformer block stack.
+
+    Adjacent denoising steps feed the block stack with nearly identical inputs, so the residual the blocks add
+    (`output - input`) changes slowly as well. Before running the blocks the transformer hands the timestep-modulated
+    input of the first block to `lookup`. The relative L1 change of that input since the previous step is accumulated,
+    and while the sum stays below `threshold` the residual of the last computed step is returned for reuse instead of
+    running the blocks. Once it is exceeded the blocks run again, `store` records the new residual and the sum restarts
+    from zero.
+
+    State is kept per key, the transformer combines the caller's `step_cache_key` with the shape of the tokens, so
+    independent streams (e.g. different windows of the same video) never reuse each other's residuals.
+
+    Deciding whether to run the blocks needs the change on the host, so `lookup` synchronizes with the device once per
+    call after the warmup. This is the only host-device synchronization of a denoising step it adds.
+
+    Parameters:
+        threshold (`float`, *optional*, defaults to 0.1):
+            Accumulated relative L1 change below which the cached residual is reused. 0 never reuses.
+        warmup_steps (`int`, *optional*, defaults to 2):
+            Number of steps per key that are always computed before reuse is considered.
+        token_stride (`int`, *optional*, defaults to 4):
+            Only every `token_stride`-th token is modulated and compared, which keeps the probe and its copy small.
+    """
+
+    def __init__(self, threshold: float = 0.1, warmup_steps: int = 2, token_stride: int = 4):
+        self.threshold = threshold
+        self.warmup_steps = warmup_steps
+        self.token_stride = token_stride
+        self.hits = 0
+        self.misses = 0
+        self._states = {}
+
+    def reset(self) -> None:
+        self._states.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: Hashable, modulated: torch.Tensor) -> Optional[torch.Tensor]:
+        state = self._states.get(key)
+        if state is None or state["computed"] < self.warmup_steps:
+            return None
+        previous = state["modulated"]
+        change = ((modulated - previous).abs().mean() / previous.abs().mean().clamp(min=1e-8)).item()
+        state["modulated"] = modulated
+        state["accumulated"] += change
+        if state["accumulated"] < self.threshold:
+            self.hits += 1
+            return state["residual"]
+        return None
+
+    def store(self, key: Hashable, modulated: torch.Tensor, residual: torch.Tensor) -> None:
+        state = self._states.setdefault(key, {"computed": 0})
+        state["modulated"] = modulated
+        state["residual"] = residual
+        state["accumulated"] = 0.0
+        state["computed"] += 1
+        self.misses += 1
+
+    def __repr__(self) -> str:
+        return f"StepCache(threshold={self.threshold}, hits={self.hits}, misses={self.misses})"
@@ -0,0 +1,120 @@
+from typing import List, Optional, Tuple
+
+import torch
+
+
+def parse_block_indices(spec: str, num_blocks: int) -> List[int]:
+    """Block indices from a spec like `"8-23"` or `"0,4,10-12"`, empty selects every block."""
+    if not spec.strip():
+        return list(range(num_blocks))
+    indices = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        indices.update(range(int(first), int(last or first) + 1))
+    invalid = [index for index in indices if not 0 <= index < num_blocks]
+    if invalid:
+        raise ValueError(f"Block indices {sorted(invalid)} out of range for {num_blocks} blocks")
+    return sorted(indices)
+
+
+class MergePlan:
+    r"""
+    Which tokens of a `(batch, tokens, dim)` sequence are merged into which, computed by [`TokenMerging.plan`].
+
+    `kept` holds the indices of the remaining tokens in sequence order, `merged` the merged ones and `targets` the kept
+    token each of them was merged into.
+    """
+
+    def __init__(self, kept: torch.Tensor, merged: torch.Tensor, targets: torch.Tensor, tokens: int):
+        self.kept = kept
+        self.merged = merged
+        self.targets = targets
+        self.tokens = tokens
+        counts = torch.ones(kept.shape[0], tokens, device=kept.device)
+        counts.scatter_add_(1, targets, torch.ones_like(targets, dtype=counts.dtype))
+        self._counts = counts.gather(1, kept)[..., None]
+
+    def merge(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        """Averages every merged token into its target and drops it, `(batch, tokens, dim) -> (batch, kept, dim)`."""
+        dim = hidden_states.shape[-1]
+        sources = hidden_states.gather(1, self.merged[..., None].expand(-1, -1, dim))
+        summed = hidden_states.scatter_add(1, self.targets[..., None].expand(-1, -1, dim), sources)
+        return summed.gather(1, self.kept[..., None].expand(-1, -1, dim)) / self._counts.to(hidden_states.dtype)
+
+    def unmerge(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        """Copies the output of every target back to the tokens merged into it, `(batch, kept, dim) -> (batch, tokens, dim)`."""
+        batch_size, _, dim = hidden_states.shape
+        output = hidden_states.new_empty(batch_size, self.tokens, dim)
+        output.scatter_(1, self.kept[..., None].expand(-1, -1, dim), hidden_states)
+        output.scatter_(1, self.merged[..., None].expand(-1, -1, dim), output.gather(1, self.targets[..., None].expand(-1, -1, dim)))
+        return output
+
+    def merge_mask(self, attention_mask: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        """Keeps the key bias of the remaining tokens, `(batch, ..., tokens) -> (batch, ..., kept)`."""
+        if attention_mask is None:
+            return None
+        kept = self.kept.view(self.kept.shape[0], *[1] * (attention_mask.ndim - 2), -1)
+        return attention_mask.gather(-1, kept.expand(*attention_mask.shape[:-1], -1))
+
+
+class TokenMerging:
+    r"""
+    Spatio-temporal token merging for the self-attention and feed-forward of a block.
+
+    The patched video is divided into windows of `window` (frames, rows, columns) tokens, the first token of each
+    window being its anchor. Every other token is scored by the cosine similarity of its hidden state to its window's
+    anchor, and the `ratio` most similar tokens of the whole sequence are averaged into their anchors before `attn1`
+    and `ff`. Afterwards each merged token receives its anchor's output again. Anchors keep their own RoPE positions,
+    so the merged sequence is rotated as in the full one.
+
+    Parameters:
+        ratio (`float`, *optional*, defaults to 0.3):
+            Fraction of the tokens merged away, at most the share of non-anchor tokens.
+        window (`tuple` of `int`, *optional*, defaults to `(1, 2, 2)`):
+            Window size in patched frames, rows and columns.
+        similarity_chunk_size (`int`, *optional*, defaults to 8192):
+            Tokens scored at once, bounds the gathered copies of the hidden states.
+    """
+
+    def __init__(self, ratio: float = 0.3, window: Tuple[int, int, int] = (1, 2, 2), similarity_chunk_size: int = 8192):
+        self.ratio = ratio
+        self.window = tuple(window)
+        self.similarity_chunk_size = similarity_chunk_size
+        self._anchors = {}
+
+    def _window_anchors(self, frame: int, height: int, width: int, device: torch.device):
+        key = (frame, height, width, device)
+        if key not in self._anchors:
+            window_t, window_h, window_w = self.window
+            t = torch.arange(frame, device=device)[:, None, None]
+            y = torch.arange(height, device=device)[None, :, None]
+            x = torch.arange(width, device=device)[None, None, :]
+            # tokens are ordered (t, h, w) as in `PositionGetter3D`
+            anchor = (t - t % window_t) * height * width + (y - y % window_h) * width + (x - x % window_w)
+            anchor = anchor.flatten()
+            sources = torch.nonzero(anchor != torch.arange(anchor.numel(), device=device)).flatten()
+            self._anchors[key] = (sources, anchor[sources])
+        return self._anchors[key]
+
+    def plan(self, hidden_states: torch.Tensor, frame: int, height: int, width: int) -> Optional[MergePlan]:
+        batch_size, tokens, _ = hidden_states.shape
+        sources, anchors = self._window_anchors(frame, height, width, hidden_states.device)
+        count = min(int(tokens * self.ratio), sources.numel())
+        if count <= 0:
+            return None
+        similarity = []
+        for start in range(0, sources.numel(), self.similarity_chunk_size):
+            source = hidden_states[:, sources[start : start + self.similarity_chunk_size]].float()
+            anchor = hidden_states[:, anchors[start : start + self.similarity_chunk_size]].float()
+            similarity.append(torch.nn.functional.cosine_similarity(source, anchor, dim=-1))
+        top = torch.cat(similarity, dim=1).topk(count, dim=-1).indices
+        merged, targets = sources[top], anchors[top]
+        # a stable sort puts the kept tokens first in their original order, without the host-device synchronization
+        # of a boolean mask gather
+        dropped = torch.zeros(batch_size, tokens, dtype=torch.uint8, device=hidden_states.device)
+        dropped.scatter_(1, merged, 1)
+        kept = torch.sort(dropped, dim=1, stable=True).indices[:, : tokens - count]
+        return MergePlan(kept, merged, targets, tokens)
@@ -8,7 +8,7 @@
 # --------------------------------------------------------
 
 from dataclasses import dataclass
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
 
 import os
 from torch import nn
@@ -21,7 +21,10 @@ from diffusers.configuration_utils import ConfigMixin, register_to_config
 from diffusers.models.modeling_utils import ModelMixin
 from diffusers.models.embeddings import PixArtAlphaTextProjection
 
-from allegro.models.transformers.block import to_2tuple, BasicTransformerBlock, AdaLayerNormSingle
+from allegro.models.transformers.block import to_2tuple, ATTENTION_MODES, BasicTransformerBlock, AdaLayerNormSingle
+from allegro.models.transformers.step_cache import StepCache
+from allegro.models.transformers.sequence_parallel import SequenceParallel
+from allegro.models.transformers.token_merging import TokenMerging
 from allegro.models.transformers.embedding import PatchEmbed2D, PatchEmbed2DTI2V
 from tqdm import tqdm
 logger = logging.get_logger(__name__)
@@ -222,6 +225,8 @@ class AllegroTransformerTI2V3DModel(ModelMixin, ConfigMixin):
             )
         
         self.gradient_checkpointing = False
+        self.step_cache = None
+        self.sequence_parallel = None
 
         # init masked_video and mask conv_in
         self._init_patched_inputs_for_ti2v()
@@ -229,6 +234,120 @@ class AllegroTransformerTI2V3DModel(ModelMixin, ConfigMixin):
     def _set_gradient_checkpointing(self, value=False):
         self.gradient_checkpointing = value
 
+    def enable_step_cache(self, threshold: float = 0.1, warmup_steps: int = 2) -> StepCache:
+        r"""
+        Reuse the residual of the block stack across denoising steps while the timestep-modulated input of the first
+        block changes by less than `threshold` (accumulated relative L1). See [`StepCache`].
+        """
+        if self.config.norm_type != "ada_norm_single":
+            raise ValueError(f"Step cache requires norm_type 'ada_norm_single', got {self.config.norm_type}")
+        self.step_cache = StepCache(threshold=threshold, warmup_steps=warmup_steps)
+        return self.step_cache
+
+    def disable_step_cache(self):
+        self.step_cache = None
+
+    def fuse_qkv_projections(self) -> None:
+        r"""
+        Fuse the attention projections of every block at load time, so that self-attention runs one q/k/v GEMM and
+        cross-attention one k/v GEMM per step. Apply before `quantize_transformer`, which then quantizes the fused
+        linears.
+        """
+        for block in self.transformer_blocks:
+            block.fuse_projections()
+
+    def set_compiled_modulation(self, enabled: bool = True) -> None:
+        r"""
+        Fuse the adaLN-single LayerNorm and modulation of every block into one kernel with `torch.compile`, see
+        `BasicTransformerBlock.set_compiled_modulation`.
+        """
+        for block in self.transformer_blocks:
+            block.set_compiled_modulation(enabled)
+
+    def enable_forward_chunking(self, chunk_size: Optional[int] = None, dim: int = 1) -> None:
+        r"""
+        Cap the activation peak of every block by running its feed-forward and the output projection of both
+        attentions over slices of `chunk_size` tokens. The result matches the unchunked forward up to floating point
+        accumulation order.
+
+        Parameters:
+            chunk_size (`int`, *optional*):
+                The number of tokens per slice, defaults to 1 (slowest, smallest peak).
+            dim (`int`, *optional*, defaults to 1):
+                The dimension the feed-forward is sliced along, 1 is the token axis.
+        """
+        chunk_size = chunk_size or 1
+        for block in self.transformer_blocks:
+            block.set_chunk_feed_forward(chunk_size, dim)
+            block.attn1.set_chunk_out_projection(chunk_size)
+            if block.attn2 is not None:
+                block.attn2.set_chunk_out_projection(chunk_size)
+
+    def disable_forward_chunking(self) -> None:
+        for block in self.transformer_blocks:
+            block.set_chunk_feed_forward(None)
+            block.attn1.set_chunk_out_projection(None)
+            if block.attn2 is not None:
+                block.attn2.set_chunk_out_projection(None)
+
+    def enable_token_merging(
+        self, ratio: float = 0.3, blocks: Optional[Iterable[int]] = None, window: Tuple[int, int, int] = (1, 2, 2)
+    ) -> TokenMerging:
+        r"""
+        Merge the `ratio` most redundant tokens within local windows before the self-attention and feed-forward of
+        `blocks` (all blocks if omitted) and unmerge them afterwards. See [`TokenMerging`].
+        """
+        token_merging = TokenMerging(ratio=ratio, window=window)
+        blocks = range(len(self.transformer_blocks)) if blocks is None else blocks
+        self.disable_token_merging()
+        for index in blocks:
+            self.transformer_blocks[index].token_merging = token_merging
+        return token_merging
+
+    def disable_token_merging(self) -> None:
+        for block in self.transformer_blocks:
+            block.token_merging = None
+
+    def prepare_encoder_attention_bias(self, encoder_attention_mask: torch.Tensor) -> torch.Tensor:
+        r"""
+        Cross-attention bias `(batch, 1, 1, sequence_length)` from a keep mask `(batch, 1, sequence_length)`, 0 = keep
+        and -10000 = discard. It only depends on the prompt, so pipelines build it once per call and pass it to every
+        step as `encoder_attention_mask`.
+        """
+        bias = (1 - encoder_attention_mask.to(self.dtype)) * -10000.0
+        return rearrange(bias, 'b 1 l -> b 1 1 l')
+
+    def set_attention_mode(self, sa_attention_mode: Optional[str] = None, ca_attention_mode: Optional[str] = None) -> None:
+        r"""
+        Switch the attention kernels of all blocks at runtime, e.g. to `'chunked'` for CPU execution. `None` leaves the
+        self- or cross-attention mode unchanged; `config.sa_attention_mode`/`config.ca_attention_mode` keep the values
+        the model was built with.
+        """
+        for mode in (sa_attention_mode, ca_attention_mode):
+            if mode is not None and mode not in ATTENTION_MODES:
+                raise ValueError(f"Unknown attention mode {mode}, expected one of {ATTENTION_MODES}")
+        for block in self.transformer_blocks:
+            if sa_attention_mode is not None:
+                block.attn1.processor.attention_mode = sa_attention_mode
+            if ca_attention_mode is not None and block.attn2 is not None:
+                block.attn2.processor.attention_mode = ca_attention_mode
+
+    def enable_sequence_parallel(self, group=None, query_chunk_size: int = 1024) -> SequenceParallel:
+        r"""
+        Shard the token sequence across the ranks of `group` (the default process group if omitted). Every rank must
+        call the forward with the same inputs; each runs the blocks on its slice and returns the full prediction. See
+        [`SequenceParallel`].
+        """
+        self.sequence_parallel = SequenceParallel(group, query_chunk_size=query_chunk_size)
+        for block in self.transformer_blocks:
+            block.attn1.processor.sequence_parallel = self.sequence_parallel
+        return self.sequence_parallel
+
+    def disable_sequence_parallel(self) -> None:
+        self.sequence_parallel = None
+        for block in self.transformer_blocks:
+            block.attn1.processor.sequence_parallel = None
+
 
     def forward(
         self,
@@ -243,6 +362,9 @@ class AllegroTransformerTI2V3DModel(ModelMixin, ConfigMixin):
         encoder_attention_mask: Optional[torch.Tensor] = None,
         return_dict: bool = True,
         device: Optional[torch.device]=None,
+        step_cache_key: Optional[Hashable]=None,
+        micro_batch_size: Optional[int]=None,
+        conditioning: Optional[torch.Tensor]=None,
     ):
         """
         The [`Transformer2DModel`] forward method.
@@ -267,16 +389,30 @@ class AllegroTransformerTI2V3DModel(ModelMixin, ConfigMixin):
                 is kept, otherwise if `0` it is discarded. Mask will be converted into a bias, which adds large
                 negative values to the attention scores corresponding to "discard" tokens.
             encoder_attention_mask ( `torch.Tensor`, *optional*):
-                Cross-attention mask applied to `encoder_hidden_states`. Two formats supported:
+                Cross-attention mask applied to `encoder_hidden_states`. Three formats supported:
 
                     * Mask `(batch, sequence_length)` True = keep, False = discard.
-                    * Bias `(batch, 1, sequence_length)` 0 = keep, -10000 = discard.
+                    * Mask `(batch, 1, sequence_length)` True = keep, False = discard.
+                    * Bias `(batch, 1, 1, sequence_length)` 0 = keep, -10000 = discard.
 
-                If `ndim == 2`: will be interpreted as a mask, then converted into a bias consistent with the format
-                above. This bias will be added to the cross-attention scores.
+                If `ndim` is 2 or 3 it is interpreted as a mask and converted into a bias of the last format with
+                [`prepare_encoder_attention_bias`]. A 4-D bias, e.g. built once per call by that method, is passed
+                through unchanged. The bias is added to the cross-attention scores.
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~models.unet_2d_condition.UNet2DConditionOutput`] instead of a plain
                 tuple.
+            device (`torch.device`, *optional*):
+                Device to run on. Parts of the model that sit elsewhere are moved there one at a time and back.
+            step_cache_key (`Hashable`, *optional*):
+                Keeps the [`StepCache`] state of independent streams apart, e.g. of different windows of one video.
+            micro_batch_size (`int`, *optional*):
+                Run every block on slices of this many samples one after another, e.g. the unconditional and the
+                conditional half of a guidance batch. Halves the peak activation memory for guidance, and a block
+                streamed in by `device` serves all slices before it is moved back.
+            conditioning (`torch.Tensor`, *optional*):
+                The masked video and mask embeddings from [`embed_conditioning`]. When given, `hidden_states` holds
+                only the noisy latents instead of the concatenation with the masked video and mask, and a batch of
+                conditioning is shared by every copy of it in `hidden_states`, e.g. both guidance halves.
 
         Returns:
             If `return_dict` is True, an [`~models.transformer_2d.Transformer2DModelOutput`] is returned, otherwise a
@@ -308,16 +444,19 @@ class AllegroTransformerTI2V3DModel(ModelMixin, ConfigMixin):
                 attention_mask_vid = attention_mask_vid.unsqueeze(1)  # b 1 t h w
                 attention_mask_vid = F.max_pool3d(attention_mask_vid, kernel_size=(self.patch_size_t, self.patch_size, self.patch_size), 
                                                   stride=(self.patch_size_t, self.patch_size, self.patch_size))
-                attention_mask_vid = rearrange(attention_mask_vid, 'b 1 t h w -> (b 1) 1 (t h w)') 
+                attention_mask_vid = rearrange(attention_mask_vid, 'b 1 t h w -> b 1 1 (t h w)')
 
             attention_mask_vid = (1 - attention_mask_vid.bool().to(self.dtype)) * -10000.0 if attention_mask_vid.numel() > 0 else None
 
         # convert encoder_attention_mask to a bias the same way we do for attention_mask
+        if encoder_attention_mask is not None and encoder_attention_mask.ndim == 2:
+            encoder_attention_mask = encoder_attention_mask.unsqueeze(1)  # b l -> b 1 l
         if encoder_attention_mask is not None and encoder_attention_mask.ndim == 3:  
             # b, 1+use_image_num, l -> a video with images
             # b, 1, l -> only images
-            encoder_attention_mask = (1 - encoder_attention_mask.to(self.dtype)) * -10000.0
-            encoder_attention_mask_vid = rearrange(encoder_attention_mask, 'b 1 l -> (b 1) 1 l') if encoder_attention_mask.numel() > 0 else None
+            encoder_attention_mask = self.prepare_encoder_attention_bias(encoder_attention_mask)
+        # b 1 1 l, broadcast over the heads and query tokens of every attn2 instead of expanded per head
+        encoder_attention_mask_vid = encoder_attention_mask if encoder_attention_mask is not None and encoder_attention_mask.numel() > 0 else None
 
         # 1. Input
         frame = frame // self.patch_size_t  # patchfy
@@ -326,14 +465,29 @@ class AllegroTransformerTI2V3DModel(ModelMixin, ConfigMixin):
         added_cond_kwargs = {"resolution": None, "aspect_ratio": None}
         hidden_states, encoder_hidden_states_vid, \
         timestep_vid, embedded_timestep_vid = self._operate_on_patched_inputs(
-            hidden_states, encoder_hidden_states, timestep, added_cond_kwargs, batch_size, device=device
+            hidden_states, encoder_hidden_states, timestep, added_cond_kwargs, batch_size, device=device, conditioning=conditioning
         )
 
-        #for _, block in enumerate(self.transformer_blocks):                
-        for _, block in tqdm(enumerate(self.transformer_blocks)):
-            if device != None and device != self.device:
-                block = block.to(device = device)
-            hidden_states = block(
+        if self.sequence_parallel is not None:
+            if self.step_cache is not None:
+                # ranks would decide on reuse from different token slices and stop passing keys in step
+                raise ValueError("Step cache and sequence parallelism cannot be combined")
+            if any(block.token_merging is not None for block in self.transformer_blocks):
+                # merging picks tokens and positions across the whole sequence
+                raise ValueError("Token merging and sequence parallelism cannot be combined")
+            hidden_states = self.sequence_parallel.shard(hidden_states)
+
+        # 2. Blocks
+        cached_residual = None
+        if self.step_cache is not None:
+            step_cache_key = (step_cache_key, tuple(hidden_states.shape))
+            probe = self.transformer_blocks[0].modulated_input(hidden_states[:, ::self.step_cache.token_stride], timestep_vid)
+            cached_residual = self.step_cache.lookup(step_cache_key, probe)
+        if cached_residual is not None:
+            hidden_states = hidden_states + cached_residual
+        else:
+            blocks_input = hidden_states
+            hidden_states = self._forward_blocks(
                 hidden_states,
                 attention_mask_vid,
                 encoder_hidden_states_vid,
@@ -344,9 +498,14 @@ class AllegroTransformerTI2V3DModel(ModelMixin, ConfigMixin):
                 frame=frame, 
                 height=height, 
                 width=width, 
+                device=device,
+                micro_batch_size=micro_batch_size,
             )
-            if device != None and self.device != device:
-                block = block.to(device = self.device)
+            if self.step_cache is not None:
+                self.step_cache.store(step_cache_key, probe, hidden_states - blocks_input)
+
+        if self.sequence_parallel is not None:
+            hidden_states = self.sequence_parallel.gather(hidden_states, frame * height * width)
 
          # 3. Output
         output = None 
@@ -367,6 +526,52 @@ class AllegroTransformerTI2V3DModel(ModelMixin, ConfigMixin):
 
         return Transformer3DModelOutput(sample=output)
 
+    def _forward_blocks(
+        self,
+        hidden_states,
+        attention_mask_vid,
+        encoder_hidden_states_vid,
+        encoder_attention_mask_vid,
+        timestep_vid,
+        cross_attention_kwargs,
+        class_labels,
+        frame=None,
+        height=None,
+        width=None,
+        device=None,
+        micro_batch_size=None,
+    ):
+        if micro_batch_size is not None and micro_batch_size < hidden_states.shape[0]:
+            # slices are written back in place, keep the caller's tensor intact
+            hidden_states = hidden_states.clone()
+            slices = [slice(start, start + micro_batch_size) for start in range(0, hidden_states.shape[0], micro_batch_size)]
+        else:
+            slices = [slice(None)]
+        #for _, block in enumerate(self.transformer_blocks):
+        for _, block in tqdm(enumerate(self.transformer_blocks)):
+            if device != None and device != self.device:
+                block = block.to(device = device)
+            for batch in slices:
+                output = block(
+                    hidden_states[batch],
+                    attention_mask_vid[batch] if attention_mask_vid is not None else None,
+                    encoder_hidden_states_vid[batch],
+                    encoder_attention_mask_vid[batch] if encoder_attention_mask_vid is not None else None,
+                    timestep_vid[batch],
+                    cross_attention_kwargs,
+                    class_labels,
+                    frame=frame, 
+                    height=height, 
+                    width=width, 
+                )
+                if batch == slice(None):
+                    hidden_states = output
+                else:
+                    hidden_states[batch] = output
+            if device != None and self.device != device:
+                block = block.to(device = self.device)
+        return hidden_states
+
     def _init_patched_inputs_for_ti2v(self):
         assert self.config.sample_size_t is not None, "AllegroTransformerTI2V3DModel over patched input must provide sample_size_t"
         assert self.config.sample_size is not None, "AllegroTransformerTI2V3DModel over patched input must provide sample_size"
@@ -439,28 +644,40 @@ class AllegroTransformerTI2V3DModel(ModelMixin, ConfigMixin):
             ]
         )
 
-    def _operate_on_patched_inputs(self, hidden_states, encoder_hidden_states, timestep, added_cond_kwargs, batch_size, frame=88, device=None):
-        assert hidden_states.shape[2] > 1, "AllegroTransformerTI2V3DModel only supports video input"
-        in_channels = self.config.in_channels
-        hidden_states, hidden_states_masked_vid, hidden_states_mask = hidden_states[:, :in_channels], hidden_states[:, in_channels: 2 * in_channels], hidden_states[:, 2 * in_channels:]
-        if device != None and device != self.device:
-            self.pos_embed = self.pos_embed.to(device)
-        hidden_states_vid = self.pos_embed(hidden_states.to(self.dtype))
-        if device != None and device != self.device:
-            self.pos_embed = self.pos_embed.to(self.device)
+    def embed_conditioning(self, masked_video, mask, device=None):
+        r"""
+        Sum of the patch embeddings of the masked video and the mask latents, `(batch, tokens, inner_dim)`. Both are
+        the same for every denoising step, so the result can be computed once and passed to `forward` as
+        `conditioning`.
+        """
+        frame = masked_video.shape[2]
         if device != None and device != self.device:
             self.pos_embed_masked_video = self.pos_embed_masked_video.to(device)
-        hidden_states_masked_vid, _ = self.pos_embed_masked_video[0](hidden_states_masked_vid.to(self.dtype), frame)
+        hidden_states_masked_vid, _ = self.pos_embed_masked_video[0](masked_video.to(self.dtype), frame)
         hidden_states_masked_vid = self.pos_embed_masked_video[1](hidden_states_masked_vid)
         if device != None and device != self.device:
             self.pos_embed_masked_video = self.pos_embed_masked_video.to(self.device)
         if device != None and device != self.device:
             self.pos_embed_mask = self.pos_embed_mask.to(device)
-        hidden_states_mask, _ = self.pos_embed_mask[0](hidden_states_mask.to(self.dtype), frame)
+        hidden_states_mask, _ = self.pos_embed_mask[0](mask.to(self.dtype), frame)
         hidden_states_mask = self.pos_embed_mask[1](hidden_states_mask)
         if device != None and device != self.device:
             self.pos_embed_mask = self.pos_embed_mask.to(self.device)
-        hidden_states_vid = hidden_states_vid + hidden_states_masked_vid + hidden_states_mask
+        return hidden_states_masked_vid + hidden_states_mask
+
+    def _operate_on_patched_inputs(self, hidden_states, encoder_hidden_states, timestep, added_cond_kwargs, batch_size, frame=88, device=None, conditioning=None):
+        assert hidden_states.shape[2] > 1, "AllegroTransformerTI2V3DModel only supports video input"
+        in_channels = self.config.in_channels
+        if conditioning is None:
+            hidden_states, hidden_states_masked_vid, hidden_states_mask = hidden_states[:, :in_channels], hidden_states[:, in_channels: 2 * in_channels], hidden_states[:, 2 * in_channels:]
+            conditioning = self.embed_conditioning(hidden_states_masked_vid, hidden_states_mask, device=device)
+        if device != None and device != self.device:
+            self.pos_embed = self.pos_embed.to(device)
+        hidden_states_vid = self.pos_embed(hidden_states.to(self.dtype))
+        if device != None and device != self.device:
+            self.pos_embed = self.pos_embed.to(self.device)
+        # (copies * b) n d + b n d, without repeating the conditioning for every guidance copy
+        hidden_states_vid = (hidden_states_vid.unflatten(0, (-1, conditioning.shape[0])) + conditioning).flatten(0, 1)
         if device != None and device != self.device:
             self.pos_embed_first_frame = self.pos_embed_first_frame.to(device)
         hidden_states_first_frame, _ = self.pos_embed_first_frame[0](hidden_states.to(self.dtype), 1)
@@ -1,3 +1,4 @@
+import itertools
 import math
 import os
 from typing import Optional, Tuple, Union, Callable
@@ -372,63 +373,92 @@ class AllegroAutoencoderKL3D(ModelMixin, ConfigMixin):
         self.latent_t_over = self.t_over//4 
         self.kernel = (self.chunk_len, self.sample_size, self.sample_size) #(24, 256, 256)
         self.stride = (self.chunk_len - self.t_over, self.sample_size-self.tile_overlap[0], self.sample_size-self.tile_overlap[1])  # (16, 112, 192)
+        self._zero_tile_latents = {}
 
 
-    def encode(self, input_imgs: torch.Tensor, return_dict: bool = True, local_batch_size=1, callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None) -> Union[AutoencoderKLOutput, Tuple[DiagonalGaussianDistribution]]:
+    def tile_starts(self, latent_size: Tuple[int, int, int]):
+        r"""
+        Start of every tile along the (frames, height, width) axes of a latent of `latent_size`, in latent units.
+        Tiles advance by the stride, and an axis whose size does not fit the stride ends with a tile aligned to its far
+        edge; an axis shorter than a tile is padded to one.
+        """
+        latent_kernel = self.kernel[0]//4, self.kernel[1]//8, self.kernel[2]//8
+        latent_stride = self.stride[0]//4, self.stride[1]//8, self.stride[2]//8
+        starts = []
+        for size, kernel, stride in zip(latent_size, latent_kernel, latent_stride):
+            axis = list(range(0, max(size - kernel, 0) + 1, stride))
+            if axis[-1] + kernel < size:
+                axis.append(size - kernel)
+            starts.append(axis)
+        return starts
+
+    def tile_count(self, latent_size: Tuple[int, int, int]) -> int:
+        return math.prod(len(axis) for axis in self.tile_starts(latent_size))
+
+    def zero_tile_latent(self, channels: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+        r"""
+        Encoder output of an all-zero video tile. The encoder sees every tile on its own, so this is what any zero
+        tile encodes to; it is computed once per tile shape, placement and encoder weights.
+        """
+        weight = self.encoder.conv_in.weight
+        key = (channels, self.kernel, torch.device(device), dtype, weight.data_ptr(), weight._version)
+        if key not in self._zero_tile_latents:
+            # entries for other weights or placements are stale
+            self._zero_tile_latents.clear()
+            with torch.no_grad():
+                zeros = torch.zeros((1, channels, *self.kernel), device=device, dtype=dtype)
+                self._zero_tile_latents[key] = self.encoder(zeros)[0]
+        return self._zero_tile_latents[key]
+
+    def encode(self, input_imgs: torch.Tensor, return_dict: bool = True, local_batch_size=1, callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None, skip_zero_tiles: bool = False) -> Union[AutoencoderKLOutput, Tuple[DiagonalGaussianDistribution]]:
+        r"""
+        Encodes `input_imgs` of shape `(batch, channels, frames, height, width)` tile by tile.
+
+        Args:
+            skip_zero_tiles (`bool`, *optional*, defaults to `False`):
+                Fill tiles that are zero throughout from [`zero_tile_latent`] instead of encoding them, e.g. for the
+                TI2V masked video, which is zero except for its reference frames.
+        """
         KERNEL = self.kernel
-        STRIDE = self.stride
         LOCAL_BS = local_batch_size
         OUT_C = 8
 
         B, C, N, H, W = input_imgs.shape
-        
+        OUT_KERNEL = KERNEL[0]//4, KERNEL[1]//8, KERNEL[2]//8
+        starts = self.tile_starts((N//4, H//8, W//8))
+        tiles = list(itertools.product(*starts))
+        ## videos smaller than a tile are padded to it, the padding is cropped from the latent again
+        input_imgs = pad_to_kernel(input_imgs, KERNEL)
        
-        out_n = math.floor((N - KERNEL[0]) / STRIDE[0]) + 1
-        out_h = math.floor((H - KERNEL[1]) / STRIDE[1]) + 1
-        out_w = math.floor((W - KERNEL[2]) / STRIDE[2]) + 1
-        
         ## cut video into overlapped small cubes and batch forward
-        num = 0
-
-        out_latent = torch.zeros((out_n*out_h*out_w, OUT_C, KERNEL[0]//4, KERNEL[1]//8, KERNEL[2]//8), device=input_imgs.device, dtype=input_imgs.dtype) 
+        out_latent = torch.zeros((len(tiles), OUT_C, OUT_KERNEL[0], OUT_KERNEL[1], OUT_KERNEL[2]), device=input_imgs.device, dtype=input_imgs.dtype) 
         vae_batch_input = torch.zeros((LOCAL_BS, C, KERNEL[0], KERNEL[1], KERNEL[2]), device=input_imgs.device, dtype=input_imgs.dtype)
 
-        for i in range(out_n):
-            for j in range(out_h):
-                for k in range(out_w):
-                    n_start, n_end = i * STRIDE[0], i * STRIDE[0] + KERNEL[0]
-                    h_start, h_end = j * STRIDE[1], j * STRIDE[1] + KERNEL[1]
-                    w_start, w_end = k * STRIDE[2], k * STRIDE[2] + KERNEL[2]
-                    video_cube = input_imgs[:, :, n_start:n_end, h_start:h_end, w_start:w_end]
-                    vae_batch_input[num%LOCAL_BS] = video_cube
-                    
-                    if num%LOCAL_BS == LOCAL_BS-1 or num == out_n*out_h*out_w-1:                        
-                        latent = self.encoder(vae_batch_input)
-                        if callback != None:
-                            callback(num, out_n*out_h*out_w, latent)
-                        if num == out_n*out_h*out_w-1 and num%LOCAL_BS != LOCAL_BS-1:
-                            out_latent[num-num%LOCAL_BS:] = latent[:num%LOCAL_BS+1]
-                        else:
-                            out_latent[num-LOCAL_BS+1:num+1] = latent
-                        vae_batch_input = torch.zeros((LOCAL_BS, C, KERNEL[0], KERNEL[1], KERNEL[2]), device=input_imgs.device, dtype=input_imgs.dtype)
-                    num+=1
+        zero_latent = self.zero_tile_latent(C, input_imgs.device, input_imgs.dtype) if skip_zero_tiles else None
+        batch_tiles = []
+        for num, (n, h, w) in enumerate(tiles):
+            n_start, h_start, w_start = n * 4, h * 8, w * 8
+            video_cube = input_imgs[:, :, n_start:n_start+KERNEL[0], h_start:h_start+KERNEL[1], w_start:w_start+KERNEL[2]]
+            if zero_latent is not None and not video_cube.any():
+                out_latent[num] = zero_latent
+                if callback != None:
+                    callback(num, len(tiles), zero_latent[None])
+            else:
+                vae_batch_input[len(batch_tiles)] = video_cube
+                batch_tiles.append(num)
+
+            if batch_tiles and (len(batch_tiles) == LOCAL_BS or num == len(tiles)-1):
+                latent = self.encoder(vae_batch_input)
+                if callback != None:
+                    callback(num, len(tiles), latent)
+                out_latent[batch_tiles] = latent[:len(batch_tiles)]
+                batch_tiles = []
+                vae_batch_input = torch.zeros((LOCAL_BS, C, KERNEL[0], KERNEL[1], KERNEL[2]), device=input_imgs.device, dtype=input_imgs.dtype)
         
         ## flatten the batched out latent to videos and supress the overlapped parts
-        B, C, N, H, W = input_imgs.shape
-
-        out_video_cube = torch.zeros((B, OUT_C, N//4, H//8, W//8), device=input_imgs.device, dtype=input_imgs.dtype)
-        OUT_KERNEL = KERNEL[0]//4, KERNEL[1]//8, KERNEL[2]//8
-        OUT_STRIDE = STRIDE[0]//4, STRIDE[1]//8, STRIDE[2]//8
+        OUT_STRIDE = self.stride[0]//4, self.stride[1]//8, self.stride[2]//8
         OVERLAP = OUT_KERNEL[0]-OUT_STRIDE[0], OUT_KERNEL[1]-OUT_STRIDE[1], OUT_KERNEL[2]-OUT_STRIDE[2]
-        
-        for i in range(out_n):
-            n_start, n_end = i * OUT_STRIDE[0], i * OUT_STRIDE[0] + OUT_KERNEL[0]
-            for j in range(out_h):
-                h_start, h_end = j * OUT_STRIDE[1], j * OUT_STRIDE[1] + OUT_KERNEL[1]
-                for k in range(out_w):
-                    w_start, w_end = k * OUT_STRIDE[2], k * OUT_STRIDE[2] + OUT_KERNEL[2]
-                    latent_mean_blend = prepare_for_blend((i, out_n, OVERLAP[0]), (j, out_h, OVERLAP[1]), (k, out_w, OVERLAP[2]), out_latent[i*out_h*out_w+j*out_w+k].unsqueeze(0))
-                    out_video_cube[:, :, n_start:n_end, h_start:h_end, w_start:w_end] += latent_mean_blend
+        out_video_cube = blend_tiles(out_latent, starts, (1, 1, 1), OVERLAP, (B, OUT_C, N//4, H//8, W//8))
         
         ## final conv
         out_video_cube = rearrange(out_video_cube, 'b c n h w -> (b n) c h w')
@@ -443,6 +473,7 @@ class AllegroAutoencoderKL3D(ModelMixin, ConfigMixin):
         return AutoencoderKLOutput(latent_dist=posterior)
     
 
+
     def decode(self, input_latents: torch.Tensor, return_dict: bool = True, local_batch_size=1, callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None) -> Union[DecoderOutput, torch.Tensor]:
         KERNEL = self.kernel
         STRIDE = self.stride
@@ -450,7 +481,6 @@ class AllegroAutoencoderKL3D(ModelMixin, ConfigMixin):
         LOCAL_BS = local_batch_size
         OUT_C = 3
         IN_KERNEL = KERNEL[0]//4, KERNEL[1]//8, KERNEL[2]//8
-        IN_STRIDE = STRIDE[0]//4, STRIDE[1]//8, STRIDE[2]//8
 
         B, C, N, H, W = input_latents.shape
 
@@ -459,45 +489,30 @@ class AllegroAutoencoderKL3D(ModelMixin, ConfigMixin):
         input_latents = self.post_quant_conv(input_latents)
         input_latents = rearrange(input_latents, '(b n) c h w -> b c n h w', b=B)
         
-        ## out tensor shape
-        out_n = math.floor((N - IN_KERNEL[0]) / IN_STRIDE[0]) + 1
-        out_h = math.floor((H - IN_KERNEL[1]) / IN_STRIDE[1]) + 1
-        out_w = math.floor((W - IN_KERNEL[2]) / IN_STRIDE[2]) + 1
+        ## tile starts, the last tile of an axis is aligned to its edge so sizes need not fit the stride
+        starts = self.tile_starts((N, H, W))
+        tiles = list(itertools.product(*starts))
+        ## latents smaller than a tile are padded to it, the padding is cropped from the video again
+        input_latents = pad_to_kernel(input_latents, IN_KERNEL)
 
         ## cut latent into overlapped small cubes and batch forward
-        num = 0
-        decoded_cube = torch.zeros((out_n*out_h*out_w, OUT_C, KERNEL[0], KERNEL[1], KERNEL[2]), device=input_latents.device, dtype=input_latents.dtype) 
+        decoded_cube = torch.zeros((len(tiles), OUT_C, KERNEL[0], KERNEL[1], KERNEL[2]), device=input_latents.device, dtype=input_latents.dtype) 
         vae_batch_input = torch.zeros((LOCAL_BS, C, IN_KERNEL[0], IN_KERNEL[1], IN_KERNEL[2]), device=input_latents.device, dtype=input_latents.dtype)
-        for i in range(out_n):
-            for j in range(out_h):
-                for k in range(out_w):
-                    n_start, n_end = i * IN_STRIDE[0], i * IN_STRIDE[0] + IN_KERNEL[0]
-                    h_start, h_end = j * IN_STRIDE[1], j * IN_STRIDE[1] + IN_KERNEL[1]
-                    w_start, w_end = k * IN_STRIDE[2], k * IN_STRIDE[2] + IN_KERNEL[2]
-                    latent_cube = input_latents[:, :, n_start:n_end, h_start:h_end, w_start:w_end]
-                    vae_batch_input[num%LOCAL_BS] = latent_cube
-                    if num%LOCAL_BS == LOCAL_BS-1 or num == out_n*out_h*out_w-1:
-                        latent = self.decoder(vae_batch_input)
-                        if callback != None:
-                            callback(num, out_n*out_h*out_w, latent)
-                        if num == out_n*out_h*out_w-1 and num%LOCAL_BS != LOCAL_BS-1:
-                            decoded_cube[num-num%LOCAL_BS:] = latent[:num%LOCAL_BS+1]
-                        else:
-                            decoded_cube[num-LOCAL_BS+1:num+1] = latent
-                        vae_batch_input = torch.zeros((LOCAL_BS, C, IN_KERNEL[0], IN_KERNEL[1], IN_KERNEL[2]), device=input_latents.device, dtype=input_latents.dtype)
-                    num+=1
-        B, C, N, H, W = input_latents.shape
+        for num, (n_start, h_start, w_start) in enumerate(tiles):
+            latent_cube = input_latents[:, :, n_start:n_start+IN_KERNEL[0], h_start:h_start+IN_KERNEL[1], w_start:w_start+IN_KERNEL[2]]
+            vae_batch_input[num%LOCAL_BS] = latent_cube
+            if num%LOCAL_BS == LOCAL_BS-1 or num == len(tiles)-1:
+                latent = self.decoder(vae_batch_input)
+                if callback != None:
+                    callback(num, len(tiles), latent)
+                if num == len(tiles)-1 and num%LOCAL_BS != LOCAL_BS-1:
+                    decoded_cube[num-num%LOCAL_BS:] = latent[:num%LOCAL_BS+1]
+                else:
+                    decoded_cube[num-LOCAL_BS+1:num+1] = latent
+                vae_batch_input = torch.zeros((LOCAL_BS, C, IN_KERNEL[0], IN_KERNEL[1], IN_KERNEL[2]), device=input_latents.device, dtype=input_latents.dtype)
         
-        out_video = torch.zeros((B, OUT_C, N*4, H*8, W*8), device=input_latents.device, dtype=input_latents.dtype)
         OVERLAP = KERNEL[0]-STRIDE[0], KERNEL[1]-STRIDE[1], KERNEL[2]-STRIDE[2]
-        for i in range(out_n):
-            n_start, n_end = i * STRIDE[0], i * STRIDE[0] + KERNEL[0]
-            for j in range(out_h):
-                h_start, h_end = j * STRIDE[1], j * STRIDE[1] + KERNEL[1]
-                for k in range(out_w):
-                    w_start, w_end = k * STRIDE[2], k * STRIDE[2] + KERNEL[2]
-                    out_video_blend = prepare_for_blend((i, out_n, OVERLAP[0]), (j, out_h, OVERLAP[1]), (k, out_w, OVERLAP[2]), decoded_cube[i*out_h*out_w+j*out_w+k].unsqueeze(0))
-                    out_video[:, :, n_start:n_end, h_start:h_end, w_start:w_end] += out_video_blend
+        out_video = blend_tiles(decoded_cube, starts, (4, 8, 8), OVERLAP, (B, OUT_C, N*4, H*8, W*8))
        
         out_video = rearrange(out_video, 'b c t h w -> b t c h w').contiguous()
 
@@ -549,21 +564,53 @@ class AllegroAutoencoderKL3D(ModelMixin, ConfigMixin):
         return super().from_pretrained(pretrained_model_name_or_path, **kwargs)
 
 
-def prepare_for_blend(n_param, h_param, w_param, x):
-    n, n_max, overlap_n = n_param
-    h, h_max, overlap_h = h_param
-    w, w_max, overlap_w = w_param
-    if overlap_n > 0:
-        if n > 0: # the head overlap part decays from 0 to 1
-            x[:,:,0:overlap_n,:,:] = x[:,:,0:overlap_n,:,:] * (torch.arange(0, overlap_n).float().to(x.device) / overlap_n).reshape(overlap_n,1,1)
-        if n < n_max-1:  # the tail overlap part decays from 1 to 0
-            x[:,:,-overlap_n:,:,:] = x[:,:,-overlap_n:,:,:] * (1 - torch.arange(0, overlap_n).float().to(x.device) / overlap_n).reshape(overlap_n,1,1)
-    if h > 0:
-        x[:,:,:,0:overlap_h,:] = x[:,:,:,0:overlap_h,:] * (torch.arange(0, overlap_h).float().to(x.device) / overlap_h).reshape(overlap_h,1)
-    if h < h_max-1:
-        x[:,:,:,-overlap_h:,:] = x[:,:,:,-overlap_h:,:] * (1 - torch.arange(0, overlap_h).float().to(x.device) / overlap_h).reshape(overlap_h,1)
-    if w > 0:
-        x[:,:,:,:,0:overlap_w] = x[:,:,:,:,0:overlap_w] * (torch.arange(0, overlap_w).float().to(x.device) / overlap_w)
-    if w < w_max-1:
-        x[:,:,:,:,-overlap_w:] = x[:,:,:,:,-overlap_w:] * (1 - torch.arange(0, overlap_w).float().to(x.device) / overlap_w)
-    return x
+def pad_to_kernel(x, kernel):
+    # replicate the last frame, row and column of inputs shorter than a tile along some axis
+    padding = [max(k - size, 0) for size, k in zip(x.shape[-3:], kernel)]
+    if not any(padding):
+        return x
+    return nn.functional.pad(x, (0, padding[2], 0, padding[1], 0, padding[0]), mode="replicate")
+
+
+def blend_weight(index, count, overlap, length, device):
+    # ramps from 0 to 1 over the overlap with the previous tile and from 1 to 0 over the one with the next tile
+    weight = torch.ones(length, device=device)
+    if overlap > 0:
+        ramp = torch.arange(0, overlap, device=device).float() / overlap
+        if index > 0:
+            weight[:overlap] *= ramp
+        if index < count - 1:
+            weight[-overlap:] *= 1 - ramp
+    return weight
+
+
+def blend_tiles(cubes, starts, scale, overlap, shape):
+    r"""
+    Accumulates the decoded or encoded `cubes`, one per combination of `starts` (in latent units, scaled by `scale` to
+    the output), into a tensor of `shape` with linear ramps over the overlaps. The sum is normalized by the accumulated
+    weights, so edge-aligned tiles that overlap their neighbour by more than the stride blend correctly, and the
+    padding of inputs shorter than a tile is cropped.
+    """
+    kernel = cubes.shape[-3:]
+    padded = [max(size, k) for size, k in zip(shape[-3:], kernel)]
+    out = torch.zeros((*shape[:2], *padded), device=cubes.device, dtype=cubes.dtype)
+    weights = [
+        [blend_weight(i, len(axis), overlap[d], kernel[d], cubes.device) for i in range(len(axis))]
+        for d, axis in enumerate(starts)
+    ]
+    # tiles form a full grid, so the accumulated weight is the product of the per-axis sums and is divided out per axis
+    axis_sums = []
+    for d, axis in enumerate(starts):
+        axis_sum = torch.zeros(padded[d], device=cubes.device)
+        for i, start in enumerate(axis):
+            axis_sum[start * scale[d] : start * scale[d] + kernel[d]] += weights[d][i]
+        axis_sums.append(axis_sum)
+    for num, (i, j, k) in enumerate(itertools.product(*(range(len(axis)) for axis in starts))):
+        n_start, h_start, w_start = starts[0][i] * scale[0], starts[1][j] * scale[1], starts[2][k] * scale[2]
+        weight = weights[0][i][:, None, None] * weights[1][j][None, :, None] * weights[2][k][None, None, :]
+        region = (slice(n_start, n_start + kernel[0]), slice(h_start, h_start + kernel[1]), slice(w_start, w_start + kernel[2]))
+        out[(slice(None), slice(None), *region)] += cubes[num] * weight.to(cubes.dtype)
+    out /= axis_sums[0].clamp(min=1e-6).to(cubes.dtype)[:, None, None]
+    out /= axis_sums[1].clamp(min=1e-6).to(cubes.dtype)[:, None]
+    out /= axis_sums[2].clamp(min=1e-6).to(cubes.dtype)
+    return out[:, :, :shape[2], :shape[3], :shape[4]]
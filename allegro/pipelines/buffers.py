@@ -0,0 +1,52 @@
+import torch
+
+
+class DenoisingBuffers:
+    r"""
+    Transformer inputs that a denoising loop refills in place every step instead of allocating them. They are the latent
+    batch of both guidance branches, the constant all-ones attention mask and the per-sample timesteps, plus two
+    alternating outputs for the guided prediction. All are sized once per pipeline call from the initial `latents`, so
+    the allocator sees no per-step churn and the step reads and writes fixed addresses.
+
+    Steps without the unconditional branch use the first half of every buffer.
+
+    Parameters:
+        latents (`torch.Tensor`):
+            The initial latents `(batch, channels, frames, height, width)`.
+        timestep_dtype (`torch.dtype`):
+            The dtype of the scheduler's timesteps.
+    """
+
+    def __init__(self, latents: torch.Tensor, timestep_dtype: torch.dtype):
+        self.batch_size = latents.shape[0]
+        batch = 2 * self.batch_size
+        self.latent_model_input = latents.new_empty((batch, *latents.shape[1:]))
+        # b c t h w -> b t h w, every token is kept
+        self.attention_mask = latents.new_ones((batch, *latents.shape[2:]))
+        self.timestep = torch.empty(batch, dtype=timestep_dtype, device=latents.device)
+        self._guided = [None, None]
+        self._next = 0
+
+    def inputs(self, latent_model_input: torch.Tensor, t, run_uncond: bool):
+        """
+        Copies the scaled latents of this step into one or, for both guidance branches, two halves and fills in the
+        timestep. Returns views of the latents, attention mask and timesteps of this step's batch.
+        """
+        batch = 2 * self.batch_size if run_uncond else self.batch_size
+        self.latent_model_input[: self.batch_size].copy_(latent_model_input)
+        if run_uncond:
+            self.latent_model_input[self.batch_size :].copy_(latent_model_input)
+        self.timestep.fill_(t)
+        return self.latent_model_input[:batch], self.attention_mask[:batch], self.timestep[:batch]
+
+    def guide(self, noise_pred_uncond: torch.Tensor, noise_pred_text: torch.Tensor, guidance_scale: float) -> torch.Tensor:
+        """
+        `noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)` as a single `lerp`. It is written
+        into the output the previous step did not return, so a scheduler that holds on to the last model output still
+        sees it intact.
+        """
+        out = self._guided[self._next]
+        if out is None or out.shape != noise_pred_text.shape or out.dtype != noise_pred_text.dtype:
+            out = self._guided[self._next] = torch.empty_like(noise_pred_text)
+        self._next ^= 1
+        return torch.lerp(noise_pred_uncond, noise_pred_text, guidance_scale, out=out)
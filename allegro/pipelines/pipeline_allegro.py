@@ -21,7 +21,7 @@ import tqdm
 from bs4 import BeautifulSoup
 
 from diffusers import DiffusionPipeline
-from diffusers.schedulers import EulerAncestralDiscreteScheduler
+from diffusers.schedulers.scheduling_utils import SchedulerMixin
 from diffusers.utils import (
     BACKENDS_MAPPING,
     is_bs4_available,
@@ -37,6 +37,8 @@ logger = logging.get_logger(__name__)
 
 from allegro.models.transformers.transformer_3d_allegro import AllegroTransformer3DModel
 from allegro.models.vae.vae_allegro import AllegroAutoencoderKL3D
+from allegro.pipelines.buffers import DenoisingBuffers
+from allegro.pipelines.temporal_windows import TemporalWindows
 
 @dataclass
 class AllegroPipelineOutput(BaseOutput):
@@ -108,6 +110,30 @@ def retrieve_timesteps(
     return timesteps, num_inference_steps
 
 
+def latent_size(num_frames: int, height: int, width: int, vae_scale_factor=(4, 8, 8)) -> Tuple[int, int, int]:
+    """Latent (frames, height, width) of a video of `num_frames` x `height` x `width` pixels."""
+    return (
+        (math.ceil((int(num_frames) - 1) / vae_scale_factor[0]) + 1)
+        if int(num_frames) % 2 == 1
+        else math.ceil(int(num_frames) / vae_scale_factor[0]),
+        math.ceil(int(height) / vae_scale_factor[1]),
+        math.ceil(int(width) / vae_scale_factor[2]),
+    )
+
+
+def upsample_latents(
+    latents: torch.FloatTensor, num_frames: int, height: int, width: int, vae_scale_factor=(4, 8, 8)
+) -> torch.FloatTensor:
+    r"""
+    Trilinearly resizes `(batch, channels, frames, height, width)` latents, e.g. of a low resolution draft, to the
+    latent size of a `num_frames` x `height` x `width` video, to be refined with `strength` < 1.
+    """
+    size = latent_size(num_frames, height, width, vae_scale_factor)
+    if tuple(latents.shape[-3:]) == size:
+        return latents
+    return torch.nn.functional.interpolate(latents.float(), size=size, mode="trilinear", align_corners=False).to(latents.dtype)
+
+
 class AllegroPipeline(DiffusionPipeline):
     r"""
     Pipeline for text-to-image generation using Allegro.
@@ -143,7 +169,7 @@ class AllegroPipeline(DiffusionPipeline):
         text_encoder: Optional[T5EncoderModel] = None,
         vae: Optional[AllegroAutoencoderKL3D] = None,
         transformer: Optional[AllegroTransformer3DModel] = None,
-        scheduler: Optional[EulerAncestralDiscreteScheduler] = None,
+        scheduler: Optional[SchedulerMixin] = None,
         device: torch.device = torch.device("cuda"),
         dtype: torch.dtype = torch.float16,
     ):
@@ -534,11 +560,7 @@ class AllegroPipeline(DiffusionPipeline):
         shape = (
             batch_size,
             num_channels_latents,
-            (math.ceil((int(num_frames) - 1) / self.vae.vae_scale_factor[0]) + 1)
-            if int(num_frames) % 2 == 1
-            else math.ceil(int(num_frames) / self.vae.vae_scale_factor[0]),
-            math.ceil(int(height) / self.vae.vae_scale_factor[1]),
-            math.ceil(int(width) / self.vae.vae_scale_factor[2]),
+            *latent_size(num_frames, height, width, self.vae.vae_scale_factor),
         )
         if isinstance(generator, list) and len(generator) != batch_size:
             raise ValueError(
@@ -557,6 +579,24 @@ class AllegroPipeline(DiffusionPipeline):
 
         return latents
 
+    # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img.StableDiffusionImg2ImgPipeline.get_timesteps
+    def get_timesteps(self, num_inference_steps, strength):
+        # get the original timestep using init_timestep
+        init_timestep = min(int(num_inference_steps * strength), num_inference_steps)
+
+        t_start = max(num_inference_steps - init_timestep, 0)
+        timesteps = self.scheduler.timesteps[t_start * self.scheduler.order :]
+        if hasattr(self.scheduler, "set_begin_index"):
+            self.scheduler.set_begin_index(t_start * self.scheduler.order)
+
+        return timesteps, num_inference_steps - t_start
+
+    def prepare_refine_latents(self, latents, timestep, dtype, device, generator):
+        # noise clean latents (e.g. an upsampled draft) to the first timestep of the shortened schedule
+        latents = latents.to(device=device, dtype=dtype)
+        noise = randn_tensor(latents.shape, generator=generator, device=device, dtype=dtype)
+        return self.scheduler.add_noise(latents, noise, timestep.repeat(latents.shape[0]))
+
     @torch.no_grad()
     @replace_example_docstring(EXAMPLE_DOC_STRING)
     def __call__(
@@ -584,7 +624,14 @@ class AllegroPipeline(DiffusionPipeline):
         clean_caption: bool = True,
         max_sequence_length: int = 512,
         verbose: bool = True,
-        device: Optional[torch.device] = None
+        device: Optional[torch.device] = None,
+        guidance_start: float = 0.0,
+        guidance_end: float = 1.0,
+        uncond_reuse_steps: int = 0,
+        split_guidance_batch: bool = False,
+        strength: float = 1.0,
+        temporal_window: Optional[int] = None,
+        temporal_overlap: int = 24,
     ) -> Union[AllegroPipelineOutput, Tuple]:
         """
         Function invoked when calling the pipeline for generation.
@@ -652,6 +699,27 @@ class AllegroPipeline(DiffusionPipeline):
                 be installed. If the dependencies are not installed, the embeddings will be created from the raw
                 prompt.
             max_sequence_length (`int` defaults to 512): Maximum sequence length to use with the `prompt`.
+            guidance_start (`float`, *optional*, defaults to 0.0):
+                Fraction of the denoising steps after which classifier-free guidance starts. Outside of
+                `[guidance_start, guidance_end)` only the conditional branch runs, at half the batch size.
+            guidance_end (`float`, *optional*, defaults to 1.0):
+                Fraction of the denoising steps after which classifier-free guidance stops.
+            uncond_reuse_steps (`int`, *optional*, defaults to 0):
+                Within the guidance interval, reuse the last unconditional prediction for this many steps after it was
+                computed, running only the conditional branch on those steps.
+            split_guidance_batch (`bool`, *optional*, defaults to `False`):
+                Run the unconditional and the conditional branch through each transformer block one after another
+                instead of as one batch, which halves the peak activation memory at a small cost in speed.
+            strength (`float`, *optional*, defaults to 1.0):
+                With `strength` < 1, `latents` are taken as a clean result to refine, e.g. a draft resized with
+                [`upsample_latents`] or the scaled VAE encoding of an input video. They are noised to the timestep `strength` of the way into the schedule and only
+                the remaining `strength * num_inference_steps` steps are run.
+            temporal_window (`int`, *optional*):
+                Denoise clips longer than `temporal_window` frames in overlapping windows of that many frames, blended
+                every step (see [`TemporalWindows`]), so that attention cost and memory stay those of one window. 88,
+                the frames the model was trained on, is a good choice. `None` attends over the whole clip at once.
+            temporal_overlap (`int`, *optional*, defaults to 24):
+                Frames shared by neighbouring windows.
 
         Examples:
 
@@ -718,21 +786,32 @@ class AllegroPipeline(DiffusionPipeline):
 
         # 4. Prepare timesteps
         timesteps, num_inference_steps = retrieve_timesteps(self.scheduler, num_inference_steps, device, timesteps)
-        self.scheduler.set_timesteps(num_inference_steps, device=device)
+        if hasattr(self.scheduler, "set_begin_index"):
+            # otherwise the first step looks its timestep up with a `nonzero`, which synchronizes with the device
+            self.scheduler.set_begin_index(0)
+        if strength < 1.0:
+            if latents is None:
+                raise ValueError("`strength` < 1 refines `latents`, which must be given")
+            timesteps, num_inference_steps = self.get_timesteps(num_inference_steps, strength)
+            if num_inference_steps < 1:
+                raise ValueError(f"`strength` {strength} leaves no denoising step, raise it or `num_inference_steps`")
 
         # 5. Prepare latents.
         latent_channels = self.transformer.config.in_channels
-        latents = self.prepare_latents(
-            batch_size * num_images_per_prompt,
-            latent_channels,
-            num_frames, 
-            height,
-            width,
-            prompt_embeds.dtype,
-            device,
-            generator,
-            latents,
-        )
+        if strength < 1.0:
+            latents = self.prepare_refine_latents(latents, timesteps[:1], prompt_embeds.dtype, device, generator)
+        else:
+            latents = self.prepare_latents(
+                batch_size * num_images_per_prompt,
+                latent_channels,
+                num_frames, 
+                height,
+                width,
+                prompt_embeds.dtype,
+                device,
+                generator,
+                latents,
+            )
 
         # 6. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
@@ -741,52 +820,69 @@ class AllegroPipeline(DiffusionPipeline):
         added_cond_kwargs = {"resolution": None, "aspect_ratio": None}
 
         # 7. Denoising loop
+        if getattr(self.transformer, "step_cache", None) is not None:
+            # residuals of a previous call must not leak into this one
+            self.transformer.step_cache.reset()
         num_warmup_steps = max(len(timesteps) - num_inference_steps * self.scheduler.order, 0)
 
+        if prompt_embeds.ndim == 3:
+            prompt_embeds = prompt_embeds.unsqueeze(1)  # b l d -> b 1 l d
+        if prompt_attention_mask.ndim == 2:
+            prompt_attention_mask = prompt_attention_mask.unsqueeze(1)  # b l -> b 1 l
+        # the text bias is the same for every step and broadcasts over the heads of every block, build it once
+        prompt_attention_mask = self.transformer.prepare_encoder_attention_bias(prompt_attention_mask)
+        # long clips are denoised in overlapping windows of latent frames, blended every step
+        windows = None
+        if temporal_window is not None:
+            window = max(temporal_window // self.vae.vae_scale_factor[0], 1)
+            if latents.shape[2] > window:
+                windows = TemporalWindows(latents.shape[2], window, temporal_overlap // self.vae.vae_scale_factor[0])
+        # the last unconditional prediction of every window
+        noise_pred_uncond, uncond_age = {}, 0
+
+        # step inputs and the guided prediction live in buffers allocated once for the whole loop
+        buffers = DenoisingBuffers(latents if windows is None else windows.slice(latents, 0), timesteps.dtype)
+
         progress_wrap = tqdm.tqdm if verbose else (lambda x: x)
         for i, t in progress_wrap(list(enumerate(timesteps))):
-
-            latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
-            latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-            current_timestep = t
-            if not torch.is_tensor(current_timestep):
-                # TODO: this requires sync between CPU and GPU. So try to pass timesteps as tensors if you can
-                # This would be a good case for the `match` statement (Python 3.10+)
-                is_mps = latent_model_input.device.type == "mps"
-                if isinstance(current_timestep, float):
-                    dtype = torch.float32 if is_mps else torch.float64
-                else:
-                    dtype = torch.int32 if is_mps else torch.int64
-                current_timestep = torch.tensor([current_timestep], dtype=dtype, device=latent_model_input.device)
-            elif len(current_timestep.shape) == 0:
-                current_timestep = current_timestep[None].to(latent_model_input.device)
-            # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
-            current_timestep = current_timestep.expand(latent_model_input.shape[0])
-
-            if prompt_embeds.ndim == 3:
-                prompt_embeds = prompt_embeds.unsqueeze(1)  # b l d -> b 1 l d
-            if prompt_attention_mask.ndim == 2:
-                prompt_attention_mask = prompt_attention_mask.unsqueeze(1)  # b l -> b 1 l
-            # prepare attention_mask.
-            # b c t h w -> b t h w
-            attention_mask = torch.ones_like(latent_model_input)[:, 0]
-            # predict noise model_output
-            noise_pred = self.transformer(
-                latent_model_input,
-                attention_mask=attention_mask, 
-                encoder_hidden_states=prompt_embeds,
-                encoder_attention_mask=prompt_attention_mask,
-                timestep=current_timestep,
-                added_cond_kwargs=added_cond_kwargs,
-                return_dict=False,
-                device=device,
-            )[0]
-
-            # perform guidance
-            if do_classifier_free_guidance:
-                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+            use_guidance = do_classifier_free_guidance and guidance_start <= i / len(timesteps) < guidance_end
+            run_uncond = use_guidance and (not noise_pred_uncond or uncond_age >= uncond_reuse_steps)
+            # the conditional branch alone is the second half of the [negative, positive] batch
+            encoder_hidden_states = prompt_embeds if run_uncond or not do_classifier_free_guidance else prompt_embeds.chunk(2)[1]
+            encoder_attention_mask = prompt_attention_mask if run_uncond or not do_classifier_free_guidance else prompt_attention_mask.chunk(2)[1]
+            # scaled once for both branches and all windows
+            scaled_latents = self.scheduler.scale_model_input(latents, t)
+
+            for index in range(1 if windows is None else len(windows)):
+                # copied into the persistent batch
+                latent_model_input, attention_mask, current_timestep = buffers.inputs(
+                    scaled_latents if windows is None else windows.slice(scaled_latents, index), t, run_uncond
+                )
+                # predict noise model_output
+                noise_pred = self.transformer(
+                    latent_model_input,
+                    attention_mask=attention_mask, 
+                    encoder_hidden_states=encoder_hidden_states,
+                    encoder_attention_mask=encoder_attention_mask,
+                    timestep=current_timestep,
+                    added_cond_kwargs=added_cond_kwargs,
+                    return_dict=False,
+                    device=device,
+                    micro_batch_size=latents.shape[0] if split_guidance_batch and run_uncond else None,
+                    step_cache_key=index,
+                )[0]
+
+                # perform guidance, with the unconditional prediction of this step or the last one that was computed
+                if run_uncond:
+                    noise_pred_uncond[index], noise_pred = noise_pred.chunk(2)
+                if use_guidance:
+                    noise_pred = buffers.guide(noise_pred_uncond[index], noise_pred, guidance_scale)
+                if windows is not None:
+                    windows.add(index, noise_pred)
+
+            if windows is not None:
+                noise_pred = windows.blended()
+            uncond_age = 0 if run_uncond else uncond_age + 1
 
             # learned sigma
             if self.transformer.config.out_channels // 2 == latent_channels:
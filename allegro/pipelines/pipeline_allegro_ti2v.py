@@ -25,7 +25,7 @@ import numpy as np
 import torch.nn.functional as F
 
 from diffusers import DiffusionPipeline
-from diffusers.schedulers import EulerAncestralDiscreteScheduler
+from diffusers.schedulers.scheduling_utils import SchedulerMixin
 from diffusers.utils import (
     BACKENDS_MAPPING,
     is_bs4_available,
@@ -41,6 +41,7 @@ logger = logging.get_logger(__name__)
 
 from allegro.models.transformers.transformer_3d_allegro_ti2v import AllegroTransformerTI2V3DModel
 from allegro.models.vae.vae_allegro import AllegroAutoencoderKL3D
+from allegro.pipelines.buffers import DenoisingBuffers
 
 @dataclass
 class AllegroTI2VPipelineOutput(BaseOutput):
@@ -148,7 +149,7 @@ class AllegroTI2VPipeline(DiffusionPipeline):
         text_encoder: Optional[T5EncoderModel] = None,
         vae: Optional[AllegroAutoencoderKL3D] = None,
         transformer: Optional[AllegroTransformerTI2V3DModel] = None,
-        scheduler: Optional[EulerAncestralDiscreteScheduler] = None,
+        scheduler: Optional[SchedulerMixin] = None,
         device: torch.device = torch.device("cuda"),
         dtype: torch.dtype = torch.float16,
     ):
@@ -612,6 +613,10 @@ class AllegroTI2VPipeline(DiffusionPipeline):
         mask: Optional[torch.FloatTensor] = None,
         masked_video: Optional[torch.FloatTensor] = None,
         device: Optional[torch.device] = None,
+        guidance_start: float = 0.0,
+        guidance_end: float = 1.0,
+        uncond_reuse_steps: int = 0,
+        split_guidance_batch: bool = False,
     ) -> Union[AllegroTI2VPipelineOutput, Tuple]:
         """
         Function invoked when calling the pipeline for generation.
@@ -679,6 +684,17 @@ class AllegroTI2VPipeline(DiffusionPipeline):
                 be installed. If the dependencies are not installed, the embeddings will be created from the raw
                 prompt.
             max_sequence_length (`int` defaults to 512): Maximum sequence length to use with the `prompt`.
+            guidance_start (`float`, *optional*, defaults to 0.0):
+                Fraction of the denoising steps after which classifier-free guidance starts. Outside of
+                `[guidance_start, guidance_end)` only the conditional branch runs, at half the batch size.
+            guidance_end (`float`, *optional*, defaults to 1.0):
+                Fraction of the denoising steps after which classifier-free guidance stops.
+            uncond_reuse_steps (`int`, *optional*, defaults to 0):
+                Within the guidance interval, reuse the last unconditional prediction for this many steps after it was
+                computed, running only the conditional branch on those steps.
+            split_guidance_batch (`bool`, *optional*, defaults to `False`):
+                Run the unconditional and the conditional branch through each transformer block one after another
+                instead of as one batch, which halves the peak activation memory at a small cost in speed.
 
         Examples:
 
@@ -749,7 +765,9 @@ class AllegroTI2VPipeline(DiffusionPipeline):
 
         # 4. Prepare timesteps
         timesteps, num_inference_steps = retrieve_timesteps(self.scheduler, num_inference_steps, device, timesteps)
-        self.scheduler.set_timesteps(num_inference_steps, device=device)
+        if hasattr(self.scheduler, "set_begin_index"):
+            # otherwise the first step looks its timestep up with a `nonzero`, which synchronizes with the device
+            self.scheduler.set_begin_index(0)
 
         # 5. Prepare latents.
         latent_channels = self.transformer.config.in_channels
@@ -773,6 +791,9 @@ class AllegroTI2VPipeline(DiffusionPipeline):
         added_cond_kwargs = {"resolution": None, "aspect_ratio": None}
 
         # 7. Denoising loop
+        if getattr(self.transformer, "step_cache", None) is not None:
+            # residuals of a previous call must not leak into this one
+            self.transformer.step_cache.reset()
         num_warmup_steps = max(len(timesteps) - num_inference_steps * self.scheduler.order, 0)
 
         if conditional_images is not None:
@@ -788,54 +809,56 @@ class AllegroTI2VPipeline(DiffusionPipeline):
                 device=latents.device,
         )
 
+        if prompt_embeds.ndim == 3:
+            prompt_embeds = prompt_embeds.unsqueeze(1)  # b l d -> b 1 l d
+        if prompt_attention_mask.ndim == 2:
+            prompt_attention_mask = prompt_attention_mask.unsqueeze(1)  # b l -> b 1 l
+        # the text bias is the same for every step and broadcasts over the heads of every block, build it once
+        prompt_attention_mask = self.transformer.prepare_encoder_attention_bias(prompt_attention_mask)
+        noise_pred_uncond, uncond_age = None, 0
+
+        # the masked video and mask do not change across steps, embed them once and share them with both guidance halves
+        conditioning = None
+        if masked_video is not None and mask is not None:
+            conditioning = self.transformer.embed_conditioning(masked_video.to(device), mask.to(device), device=device)
+
+        # step inputs and the guided prediction live in buffers allocated once for the whole loop
+        buffers = DenoisingBuffers(latents, timesteps.dtype)
+
         progress_wrap = tqdm.tqdm if verbose else (lambda x: x)
         for i, t in progress_wrap(list(enumerate(timesteps))):
-            if masked_video is not None and mask is not None: #conditional_images is not None:
-                latent_model_input = self.scheduler.scale_model_input(latents, t)
-                latent_model_input = torch.cat([latent_model_input, masked_video, mask], dim=1)
-                latent_model_input = torch.cat([latent_model_input] * 2) if do_classifier_free_guidance else latent_model_input
-            else:
-                latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
-                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-            current_timestep = t
-            if not torch.is_tensor(current_timestep):
-                # TODO: this requires sync between CPU and GPU. So try to pass timesteps as tensors if you can
-                # This would be a good case for the `match` statement (Python 3.10+)
-                is_mps = latent_model_input.device.type == "mps"
-                if isinstance(current_timestep, float):
-                    dtype = torch.float32 if is_mps else torch.float64
-                else:
-                    dtype = torch.int32 if is_mps else torch.int64
-                current_timestep = torch.tensor([current_timestep], dtype=dtype, device=latent_model_input.device)
-            elif len(current_timestep.shape) == 0:
-                current_timestep = current_timestep[None].to(latent_model_input.device)
-            # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
-            current_timestep = current_timestep.expand(latent_model_input.shape[0])
-
-            if prompt_embeds.ndim == 3:
-                prompt_embeds = prompt_embeds.unsqueeze(1)  # b l d -> b 1 l d
-            if prompt_attention_mask.ndim == 2:
-                prompt_attention_mask = prompt_attention_mask.unsqueeze(1)  # b l -> b 1 l
-            # prepare attention_mask.
-            # b c t h w -> b t h w
-            attention_mask = torch.ones_like(latent_model_input)[:, 0]
+            use_guidance = do_classifier_free_guidance and guidance_start <= i / len(timesteps) < guidance_end
+            run_uncond = use_guidance and (noise_pred_uncond is None or uncond_age >= uncond_reuse_steps)
+            # scaled once for both branches and copied into the persistent batch
+            latent_model_input, attention_mask, current_timestep = buffers.inputs(
+                self.scheduler.scale_model_input(latents, t), t, run_uncond
+            )
+
+            # the conditional branch alone is the second half of the [negative, positive] batch
+            encoder_hidden_states = prompt_embeds if run_uncond or not do_classifier_free_guidance else prompt_embeds.chunk(2)[1]
+            encoder_attention_mask = prompt_attention_mask if run_uncond or not do_classifier_free_guidance else prompt_attention_mask.chunk(2)[1]
             # predict noise model_output
             noise_pred = self.transformer(
                 latent_model_input,
                 attention_mask=attention_mask, 
-                encoder_hidden_states=prompt_embeds,
-                encoder_attention_mask=prompt_attention_mask,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_attention_mask,
                 timestep=current_timestep,
                 added_cond_kwargs=added_cond_kwargs,
                 return_dict=False,
                 device=device,
+                micro_batch_size=latents.shape[0] if split_guidance_batch and run_uncond else None,
+                conditioning=conditioning,
             )[0]
 
-            # perform guidance
-            if do_classifier_free_guidance:
-                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+            # perform guidance, with the unconditional prediction of this step or the last one that was computed
+            if run_uncond:
+                noise_pred_uncond, noise_pred = noise_pred.chunk(2)
+                uncond_age = 0
+            else:
+                uncond_age += 1
+            if use_guidance:
+                noise_pred = buffers.guide(noise_pred_uncond, noise_pred, guidance_scale)
 
             # learned sigma
             if self.transformer.config.out_channels // 2 == latent_channels:
@@ -912,7 +935,7 @@ class AllegroTI2VPipeline(DiffusionPipeline):
         mask = torch.ones_like(input_video, device=input_video.device, dtype=input_video.dtype)
         mask[:, :, conditional_images_indices] = 0
         masked_video = input_video * (mask < 0.5)
-        masked_video = self.vae.encode(masked_video.to(device), local_batch_size=local_batch_size, callback=callback).latent_dist.sample(generator=generator).mul_(self.vae.scale_factor)
+        masked_video = self.vae.encode(masked_video.to(device), local_batch_size=local_batch_size, callback=callback, skip_zero_tiles=True).latent_dist.sample(generator=generator).mul_(self.vae.scale_factor)
 
         mask = mask[:, :1]
 
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from diffusers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+_fingerprints = weakref.WeakKeyDictionary()
+
+
+def _update(digest, tensor: torch.Tensor) -> None:
+    tensor = tensor.detach()
+    digest.update(f"{tuple(tensor.shape)}{tensor.dtype}".encode())
+    digest.update(tensor.to(device="cpu", dtype=torch.float32).contiguous().numpy().tobytes())
+
+
+def module_fingerprint(module: torch.nn.Module, samples: int = 4096) -> str:
+    """
+    Digest of the names, shapes and a strided sample of the values of every parameter and buffer of `module`. Computed
+    once per module instance, telling checkpoints apart without reading all of their weights.
+    """
+    if module not in _fingerprints:
+        digest = hashlib.sha256()
+        for name, tensor in sorted(module.state_dict().items()):
+            digest.update(name.encode())
+            flat = tensor.flatten()
+            _update(digest, flat[:: max(flat.numel() // samples, 1)])
+        _fingerprints[module] = digest.hexdigest()
+    return _fingerprints[module]
+
+
+def reference_key(
+    ref_images: torch.Tensor,
+    indices: Iterable[int],
+    frames: int,
+    height: int,
+    width: int,
+    seed: int,
+    vae: torch.nn.Module,
+    device: torch.device,
+    dtype: torch.dtype,
+) -> str:
+    r"""
+    Content address of a TI2V reference encoding: the reference pixels, their frame indices, the frame count and
+    resolution, the seed of the posterior sample, the VAE encoder weights and the device type and dtype of the encode,
+    the device type deciding which generator the seed is drawn from.
+    """
+    digest = hashlib.sha256()
+    _update(digest, ref_images)
+    digest.update(repr((list(indices), frames, height, width, seed, torch.device(device).type, str(dtype))).encode())
+    digest.update(module_fingerprint(vae.encoder).encode())
+    return digest.hexdigest()
+
+
+class ReferenceCache:
+    r"""
+    Least recently used store of TI2V `(mask, masked_video)` encodings by [`reference_key`], in memory and optionally
+    as safetensors files, so that encodings survive restarts.
+
+    Parameters:
+        directory (`str`, *optional*):
+            Folder of the safetensors files, `None` keeps the cache in memory only.
+        capacity (`int`, *optional*, defaults to 8):
+            Encodings held in memory.
+        disk_capacity (`int`, *optional*, defaults to 64):
+            Files kept in `directory`, the least recently used ones are deleted beyond it.
+    """
+
+    def __init__(self, directory: Optional[str] = None, capacity: int = 8, disk_capacity: int = 64):
+        self.directory = directory
+        self.capacity = capacity
+        self.disk_capacity = disk_capacity
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.safetensors")
+
+    def get(self, key: str, disk: bool = True) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if not disk or self.directory is None or not os.path.isfile(self._path(key)):
+            return None
+        try:
+            tensors = load_file(self._path(key))
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable reference cache file {self._path(key)}: {e}")
+            return None
+        # refresh the access time the pruning goes by
+        os.utime(self._path(key))
+        entry = tensors["mask"], tensors["masked_video"]
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key: str, mask: torch.Tensor, masked_video: torch.Tensor, disk: bool = True) -> None:
+        entry = mask.detach().cpu().contiguous(), masked_video.detach().cpu().contiguous()
+        self._remember(key, entry)
+        if not disk or self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # write then rename, so that a concurrent or interrupted run never reads a partial file
+        partial = self._path(key) + ".partial"
+        save_file({"mask": entry[0], "masked_video": entry[1]}, partial)
+        os.replace(partial, self._path(key))
+        self._prune()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def _remember(self, key, entry) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def _prune(self) -> None:
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".safetensors")]
+        if len(files) <= self.disk_capacity:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[: len(files) - self.disk_capacity]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
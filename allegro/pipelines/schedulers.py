@@ -0,0 +1,53 @@
+from typing import Any, Dict, Optional
+
+from diffusers.schedulers import (
+    DDIMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    UniPCMultistepScheduler,
+)
+from diffusers.schedulers.scheduling_utils import SchedulerMixin
+
+
+# name -> (scheduler class, config overrides, recommended number of inference steps)
+SCHEDULERS = {
+    "euler_ancestral": (EulerAncestralDiscreteScheduler, {}, 100),
+    "euler": (EulerDiscreteScheduler, {}, 50),
+    "ddim": (DDIMScheduler, {"set_alpha_to_one": False}, 50),
+    "dpm++_2m": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++", "solver_order": 2}, 30),
+    "dpm++_2m_karras": (
+        DPMSolverMultistepScheduler,
+        {"algorithm_type": "dpmsolver++", "solver_order": 2, "use_karras_sigmas": True},
+        30,
+    ),
+    "unipc": (UniPCMultistepScheduler, {"solver_order": 2}, 30),
+}
+DEFAULT_SCHEDULER = "euler_ancestral"
+
+
+def recommended_steps(name: str) -> int:
+    return SCHEDULERS[name][2]
+
+
+def make_scheduler(name: str, config: Optional[Dict[str, Any]] = None) -> SchedulerMixin:
+    r"""
+    Build the scheduler registered under `name`.
+
+    Args:
+        name (`str`):
+            A key of `SCHEDULERS`.
+        config (`dict`, *optional*):
+            Config of the scheduler currently in use, e.g. `pipe.scheduler.config`. The noise schedule it defines
+            (`num_train_timesteps`, betas, `prediction_type`, `timestep_spacing`) carries over to the new scheduler,
+            options the new class does not know are dropped. Defaults to the `EulerAncestralDiscreteScheduler` defaults
+            Allegro was released with.
+    """
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler {name}, expected one of {list(SCHEDULERS)}")
+    scheduler_cls, overrides, _ = SCHEDULERS[name]
+    if config is None:
+        config = EulerAncestralDiscreteScheduler().config
+    # drop options of the previous scheduler that are overridden or would leak e.g. karras sigmas into a plain euler
+    config = {k: v for k, v in config.items() if k not in ("use_karras_sigmas", "algorithm_type", "solver_order")}
+    return scheduler_cls.from_config(config, **overrides)
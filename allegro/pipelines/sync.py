@@ -0,0 +1,158 @@
+import collections
+import os
+import traceback
+import warnings
+from typing import Callable, Optional
+
+import torch
+
+
+class AsyncPreview:
+    r"""
+    Pipeline callback that reports progress every step and hands one latent frame to `preview` every `every` steps
+    without making the host wait for the device, so that the kernel queue of the next step is filled while the current
+    one still runs.
+
+    On CUDA the frame is copied into pinned host memory with `non_blocking=True` behind an event, and delivered on a
+    later call once the event has completed, or by `flush`. On other devices it is delivered right away. Which frame is
+    shown is picked from the shape of the latents, cycling through the video, so no value is read from the device.
+
+    Parameters:
+        preview (`Callable[[int, torch.Tensor], None]`, *optional*):
+            Receives the step and a `(channels, height, width)` latent frame on the CPU.
+        progress (`Callable[[int], None]`, *optional*):
+            Receives every step.
+        every (`int`, *optional*, defaults to 1):
+            Steps between previews.
+    """
+
+    def __init__(
+        self,
+        preview: Optional[Callable[[int, torch.Tensor], None]] = None,
+        progress: Optional[Callable[[int], None]] = None,
+        every: int = 1,
+    ):
+        self.preview = preview
+        self.progress = progress
+        self.every = max(every, 1)
+        self._pending = collections.deque()
+
+    def __call__(self, step: int, t, latents: torch.Tensor) -> None:
+        self._deliver(wait=False)
+        if self.progress is not None:
+            self.progress(step)
+        if self.preview is None or step % self.every:
+            return
+        frame = latents[0, :, (step // self.every) % latents.shape[2]]
+        if frame.device.type == "cuda":
+            host = torch.empty(frame.shape, dtype=frame.dtype, pin_memory=True)
+            host.copy_(frame, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            self._pending.append((step, host, event))
+        else:
+            self._pending.append((step, frame.to("cpu", copy=True), None))
+            self._deliver(wait=False)
+
+    def _deliver(self, wait: bool) -> None:
+        while self._pending:
+            step, frame, event = self._pending[0]
+            if event is not None:
+                if not wait and not event.query():
+                    return
+                event.synchronize()
+            self._pending.popleft()
+            self.preview(step, frame)
+
+    def flush(self) -> None:
+        """Waits for and delivers the previews still in flight, call it once the pipeline has returned."""
+        self._deliver(wait=True)
+
+
+class SyncAudit:
+    r"""
+    Counts the host-device synchronizations of a denoising loop per step, and where they come from.
+
+    On CUDA `torch.cuda.set_sync_debug_mode("warn")` makes every synchronizing call warn, and the warnings are counted.
+    On other devices the tensor methods that synchronize with an accelerator (`item`, `tolist`, `nonzero`, `cpu`,
+    `numpy` and the conversions to `bool`, `int` and `float`) are wrapped and counted instead. They are counted whatever
+    the device of the tensor, so on CPU this also reports reads of tensors that would stay on the host anyway, like the
+    sigmas of the Euler schedulers.
+
+    Use it as a context manager around the pipeline call and pass `mark_step` as the pipeline `callback`, or call it
+    from one. `counts[i]` are the synchronizations of step `i`, the first including the setup before the loop and the
+    last entry being those after the last step.
+
+    Parameters:
+        device (`torch.device`):
+            The device the loop runs on.
+    """
+
+    METHODS = ("item", "tolist", "nonzero", "cpu", "numpy", "__bool__", "__int__", "__float__")
+
+    def __init__(self, device: torch.device):
+        self.cuda = torch.device(device).type == "cuda"
+        self.counts = [0]
+        self.sites = collections.Counter()
+        self._originals = {}
+        self._warnings = None
+        self._mode = None
+
+    def __enter__(self) -> "SyncAudit":
+        self.counts = [0]
+        self.sites.clear()
+        if self.cuda:
+            self._warnings = warnings.catch_warnings(record=True)
+            records = self._warnings.__enter__()
+            warnings.simplefilter("always")
+            self._records = records
+            self._mode = torch.cuda.get_sync_debug_mode()
+            torch.cuda.set_sync_debug_mode("warn")
+        else:
+            for name in self.METHODS:
+                self._originals[name] = getattr(torch.Tensor, name)
+                setattr(torch.Tensor, name, self._counting(self._originals[name]))
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self.cuda:
+            torch.cuda.set_sync_debug_mode(self._mode)
+            self._collect()
+            self._warnings.__exit__(*exc)
+        else:
+            for name, original in self._originals.items():
+                setattr(torch.Tensor, name, original)
+            self._originals.clear()
+
+    def _counting(self, original):
+        audit = self
+
+        def counted(tensor, *args, **kwargs):
+            # the frame that called the tensor method
+            caller = traceback.extract_stack(limit=2)[0]
+            audit.counts[-1] += 1
+            audit.sites[f"{os.path.basename(caller.filename)}:{caller.lineno}"] += 1
+            return original(tensor, *args, **kwargs)
+
+        return counted
+
+    def _collect(self) -> None:
+        for record in self._records:
+            if "synchroniz" in str(record.message):
+                self.counts[-1] += 1
+                self.sites[f"{os.path.basename(record.filename)}:{record.lineno}"] += 1
+        self._records.clear()
+
+    def mark_step(self, *args) -> None:
+        """Closes the count of the current step, takes and ignores the pipeline callback arguments."""
+        if self.cuda:
+            self._collect()
+        self.counts.append(0)
+
+    def report(self, top: int = 10) -> str:
+        lines = [f"{'step':>6} {'syncs':>6}"]
+        lines += [f"{step:>6} {count:>6}" for step, count in enumerate(self.counts[:-1])]
+        lines.append(f"{'after':>6} {self.counts[-1]:>6}")
+        lines.append(f"{sum(self.counts)} synchronizations, most frequent sites:")
+        lines += [f"  {count:>6} {site}" for site, count in self.sites.most_common(top)]
+        return "\n".join(lines)
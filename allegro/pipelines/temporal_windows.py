@@ -0,0 +1,85 @@
+from typing import List
+
+import torch
+
+
+def window_starts(frames: int, window: int, overlap: int) -> List[int]:
+    """
+    First frames of windows of `window` frames that overlap by at least `overlap` and cover `frames`. The last window
+    is aligned to the end, so `frames` need not fit the stride.
+    """
+    stride = max(window - overlap, 1)
+    starts = list(range(0, max(frames - window, 0) + 1, stride))
+    if starts[-1] + window < frames:
+        starts.append(frames - window)
+    return starts
+
+
+class TemporalWindows:
+    r"""
+    Overlapping temporal windows of the latents that are denoised one after another and blended into a single
+    prediction every step (MultiDiffusion), so that the transformer only ever attends over `window` latent frames and
+    the cost grows linearly with the clip length.
+
+    Every window is weighted with a linear ramp across the frames it shares with its neighbours, and the weights of
+    every frame are normalized to sum to one, so that windows fade into each other instead of leaving seams.
+
+    Parameters:
+        frames (`int`):
+            Latent frames of the clip.
+        window (`int`):
+            Latent frames per window.
+        overlap (`int`):
+            Latent frames shared by neighbouring windows.
+    """
+
+    def __init__(self, frames: int, window: int, overlap: int):
+        self.frames = frames
+        self.window = min(window, frames)
+        overlap = min(max(overlap, 0), self.window - 1)
+        self.starts = window_starts(frames, self.window, overlap)
+        ramp = torch.arange(1, overlap + 1, dtype=torch.float32) / (overlap + 1)
+        weights = []
+        for index in range(len(self.starts)):
+            weight = torch.ones(self.window)
+            if overlap and index > 0:
+                weight[:overlap] = ramp
+            if overlap and index < len(self.starts) - 1:
+                weight[-overlap:] = torch.minimum(weight[-overlap:], ramp.flip(0))
+            weights.append(weight)
+        total = torch.zeros(frames)
+        for start, weight in zip(self.starts, weights):
+            total[start : start + self.window] += weight
+        self._weights = [weight / total[start : start + self.window] for start, weight in zip(self.starts, weights)]
+        self._placed = {}
+        self._blended = [None, None]
+        self._next = 0
+        self._out = None
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def slice(self, latents: torch.Tensor, index: int) -> torch.Tensor:
+        """The frames of window `index` of `(batch, channels, frames, height, width)` latents."""
+        return latents[:, :, self.starts[index] : self.starts[index] + self.window]
+
+    def add(self, index: int, prediction: torch.Tensor) -> None:
+        """
+        Accumulates the prediction of window `index` into the blend of this step. The first window starts a new blend,
+        which goes into the output the previous step did not return.
+        """
+        if index == 0:
+            shape = (*prediction.shape[:2], self.frames, *prediction.shape[3:])
+            out = self._blended[self._next]
+            if out is None or out.shape != shape or out.dtype != prediction.dtype:
+                out = self._blended[self._next] = prediction.new_empty(shape)
+            self._next ^= 1
+            self._out = out.zero_()
+        key = (index, prediction.device, prediction.dtype)
+        if key not in self._placed:
+            self._placed[key] = self._weights[index].to(prediction.device, prediction.dtype).view(1, 1, -1, 1, 1)
+        self.slice(self._out, index).addcmul_(prediction, self._placed[key])
+
+    def blended(self) -> torch.Tensor:
+        """The blended prediction of all windows of this step."""
+        return self._out
@@ -0,0 +1,73 @@
+"""
+Accuracy, speed and peak memory of the chunked attention path against `F.scaled_dot_product_attention`.
+
+    python benchmarks/attention_accuracy.py                          # small shapes plus a tiny random transformer
+    python benchmarks/attention_accuracy.py --tokens 4096 16384 --query_chunk_size 512
+
+Random queries, keys and values with the -10000 padding bias the transformer uses are attended both ways; then the
+tiny transformer predicts once with the sdpa (`flash`) path and once with `attention_mode='chunked'`. Results are
+compared by relative L2 error and cosine similarity.
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from common import add_common_arguments, compare, load_transformer, make_inputs, predict, synchronize
+
+from allegro.models.transformers.chunked_attention import chunked_attention
+
+
+def timed(device, fn):
+    if torch.device(device).type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    synchronize(device)
+    start = time.perf_counter()
+    result = fn()
+    synchronize(device)
+    seconds = time.perf_counter() - start
+    peak = torch.cuda.max_memory_allocated(device) / 2**20 if torch.device(device).type == "cuda" else float("nan")
+    return result, seconds, peak
+
+
+def main():
+    parser = add_common_arguments(argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter))
+    parser.add_argument("--tokens", nargs="+", type=int, default=[256, 1000, 2048])
+    parser.add_argument("--heads", type=int, default=4)
+    parser.add_argument("--head_dim", type=int, default=96)
+    parser.add_argument("--query_chunk_size", type=int, default=1024)
+    parser.add_argument("--key_chunk_size", type=int, default=4096)
+    parser.set_defaults(dtype="float32")
+    args = parser.parse_args()
+    dtype = getattr(torch, args.dtype)
+    generator = torch.Generator("cpu").manual_seed(args.seed)
+
+    print(f"{'tokens':>7} {'sdpa s':>8} {'chunked s':>10} {'sdpa MiB':>9} {'chunked MiB':>12} {'rel L2':>9} {'cos':>9}")
+    for tokens in args.tokens:
+        query, key, value = (torch.randn(2, args.heads, tokens, args.head_dim, generator=generator).to(args.device, dtype) for _ in range(3))
+        # the last quarter of the keys is padding, as the transformer's mask bias
+        bias = torch.zeros(2, 1, 1, tokens, device=args.device, dtype=dtype)
+        bias[..., tokens * 3 // 4:] = -10000.0
+        reference, sdpa_seconds, sdpa_peak = timed(args.device, lambda: F.scaled_dot_product_attention(query, key, value, attn_mask=bias))
+        result, seconds, peak = timed(
+            args.device,
+            lambda: chunked_attention(query, key, value, bias, query_chunk_size=args.query_chunk_size, key_chunk_size=args.key_chunk_size),
+        )
+        rel_l2, cosine = compare(reference, result)
+        print(f"{tokens:>7} {sdpa_seconds:>8.3f} {seconds:>10.3f} {sdpa_peak:>9.1f} {peak:>12.1f} {rel_l2:>9.2e} {cosine:>9.6f}")
+
+    transformer = load_transformer(args)
+    latents, embeds, mask = make_inputs(transformer, args)
+    t = torch.tensor([999], device=args.device)
+    with torch.no_grad():
+        transformer.set_attention_mode("flash", "flash")
+        reference = predict(transformer, latents, t, embeds, mask, args.guidance, args.device)
+        transformer.set_attention_mode("chunked", "chunked")
+        result = predict(transformer, latents, t, embeds, mask, args.guidance, args.device)
+    rel_l2, cosine = compare(reference, result)
+    print(f"transformer prediction: rel L2 {rel_l2:.2e}, cos {cosine:.6f}")
+
+
+if __name__ == "__main__":
+    main()
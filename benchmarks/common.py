@@ -0,0 +1,136 @@
+"""
+Shared helpers for the scripts in this folder. They run a reduced sampling loop directly against the transformer so
+that no text encoder or VAE is needed, either on the released weights (`--transformer_path`) or on a tiny randomly
+initialized transformer that runs on CPU.
+"""
+import inspect
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from allegro.models.transformers.transformer_3d_allegro import AllegroTransformer3DModel
+
+TINY_CONFIG = dict(
+    num_attention_heads=2,
+    attention_head_dim=32,
+    in_channels=4,
+    out_channels=4,
+    num_layers=2,
+    cross_attention_dim=64,
+    attention_bias=True,
+    sample_size=(8, 8),
+    sample_size_t=4,
+    patch_size=2,
+    patch_size_t=1,
+    activation_fn="gelu-approximate",
+    norm_type="ada_norm_single",
+    caption_channels=32,
+    interpolation_scale_h=1.0,
+    interpolation_scale_w=1.0,
+    interpolation_scale_t=1.0,
+    # memory efficient sdpa has no CPU kernel, use the flash path (which falls back to math) for both attentions
+    sa_attention_mode="flash",
+    ca_attention_mode="flash",
+    use_rope=True,
+    model_max_length=16,
+)
+
+
+def add_common_arguments(parser):
+    parser.add_argument("--transformer_path", default=None, help="released transformer folder, a tiny random model if omitted")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="bfloat16", choices=["bfloat16", "float16", "float32"])
+    parser.add_argument("--frames", type=int, default=None, help="video frames, latent frames are (frames + 3) // 4")
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--width", type=int, default=None)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--guidance", type=float, default=7.5)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def load_transformer(args, transformer_cls=AllegroTransformer3DModel):
+    dtype = getattr(torch, args.dtype)
+    if args.transformer_path:
+        from allegro.models.loader import load_pretrained
+
+        transformer = load_pretrained(transformer_cls, args.transformer_path, torch_dtype=dtype, device=args.device)
+        defaults = (88, 720, 1280)
+    else:
+        torch.manual_seed(args.seed)
+        transformer = transformer_cls.from_config(TINY_CONFIG).to(device=args.device, dtype=dtype).eval()
+        defaults = (13, 64, 64)
+    args.frames = args.frames or defaults[0]
+    args.height = args.height or defaults[1]
+    args.width = args.width or defaults[2]
+    return transformer
+
+
+def make_inputs(transformer, args, batch_size=1):
+    """Initial latents plus random prompt embeddings and masks standing in for the text encoder output."""
+    dtype = getattr(torch, args.dtype)
+    generator = torch.Generator("cpu").manual_seed(args.seed)
+    config = transformer.config
+    shape = (batch_size, config.in_channels, (args.frames + 3) // 4, args.height // 8, args.width // 8)
+    latents = torch.randn(shape, generator=generator).to(args.device, dtype)
+    length = config.model_max_length
+    embeds = torch.randn((2 * batch_size, length, config.caption_channels), generator=generator).to(args.device, dtype)
+    mask = torch.ones((2 * batch_size, length), dtype=torch.bool, device=args.device)
+    # the negative prompt is shorter than the positive one, as in real use
+    mask[:batch_size, length // 4:] = False
+    return latents, embeds, mask
+
+
+def predict(transformer, latents, timestep, embeds, mask, guidance, device):
+    latent_model_input = torch.cat([latents] * 2)
+    noise_pred = transformer(
+        latent_model_input,
+        attention_mask=torch.ones_like(latent_model_input)[:, 0],
+        encoder_hidden_states=embeds.unsqueeze(1),
+        encoder_attention_mask=mask.unsqueeze(1),
+        timestep=timestep.expand(latent_model_input.shape[0]),
+        added_cond_kwargs={"resolution": None, "aspect_ratio": None},
+        return_dict=False,
+        device=device,
+    )[0]
+    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+    return noise_pred_uncond + guidance * (noise_pred_text - noise_pred_uncond)
+
+
+@torch.no_grad()
+def denoise(transformer, scheduler, latents, embeds, mask, args):
+    """Runs `args.steps` guided steps of `scheduler` and returns the final latents and the elapsed seconds."""
+    scheduler.set_timesteps(args.steps, device=args.device)
+    latents = latents * scheduler.init_noise_sigma
+    step_kwargs = {}
+    if "generator" in inspect.signature(scheduler.step).parameters:
+        step_kwargs["generator"] = torch.Generator(args.device).manual_seed(args.seed)
+    synchronize(args.device)
+    start = time.perf_counter()
+    for t in scheduler.timesteps:
+        model_input = scheduler.scale_model_input(latents, t)
+        noise_pred = predict(transformer, model_input, t[None], embeds, mask, args.guidance, args.device)
+        latents = scheduler.step(noise_pred, t, latents, **step_kwargs, return_dict=False)[0]
+    synchronize(args.device)
+    return latents, time.perf_counter() - start
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def compare(reference, candidate):
+    """Relative L2 error and cosine similarity of two tensors, computed in float32."""
+    reference, candidate = reference.float().flatten(), candidate.float().flatten()
+    rel_l2 = ((candidate - reference).norm() / reference.norm().clamp(min=1e-12)).item()
+    cosine = torch.nn.functional.cosine_similarity(reference, candidate, dim=0).item()
+    return rel_l2, cosine
+
+
+def module_bytes(module):
+    return sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
@@ -0,0 +1,60 @@
+"""
+Compile time, speedup and deviation of the compiled transformer blocks per resolution bucket.
+
+    python benchmarks/compile.py                                     # tiny random transformer, inductor on CPU
+    python benchmarks/compile.py --transformer_path models/transformer --device cuda --resolutions 40x368x640 88x720x1280
+
+Each resolution (frames x height x width) is predicted eagerly, then compiled: the first compiled call includes the
+compilation of its bucket, the following `--repeats` calls reuse the graph. Going back to an already compiled
+resolution must not compile again.
+"""
+import argparse
+import time
+
+import torch
+
+from common import add_common_arguments, compare, load_transformer, make_inputs, predict, synchronize
+
+from allegro.models.compile import compile_transformer, uncompile_transformer
+
+
+def timed(args, fn):
+    synchronize(args.device)
+    start = time.perf_counter()
+    result = fn()
+    synchronize(args.device)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = add_common_arguments(argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter))
+    parser.add_argument("--resolutions", nargs="+", default=["13x64x64", "21x96x64"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--backend", default="inductor")
+    args = parser.parse_args()
+
+    transformer = load_transformer(args)
+    t = torch.tensor([999], device=args.device)
+    print(f"{'resolution':>14} {'eager s':>8} {'first s':>8} {'compiled s':>11} {'speedup':>8} {'rel L2':>9} {'cos':>9}")
+    resolutions = args.resolutions + args.resolutions[:1]
+    for index, resolution in enumerate(resolutions):
+        args.frames, args.height, args.width = (int(v) for v in resolution.split("x"))
+        latents, embeds, mask = make_inputs(transformer, args)
+        run = lambda: predict(transformer, latents, t, embeds, mask, args.guidance, args.device)
+        with torch.no_grad():
+            uncompile_transformer(transformer)
+            reference, eager = timed(args, run)
+            compile_transformer(transformer, backend=args.backend)
+            _, first = timed(args, run)
+            seconds = []
+            for _ in range(args.repeats):
+                result, s = timed(args, run)
+                seconds.append(s)
+        compiled = min(seconds)
+        rel_l2, cosine = compare(reference, result)
+        label = resolution + (" (again)" if index >= len(args.resolutions) else "")
+        print(f"{label:>14} {eager:>8.3f} {first:>8.3f} {compiled:>11.3f} {eager / compiled:>8.2f} {rel_l2:>9.2e} {cosine:>9.6f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Speed and agreement of the transformer with fused attention projections against the separate ones.
+
+    python benchmarks/fused_projections.py                           # tiny random transformer on CPU
+    python benchmarks/fused_projections.py --transformer_path models/transformer --device cuda --frames 88 --height 720 --width 1280
+
+Times `--repeats` guided predictions with the separate `to_q`/`to_k`/`to_v` linears, fuses them with
+`fuse_qkv_projections` and times the same predictions again. The fused weights are concatenations of the separate
+ones, so the predictions agree up to GEMM accumulation order.
+"""
+import argparse
+import time
+
+import torch
+
+from common import add_common_arguments, compare, load_transformer, make_inputs, predict, synchronize
+
+
+def timed(args, run):
+    seconds = []
+    for _ in range(args.repeats):
+        synchronize(args.device)
+        start = time.perf_counter()
+        result = run()
+        synchronize(args.device)
+        seconds.append(time.perf_counter() - start)
+    return result, min(seconds)
+
+
+def main():
+    parser = add_common_arguments(argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter))
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    transformer = load_transformer(args)
+    latents, embeds, mask = make_inputs(transformer, args)
+    t = torch.tensor([999], device=args.device)
+    run = lambda: predict(transformer, latents, t, embeds, mask, args.guidance, args.device)
+    with torch.no_grad():
+        reference, separate = timed(args, run)
+        transformer.fuse_qkv_projections()
+        result, fused = timed(args, run)
+
+    rel_l2, cosine = compare(reference, result)
+    print(f"{args.frames}x{args.height}x{args.width}, best of {args.repeats}")
+    print(f"separate {separate:.3f}s, fused {fused:.3f}s, speedup {separate / fused:.2f}")
+    print(f"rel L2 {rel_l2:.2e}, cos {cosine:.6f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Speed and agreement of the fused adaLN-single modulation and gated residuals against the unfused expressions.
+
+    python benchmarks/modulation.py                                  # 22 x 45 x 80 tokens of width 3072 on CPU
+    python benchmarks/modulation.py --device cuda --tokens 79200 --compiled
+
+Times one block's worth of elementwise work on random tensors of the transformer's hidden width: the LayerNorm and
+modulation before attention and feed-forward, and the gated residual updates after them. `--compiled` also times
+`compiled_layer_norm_modulate`, the first call of which includes its compilation and is excluded.
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from common import compare, synchronize
+
+from allegro.models.transformers.modulation import compiled_layer_norm_modulate, gated_residual, layer_norm_modulate
+
+
+def unfused(hidden_states, update, shift, scale, gate):
+    for _ in range(2):
+        norm_hidden_states = F.layer_norm(hidden_states, hidden_states.shape[-1:], None, None, 1e-6)
+        norm_hidden_states = norm_hidden_states * (1 + scale) + shift
+        hidden_states = gate * update + hidden_states
+    return norm_hidden_states, hidden_states
+
+
+def fused(modulate):
+    def run(hidden_states, update, shift, scale, gate):
+        hidden_states = hidden_states.clone()
+        for _ in range(2):
+            norm_hidden_states = modulate(hidden_states, hidden_states.shape[-1:], None, None, 1e-6, shift, scale)
+            hidden_states = gated_residual(hidden_states, update, gate)
+        return norm_hidden_states, hidden_states
+    return run
+
+
+def timed(args, fn, inputs):
+    seconds = []
+    for _ in range(args.repeats):
+        synchronize(args.device)
+        start = time.perf_counter()
+        result = fn(*inputs)
+        synchronize(args.device)
+        seconds.append(time.perf_counter() - start)
+    return result, min(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="bfloat16", choices=["bfloat16", "float16", "float32"])
+    parser.add_argument("--tokens", type=int, default=22 * 45 * 80)
+    parser.add_argument("--dim", type=int, default=3072)
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--compiled", action="store_true")
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+    generator = torch.Generator("cpu").manual_seed(0)
+    make = lambda *shape: torch.randn(shape, generator=generator).to(args.device, dtype)
+    inputs = (
+        make(args.batch, args.tokens, args.dim), make(args.batch, args.tokens, args.dim),
+        make(args.batch, 1, args.dim), make(args.batch, 1, args.dim), make(args.batch, 1, args.dim),
+    )
+
+    candidates = [("fused", fused(layer_norm_modulate))]
+    if args.compiled:
+        candidates.append(("compiled", fused(compiled_layer_norm_modulate)))
+    with torch.no_grad():
+        reference, baseline = timed(args, unfused, inputs)
+        print(f"{'variant':>10} {'s':>8} {'speedup':>8} {'rel L2':>9}")
+        print(f"{'unfused':>10} {baseline:>8.4f} {1.0:>8.2f} {0.0:>9.2e}")
+        for name, fn in candidates:
+            fn(*inputs)
+            result, seconds = timed(args, fn, inputs)
+            rel_l2 = max(compare(r, c)[0] for r, c in zip(reference, result))
+            print(f"{name:>10} {seconds:>8.4f} {baseline / seconds:>8.2f} {rel_l2:>9.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Accuracy and size of the quantized transformer modes against the unquantized path.
+
+    python benchmarks/quantization_accuracy.py                      # tiny random transformer, CPU friendly
+    python benchmarks/quantization_accuracy.py --transformer_path models/transformer --frames 40 --height 368 --width 640
+
+For every mode the same seeds, prompt embeddings and scheduler are used, and the first noise prediction and the final
+latents are compared with the reference by relative L2 error and cosine similarity. The `forward` branch the quantized
+linears take on `--device` is reported per mode: `w8a8` only runs `torch._int_mm` on CUDA, so run on a GPU to measure
+the error of the path production uses.
+"""
+import argparse
+import copy
+
+import torch
+from diffusers.schedulers import EulerAncestralDiscreteScheduler
+
+from common import add_common_arguments, compare, denoise, load_transformer, make_inputs, module_bytes, predict
+
+from allegro.models.transformers.quantization import QUANTIZATION_MODES, QuantizedLinear, fp8_available, quantize_transformer
+
+
+def record_paths(transformer):
+    """Collects the `forward` branches the quantized linears of `transformer` take, returns the set and the hooks."""
+    paths = set()
+    hooks = [
+        module.register_forward_pre_hook(lambda module, inputs: paths.add(module.matmul_path(inputs[0])))
+        for module in transformer.modules()
+        if isinstance(module, QuantizedLinear)
+    ]
+    return paths, hooks
+
+
+def main():
+    parser = add_common_arguments(argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter))
+    parser.add_argument("--modes", nargs="+", default=[m for m in QUANTIZATION_MODES[1:] if m != "fp8" or fp8_available()])
+    args = parser.parse_args()
+
+    reference = load_transformer(args)
+    latents, embeds, mask = make_inputs(reference, args)
+    t0 = torch.tensor([999], device=args.device)
+
+    with torch.no_grad():
+        reference_pred = predict(reference, latents, t0, embeds, mask, args.guidance, args.device)
+    reference_latents, reference_seconds = denoise(reference, EulerAncestralDiscreteScheduler(), latents, embeds, mask, args)
+    print(f"{'mode':>6} {'MiB':>9} {'pred rel L2':>12} {'pred cos':>9} {'latent rel L2':>14} {'latent cos':>11} {'s':>8}  path")
+    print(f"{'none':>6} {module_bytes(reference) / 2**20:>9.1f} {0:>12.2e} {1:>9.5f} {0:>14.2e} {1:>11.5f} {reference_seconds:>8.2f}  linear")
+
+    for mode in args.modes:
+        # quantize a copy of the weights the reference ran with, one mode at a time to bound memory
+        transformer = quantize_transformer(copy.deepcopy(reference), mode)
+        paths, hooks = record_paths(transformer)
+        with torch.no_grad():
+            pred = predict(transformer, latents, t0, embeds, mask, args.guidance, args.device)
+        quantized_latents, seconds = denoise(transformer, EulerAncestralDiscreteScheduler(), latents, embeds, mask, args)
+        for hook in hooks:
+            hook.remove()
+        pred_l2, pred_cos = compare(reference_pred, pred)
+        latent_l2, latent_cos = compare(reference_latents, quantized_latents)
+        print(f"{mode:>6} {module_bytes(transformer) / 2**20:>9.1f} {pred_l2:>12.2e} {pred_cos:>9.5f} {latent_l2:>14.2e} {latent_cos:>11.5f} {seconds:>8.2f}  {'+'.join(sorted(paths))}")
+        del transformer
+
+
+if __name__ == "__main__":
+    main()
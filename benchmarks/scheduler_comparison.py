@@ -0,0 +1,45 @@
+"""
+Quality/time comparison of the schedulers offered by the sampler nodes on a small fixed config.
+
+    python benchmarks/scheduler_comparison.py                        # tiny random transformer, CPU friendly
+    python benchmarks/scheduler_comparison.py --transformer_path models/transformer --frames 40 --height 368 --width 640
+
+Deterministic schedulers all integrate the same probability flow ODE, so each run is scored against a long `euler`
+reference (`--reference_steps`) by relative L2 error and cosine similarity of the final latents. The ancestral scheduler
+samples a different SDE path and is only reported for time.
+"""
+import argparse
+
+from common import add_common_arguments, compare, denoise, load_transformer, make_inputs
+
+from allegro.pipelines.schedulers import SCHEDULERS, make_scheduler, recommended_steps
+
+
+def main():
+    parser = add_common_arguments(argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter))
+    parser.add_argument("--schedulers", nargs="+", default=list(SCHEDULERS), choices=list(SCHEDULERS))
+    parser.add_argument("--step_counts", nargs="*", type=int, default=[], help="extra step counts, besides the recommended one")
+    parser.add_argument("--reference_steps", type=int, default=200)
+    args = parser.parse_args()
+
+    transformer = load_transformer(args)
+    latents, embeds, mask = make_inputs(transformer, args)
+
+    args.steps = args.reference_steps
+    reference, reference_seconds = denoise(transformer, make_scheduler("euler"), latents, embeds, mask, args)
+    print(f"reference: euler, {args.reference_steps} steps, {reference_seconds:.2f}s")
+    print(f"{'scheduler':>16} {'steps':>6} {'s':>8} {'s/step':>8} {'rel L2':>9} {'cos':>8}")
+
+    for name in args.schedulers:
+        for steps in sorted({recommended_steps(name), *args.step_counts}):
+            args.steps = steps
+            result, seconds = denoise(transformer, make_scheduler(name), latents, embeds, mask, args)
+            if name == "euler_ancestral":
+                rel_l2, cosine = float("nan"), float("nan")
+            else:
+                rel_l2, cosine = compare(reference, result)
+            print(f"{name:>16} {steps:>6} {seconds:>8.2f} {seconds / steps:>8.3f} {rel_l2:>9.4f} {cosine:>8.5f}")
+
+
+if __name__ == "__main__":
+    main()
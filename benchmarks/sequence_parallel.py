@@ -0,0 +1,70 @@
+"""
+Agreement and speed of the sequence-sharded transformer against a single process.
+
+    python benchmarks/sequence_parallel.py                           # tiny random transformer, 2 gloo ranks on CPU
+    python benchmarks/sequence_parallel.py --world_size 4 --frames 29 --height 128 --width 128
+    python benchmarks/sequence_parallel.py --transformer_path models/transformer --device cuda --world_size 2
+
+Every rank loads the same weights and inputs, shards the patched tokens with `enable_sequence_parallel` and runs one
+guided prediction per timestep. Rank 0 compares the result with the unsharded prediction by relative L2 error and
+cosine similarity. CPU runs use the gloo backend, CUDA runs use nccl with one GPU per rank.
+"""
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from common import add_common_arguments, compare, load_transformer, make_inputs, predict, synchronize
+
+
+def run(rank, args):
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(args.port))
+    cuda = torch.device(args.device).type == "cuda"
+    dist.init_process_group("nccl" if cuda else "gloo", rank=rank, world_size=args.world_size)
+    if cuda:
+        args.device = f"cuda:{rank}"
+        torch.cuda.set_device(args.device)
+
+    transformer = load_transformer(args)
+    latents, embeds, mask = make_inputs(transformer, args)
+    timesteps = torch.linspace(999, 0, args.steps, device=args.device).long()
+
+    with torch.no_grad():
+        if rank == 0:
+            synchronize(args.device)
+            start = time.perf_counter()
+            reference = [predict(transformer, latents, t[None], embeds, mask, args.guidance, args.device) for t in timesteps]
+            synchronize(args.device)
+            reference_seconds = time.perf_counter() - start
+
+        transformer.enable_sequence_parallel()
+        dist.barrier()
+        synchronize(args.device)
+        start = time.perf_counter()
+        sharded = [predict(transformer, latents, t[None], embeds, mask, args.guidance, args.device) for t in timesteps]
+        synchronize(args.device)
+        seconds = time.perf_counter() - start
+
+    if rank == 0:
+        rel_l2, cosine = zip(*(compare(r, s) for r, s in zip(reference, sharded)))
+        print(f"world size {args.world_size}, {args.steps} predictions")
+        print(f"single process {reference_seconds:.2f}s, sharded {seconds:.2f}s")
+        print(f"max rel L2 {max(rel_l2):.2e}, min cos {min(cosine):.6f}")
+    dist.destroy_process_group()
+
+
+def main():
+    parser = add_common_arguments(argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter))
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--port", type=int, default=29511)
+    parser.set_defaults(device="cpu", dtype="float32", steps=3)
+    args = parser.parse_args()
+    mp.spawn(run, args=(args,), nprocs=args.world_size, join=True)
+
+
+if __name__ == "__main__":
+    main()
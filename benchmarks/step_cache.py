@@ -0,0 +1,40 @@
+"""
+Speed and deviation of the cross-step block cache for a range of thresholds.
+
+    python benchmarks/step_cache.py                                  # tiny random transformer, CPU friendly
+    python benchmarks/step_cache.py --transformer_path models/transformer --frames 40 --height 368 --width 640 --steps 50
+
+Each threshold runs the same seeds and scheduler as the uncached reference; the final latents are compared by relative
+L2 error and cosine similarity, and the number of steps that reused the cached residual is reported.
+"""
+import argparse
+
+from common import add_common_arguments, compare, denoise, load_transformer, make_inputs
+
+from allegro.pipelines.schedulers import SCHEDULERS, make_scheduler
+
+
+def main():
+    parser = add_common_arguments(argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter))
+    parser.add_argument("--scheduler", default="dpm++_2m", choices=list(SCHEDULERS))
+    parser.add_argument("--thresholds", nargs="+", type=float, default=[0.05, 0.1, 0.2, 0.3])
+    args = parser.parse_args()
+
+    transformer = load_transformer(args)
+    latents, embeds, mask = make_inputs(transformer, args)
+
+    transformer.disable_step_cache()
+    reference, reference_seconds = denoise(transformer, make_scheduler(args.scheduler), latents, embeds, mask, args)
+    print(f"{'threshold':>9} {'hits':>5} {'s':>8} {'speedup':>8} {'rel L2':>9} {'cos':>8}")
+    print(f"{0:>9.2f} {0:>5} {reference_seconds:>8.2f} {1:>8.2f} {0:>9.4f} {1:>8.5f}")
+
+    for threshold in args.thresholds:
+        cache = transformer.enable_step_cache(threshold)
+        result, seconds = denoise(transformer, make_scheduler(args.scheduler), latents, embeds, mask, args)
+        rel_l2, cosine = compare(reference, result)
+        print(f"{threshold:>9.2f} {cache.hits:>5} {seconds:>8.2f} {reference_seconds / seconds:>8.2f} {rel_l2:>9.4f} {cosine:>8.5f}")
+        transformer.disable_step_cache()
+
+
+if __name__ == "__main__":
+    main()
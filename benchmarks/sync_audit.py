@@ -0,0 +1,63 @@
+"""
+Host-device synchronizations per step of the `AllegroPipeline` denoising loop.
+
+    python benchmarks/sync_audit.py                                  # tiny random transformer on CPU
+    python benchmarks/sync_audit.py --device cuda --scheduler euler_ancestral --step_cache_threshold 0.1
+
+Runs the pipeline on prompt embeddings standing in for the text encoder, returning latents so that the VAE is never
+used, inside a `SyncAudit` that closes its count at every step callback. On CUDA the synchronizations are those
+`torch.cuda.set_sync_debug_mode` reports. On CPU the calls that would synchronize with an accelerator are counted,
+including reads of tensors the schedulers keep on the host by design.
+"""
+import argparse
+
+import torch
+
+from common import add_common_arguments, load_transformer, make_inputs
+
+from allegro.models.vae.vae_allegro import AllegroAutoencoderKL3D
+from allegro.pipelines.pipeline_allegro import AllegroPipeline
+from allegro.pipelines.schedulers import DEFAULT_SCHEDULER, SCHEDULERS, make_scheduler
+from allegro.pipelines.sync import SyncAudit
+
+
+def main():
+    parser = add_common_arguments(argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter))
+    parser.add_argument("--scheduler", default=DEFAULT_SCHEDULER, choices=list(SCHEDULERS))
+    parser.add_argument("--step_cache_threshold", type=float, default=0.0)
+    parser.add_argument("--top", type=int, default=10, help="call sites listed")
+    args = parser.parse_args()
+
+    transformer = load_transformer(args)
+    if args.step_cache_threshold > 0:
+        transformer.enable_step_cache(args.step_cache_threshold)
+    # the pipeline only reads the scale factors of the VAE when returning latents
+    vae = AllegroAutoencoderKL3D(block_out_channels=(32, 32, 32, 32), load_mode="decoder_only")
+    pipe = AllegroPipeline(vae=vae, transformer=transformer, scheduler=make_scheduler(args.scheduler))
+    _, embeds, mask = make_inputs(transformer, args)
+    negative_embeds, embeds = embeds.chunk(2)
+    negative_mask, mask = mask.chunk(2)
+
+    with torch.no_grad(), SyncAudit(args.device) as audit:
+        pipe(
+            prompt_embeds=embeds,
+            prompt_attention_mask=mask,
+            negative_prompt_embeds=negative_embeds,
+            negative_prompt_attention_mask=negative_mask,
+            num_frames=args.frames,
+            height=args.height,
+            width=args.width,
+            num_inference_steps=args.steps,
+            guidance_scale=args.guidance,
+            generator=torch.Generator(args.device).manual_seed(args.seed),
+            output_type="latents",
+            callback=audit.mark_step,
+            verbose=False,
+            device=args.device,
+        )
+    print(f"{args.scheduler}, {args.steps} steps on {args.device}")
+    print(audit.report(args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,9 @@ from comfy.cli_args import args
 from comfy import model_management
 import latent_preview
 import comfy.latent_formats
+import comfy.model_patcher
 import random
 import math
-import typing
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
@@ -19,16 +19,161 @@ comfy_path = os.path.dirname(folder_paths.__file__)
 sys.path.append(f'{comfy_path}/custom_nodes/ComfyUI-Allegro')
 print(sys.path)
 
-from diffusers.schedulers import EulerAncestralDiscreteScheduler
 from transformers import T5EncoderModel, T5Tokenizer
-from allegro.pipelines.pipeline_allegro import AllegroPipeline
+from allegro.pipelines.pipeline_allegro import AllegroPipeline, upsample_latents
 from allegro.pipelines.pipeline_allegro_ti2v import AllegroTI2VPipeline
+from allegro.pipelines.reference_cache import ReferenceCache, reference_key
+from allegro.pipelines.schedulers import SCHEDULERS, DEFAULT_SCHEDULER, make_scheduler, recommended_steps
+from allegro.pipelines.sync import AsyncPreview
 from allegro.models.vae.vae_allegro import AllegroAutoencoderKL3D
 from allegro.models.transformers.transformer_3d_allegro import AllegroTransformer3DModel
 from allegro.models.transformers.transformer_3d_allegro_ti2v import AllegroTransformerTI2V3DModel
+from allegro.models.loader import load_pretrained
+from allegro.models.registry import registry, component_key
+from allegro.models.transformers.quantization import QUANTIZATION_MODES, quantize_transformer
+from allegro.models.transformers.token_merging import parse_block_indices
+from allegro.models.compile import compile_transformer, compile_vae, uncompile_transformer, uncompile_vae
 
 script_directory = os.path.dirname(os.path.abspath(__file__))
 
+# TI2V reference encodings by content, so prompt and seed iterations on the same images skip the VAE encoder
+reference_cache = ReferenceCache(os.path.join(script_directory, 'cache', 'ti2v_references'))
+REFERENCE_CACHE_MODES = ["memory and disk", "memory", "off"]
+
+def prepare_transformer(transformer, quantization):
+    # fuse the attention projections first, so that quantization sees the fused linears
+    transformer.fuse_qkv_projections()
+    return quantize_transformer(transformer, quantization)
+
+def vae_run_dtype(device):
+    return model_management.vae_dtype(device, allowed_dtypes=[torch.bfloat16,])
+
+def transformer_run_dtype(device):
+    return model_management.unet_dtype(device, supported_dtypes=[torch.bfloat16,])
+
+def load_pipeline(pipeline_cls, transformer_cls, transformer_path, vae_path, text_encoder_path, tokenizer_path, quantization="none"):
+    # components are shared process-wide by resolved path and dtype, e.g. LoadAllegroTI2VModel reuses the vae,
+    # text encoder and tokenizer already loaded by LoadAllegroModel when ti2v_models/ symlinks them to models/.
+    # They are loaded in the dtype the nodes run them in, so get_patcher never has to cast a shared component
+    pbar = ProgressBar(3)
+    vae_dtype = vae_run_dtype(model_management.vae_device())
+    transformer_dtype = transformer_run_dtype(model_management.get_torch_device())
+    keys = [
+        component_key("vae", vae_path, vae_dtype),
+        component_key("tokenizer", tokenizer_path),
+        component_key("text_encoder", text_encoder_path, torch.bfloat16),
+        component_key(transformer_cls.__name__, transformer_path, transformer_dtype, quantization),
+    ]
+    acquired = []
+    try:
+        vae = registry.acquire(keys[0], lambda: load_pretrained(AllegroAutoencoderKL3D, vae_path, torch_dtype=vae_dtype, device=model_management.vae_offload_device()))
+        acquired.append(keys[0])
+        pbar.update(1)
+
+        tokenizer = registry.acquire(keys[1], lambda: T5Tokenizer.from_pretrained(tokenizer_path))
+        acquired.append(keys[1])
+        text_encoder = registry.acquire(keys[2], lambda: load_pretrained(T5EncoderModel, text_encoder_path, torch_dtype=torch.bfloat16, device=model_management.text_encoder_offload_device()))
+        acquired.append(keys[2])
+        pbar.update(1)
+
+        transformer = registry.acquire(keys[3], lambda: prepare_transformer(load_pretrained(transformer_cls, transformer_path, torch_dtype=transformer_dtype, device=model_management.unet_offload_device()), quantization))
+        acquired.append(keys[3])
+    except BaseException:
+        # including interrupts, the components acquired so far must not stay referenced
+        registry.release_all(acquired)
+        raise
+    scheduler = make_scheduler(DEFAULT_SCHEDULER)
+    pipe = pipeline_cls(vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, scheduler=scheduler, transformer=transformer)
+    registry.bind(pipe, keys)
+    pbar.update(1)
+    return pipe
+
+class AllegroModules(torch.nn.Module):
+    # plain container handed to comfy's ModelPatcher, which sets attributes such as `device` on the model it manages,
+    # while diffusers and transformers models expose `device` and `dtype` as read-only properties
+    def __init__(self, **modules):
+        super().__init__()
+        for name, module in modules.items():
+            self.add_module(name, module)
+
+def unload_patcher(patcher):
+    # evict one patcher from comfy's loaded list, moving its modules back to the offload device
+    for i in range(len(model_management.current_loaded_models) - 1, -1, -1):
+        if model_management.current_loaded_models[i].model is patcher:
+            model_management.current_loaded_models.pop(i).model_unload()
+
+def get_patcher(load_device, offload_device, dtype=None, **modules):
+    # one patcher per component, remembered on its first module so that repeated runs hit comfy's loaded-model list
+    first = next(iter(modules.values()))
+    patcher = first.__dict__.get('_comfy_patcher')
+    if dtype is not None and any(p.dtype != dtype for m in modules.values() for p in m.parameters() if p.is_floating_point()):
+        # the loaders already load components in their run dtype, so this only happens for modules loaded otherwise. The
+        # cast is kept so later runs need neither a cast nor a re-upload, the patcher is rebuilt since its size changed
+        if patcher is not None:
+            unload_patcher(patcher)
+            patcher = None
+        for module in modules.values():
+            module.to(dtype = dtype)
+    if patcher is None or patcher.load_device != load_device:
+        patcher = comfy.model_patcher.ModelPatcher(AllegroModules(**modules), load_device=load_device, offload_device=offload_device)
+        first.__dict__['_comfy_patcher'] = patcher
+    return patcher
+
+def load_patchers(patchers, memory_required=0):
+    # comfy only frees as much as these patchers plus their activations need, evicting least recently used models first
+    model_management.load_models_gpu(patchers, memory_required=memory_required, force_full_load=True)
+
+RESIDENCY_POLICIES = ["until memory pressure", "offload after run"]
+
+def apply_residency(patcher, residency):
+    # "until memory pressure" leaves the patcher to comfy, which only evicts it when another model needs the room
+    if residency == "offload after run":
+        unload_patcher(patcher)
+
+def sampler_callback(steps, preview_every):
+    # progress is host-only bookkeeping, the preview frame is copied without waiting for the device and decoded on the
+    # CPU once it has arrived, so that the denoising loop never synchronizes for it
+    pbar = ProgressBar(steps)
+    current = [0]
+    def progress(step):
+        current[0] = step + 1
+        pbar.update_absolute(current[0], steps)
+    try:
+        previewer = latent_preview.get_previewer(torch.device('cpu'), comfy.latent_formats.SD15())
+    except:
+        previewer = None
+    preview = (lambda step, frame: pbar.update_absolute(current[0], steps, previewer.decode_latent_to_preview_image("JPEG", frame.float().unsqueeze(0)))) if previewer else None
+    return AsyncPreview(preview, progress, every=preview_every)
+
+def vae_patcher(vae, part):
+    device = model_management.vae_device()
+    dtype = vae_run_dtype(device)
+    if part == 'encoder' and hasattr(vae, 'encoder') and hasattr(vae, 'quant_conv'):
+        modules = {'encoder': vae.encoder, 'quant_conv': vae.quant_conv}
+    elif part == 'decoder' and hasattr(vae, 'decoder') and hasattr(vae, 'post_quant_conv'):
+        modules = {'decoder': vae.decoder, 'post_quant_conv': vae.post_quant_conv}
+    else:
+        modules = {'vae': vae}
+    return get_patcher(device, model_management.vae_offload_device(), dtype, **modules), device, dtype
+
+def vae_memory_required(vae, batch, dtype):
+    # a few full resolution activations of the widest block per tile, times the tiles processed together
+    return batch * math.prod(vae.kernel) * vae.config.block_out_channels[0] * dtype.itemsize * 4
+
+def transformer_memory_required(transformer, frames, height, width, dtype, batch=2, chunk_size=0):
+    # tokens of the samples a block runs on at once times the widest feed-forward activation, with headroom for attention
+    config = transformer.config
+    tokens = math.ceil(frames / 4) * (height // 8 // config.patch_size) * (width // 8 // config.patch_size)
+    # the 4x wide feed-forward intermediate and its activation make up 8 of the 12 hidden widths, chunking caps them
+    ff_tokens = min(chunk_size, tokens) if chunk_size > 0 else tokens
+    return batch * (tokens * 4 + ff_tokens * 8) * config.num_attention_heads * config.attention_head_dim * dtype.itemsize
+
+def sampler_latents(samples, channels):
+    # LATENT inputs are (c,t,h,w) like sampler and encoder outputs, legacy noise in (t,c,h,w) is told apart by its channel axis
+    if samples.shape[0] != channels and samples.shape[1] == channels:
+        samples = samples.transpose(0, 1)
+    return samples.unsqueeze(0)
+
 class LoadAllegroModel:
     @classmethod
     def INPUT_TYPES(s):
@@ -39,6 +184,9 @@ class LoadAllegroModel:
                 "vae_path": ("STRING", {"default": ""}),
                 "text_encoder_path": ("STRING", {"default": ""}),
                 "tokenizer_path": ("STRING", {"default": ""}),
+            },
+            "optional": {
+                "quantization": (list(QUANTIZATION_MODES), {"default":"none"}),
             }
         }
     CATEGORY = "Allegro"
@@ -46,7 +194,7 @@ class LoadAllegroModel:
     RETURN_NAMES = ("pipe","vae",)
     FUNCTION = "run"
     
-    def run(self, model_path, transformer_path, vae_path, text_encoder_path, tokenizer_path):
+    def run(self, model_path, transformer_path, vae_path, text_encoder_path, tokenizer_path, quantization="none"):
         if not os.path.exists(transformer_path) or not os.path.exists(vae_path) or not os.path.exists(text_encoder_path) or not os.path.exists(text_encoder_path) or os.path.exists(tokenizer_path):
             if os.path.isabs(model_path) and os.path.exists(model_path):
                 modelfullpath = model_path
@@ -61,28 +209,8 @@ class LoadAllegroModel:
             vae_path = os.path.join(modelfullpath, "vae") if not os.path.exists(vae_path) else vae_path
             text_encoder_path = os.path.join(modelfullpath, "text_encoder") if not os.path.exists(text_encoder_path) else text_encoder_path
             tokenizer_path = os.path.join(modelfullpath, "tokenizer") if not os.path.exists(tokenizer_path) else tokenizer_path
-        pbar = ProgressBar(3)
-
-        vae = AllegroAutoencoderKL3D.from_pretrained(vae_path, torch_dtype=torch.float32)
-        vae.eval()
-        if vae.device != model_management.vae_offload_device():
-            vae = vae.to(model_management.vae_offload_device())
-        pbar.update(1)
-        
-        tokenizer = T5Tokenizer.from_pretrained(tokenizer_path)
-        text_encoder = T5EncoderModel.from_pretrained(text_encoder_path, torch_dtype=torch.bfloat16)
-        text_encoder.eval()
-        if text_encoder.device != model_management.text_encoder_offload_device():
-            text_encoder = text_encoder.to(model_management.text_encoder_offload_device())
-        pbar.update(1)
-        
-        scheduler = EulerAncestralDiscreteScheduler()
-        transformer = AllegroTransformer3DModel.from_pretrained(transformer_path, torch_dtype=torch.bfloat16)
-        transformer.eval()
-        if transformer.device != model_management.unet_offload_device():
-            transformer = transformer.to(model_management.unet_offload_device())
-        pipe = AllegroPipeline(vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, scheduler=scheduler, transformer=transformer)
-        pbar.update(1)
+        pipe = load_pipeline(AllegroPipeline, AllegroTransformer3DModel, transformer_path, vae_path, text_encoder_path, tokenizer_path, quantization)
+        vae = pipe.vae
     
         return (pipe,vae,)
 
@@ -105,19 +233,21 @@ class AllegroTextEncoder:
     FUNCTION = "run"
     
     def run(self, pipe, positive_prompt, negative_prompt):
-        olddevice = pipe.text_encoder.device
         positive_prompt_template = "(masterpiece), (best quality), (ultra-detailed), (unwatermarked), {} emotional, harmonious, vignette, 4k epic detailed, shot on kodak, 35mm photo, sharp focus, high budget, cinemascope, moody, epic, gorgeous"
         negative_prompt_default = "nsfw, lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry."
         positive_prompt = positive_prompt_template.format(positive_prompt.lower().strip())
         negative_prompt = negative_prompt if negative_prompt.strip() else negative_prompt_default
         
-        if pipe.text_encoder.device != model_management.text_encoder_device():
-            model_management.unload_all_models()
+        patcher = get_patcher(model_management.text_encoder_device(), model_management.text_encoder_offload_device(), text_encoder = pipe.text_encoder)
+        try:
+            load_patchers([patcher])
+        except model_management.OOM_EXCEPTION:
+            # not enough memory on the text encoder device, encode on the offload device instead. A load that failed
+            # partway may have moved some weights already and never registered the patcher, so move them all back
+            log.warning("Not enough memory to load the text encoder, encoding on the offload device")
+            unload_patcher(patcher)
+            pipe.text_encoder.to(model_management.text_encoder_offload_device())
             model_management.soft_empty_cache()
-            try:
-                pipe.text_encoder = pipe.text_encoder.to(device = model_management.text_encoder_device())
-            except:
-                pipe.text_encoder = pipe.text_encoder.to(device = torch.device('cpu'))
 
         (
             prompt_embeds,
@@ -133,9 +263,6 @@ class AllegroTextEncoder:
             clean_caption=True,
             max_sequence_length=512,
         )
-
-        if pipe.text_encoder.device != model_management.text_encoder_offload_device():
-            pipe.text_encoder = pipe.text_encoder.to(device = model_management.text_encoder_offload_device())
         
         return({"embeds": prompt_embeds,"attention_mask": prompt_attention_mask.bool()},{"embeds":negative_prompt_embeds,"attention_mask": negative_prompt_attention_mask.bool()})
 
@@ -150,13 +277,28 @@ class AllegroSampler:
                 "frames": ("INT", {"default":88,}),
                 "width": ("INT", {"default":1280,}),
                 "height": ("INT", {"default":720,}),
-                "steps": ("INT", {"default":100, "min": 1, "max": 200, "step": 1}),
+                "steps": ("INT", {"default":100, "min": 0, "max": 200, "step": 1}),
                 "guidance": ("FLOAT", {"default":7.5, "min": 0.0, "max": 20.0, "step": 0.5}),
                 "seed": ("INT", {"default":0}),
                 "low_vram_mode": ("BOOLEAN", {"default":False}),
             },
             "optional": {
-                "latents": ("LATENT",),
+                "latents": ("LATENT", {"tooltip": "(c,t,h,w) latents as output by Allegro Sampler, Encoder or Latent Upscale, refined with denoise < 1 or taken as the initial noise otherwise, legacy (t,c,h,w) noise is transposed. They set the frames and size of the output."}),
+                "scheduler": (list(SCHEDULERS), {"default":DEFAULT_SCHEDULER}),
+                "step_cache_threshold": ("FLOAT", {"default":0.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "guidance_start": ("FLOAT", {"default":0.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "guidance_end": ("FLOAT", {"default":1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "uncond_reuse_steps": ("INT", {"default":0, "min": 0, "max": 10, "step": 1}),
+                "split_guidance_batch": ("BOOLEAN", {"default":False}),
+                "chunk_size": ("INT", {"default":0, "min": 0, "max": 65536, "step": 256}),
+                "token_merge_ratio": ("FLOAT", {"default":0.0, "min": 0.0, "max": 0.75, "step": 0.05}),
+                "token_merge_blocks": ("STRING", {"default":""}),
+                "compile": ("BOOLEAN", {"default":False}),
+                "denoise": ("FLOAT", {"default":1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "temporal_window": ("INT", {"default":0, "min": 0, "max": 1024, "step": 4}),
+                "temporal_overlap": ("INT", {"default":24, "min": 0, "max": 1024, "step": 4}),
+                "preview_every": ("INT", {"default":1, "min": 1, "max": 100, "step": 1}),
+                "residency": (RESIDENCY_POLICIES, {"default":"until memory pressure"}),
             }
         }
     CATEGORY = "Allegro"
@@ -164,22 +306,29 @@ class AllegroSampler:
     RETURN_NAMES = ("latents",)
     FUNCTION = "run"
 
-    def run(self, pipe, positive, negative, frames, width, height, steps, guidance, seed, low_vram_mode, latents=None):
-        latentsdevice = latents["samples"].device if latents and "samples" in latents and hasattr(latents["samples"],'device') else None
-        latentsdtype = latents["samples"].dtype if latents and "samples" and "samples" in latents and hasattr(latents["samples"],'dtype') in latents else None
+    def run(self, pipe, positive, negative, frames, width, height, steps, guidance, seed, low_vram_mode, latents=None, residency="until memory pressure", scheduler=DEFAULT_SCHEDULER, step_cache_threshold=0.0, guidance_start=0.0, guidance_end=1.0, uncond_reuse_steps=0, split_guidance_batch=False, chunk_size=0, token_merge_ratio=0.0, token_merge_blocks="", compile=False, denoise=1.0, preview_every=1, temporal_window=0, temporal_overlap=24):
+        latentsdevice = latents["samples"].device if latents and "samples" in latents else None
+        latentsdtype = latents["samples"].dtype if latents and "samples" in latents else None
+        # steps of 0 picks the scheduler's recommended count
+        pipe.scheduler = make_scheduler(scheduler, pipe.scheduler.config)
+        steps = steps if steps > 0 else recommended_steps(scheduler)
         device = model_management.get_torch_device()
-        dtype = model_management.unet_dtype(device, supported_dtypes=[torch.bfloat16,])
-        olddtype = pipe.transformer.dtype
-        if pipe.transformer.device != device or pipe.transformer.dtype != dtype:
-            model_management.unload_all_models()
-            model_management.soft_empty_cache()
-            if low_vram_mode:
-                pipe.transformer = pipe.transformer.to(dtype = dtype)
-            else:
-                pipe.transformer = pipe.transformer.to(device = device, dtype = dtype)
+        dtype = transformer_run_dtype(device)
+        patcher = get_patcher(device, model_management.unet_offload_device(), dtype, transformer = pipe.transformer)
+        samples = sampler_latents(latents["samples"], pipe.transformer.config.in_channels) if latents!=None and "samples" in latents and latents["samples"]!=None else None
+        # given latents decide the size of the video, not the frames/width/height widgets
+        latent_frames, latent_height, latent_width = (samples.shape[-3] * 4, samples.shape[-2] * 8, samples.shape[-1] * 8) if samples is not None else (frames, height, width)
+        # a temporal window of 0 attends over all frames at once, otherwise the transformer only ever sees one window
+        window_frames = min(latent_frames, temporal_window) if temporal_window > 0 else latent_frames
+        if low_vram_mode:
+            # blocks stay on the offload device and are streamed in one by one during the forward pass
+            unload_patcher(patcher)
+            model_management.free_memory(transformer_memory_required(pipe.transformer, window_frames, latent_height, latent_width, dtype, 1 if split_guidance_batch else 2, chunk_size) + max(model_management.module_size(block) for block in pipe.transformer.transformer_blocks), device)
+        else:
+            load_patchers([patcher], transformer_memory_required(pipe.transformer, window_frames, latent_height, latent_width, dtype, 1 if split_guidance_batch else 2, chunk_size))
                 
-        if latents!=None and isinstance(latents, dict) and "samples" in latents and latents["samples"]!=None and (latents["samples"].device != device or latents["samples"].dtype != dtype):
-            latents["samples"] = latents["samples"].to(device = device, dtype = dtype)
+        if samples is not None and (samples.device != device or samples.dtype != dtype):
+            samples = samples.to(device = device, dtype = dtype)
         if positive['embeds'].device != device or positive['embeds'].dtype != dtype:
             positive['embeds'] = positive['embeds'].to(device = device, dtype = dtype)
         if positive['attention_mask'].device != device or positive['attention_mask'].dtype != dtype:
@@ -189,13 +338,33 @@ class AllegroSampler:
         if negative['attention_mask'].device != device or negative['attention_mask'].dtype != dtype:
             negative['attention_mask'] = negative['attention_mask'].to(device = device, dtype = dtype)
         
-        try:
-            setattr(pipe, 'load_device', device)
-            setattr(pipe, 'model', typing.NewType('PseudoModel',typing.Generic))
-            setattr(pipe.model, 'latent_format', comfy.latent_formats.SD15())
-            callback = latent_preview.prepare_callback(pipe, steps)
-        except:
-            callback = None
+        if step_cache_threshold > 0:
+            pipe.transformer.enable_step_cache(step_cache_threshold)
+        else:
+            pipe.transformer.disable_step_cache()
+        # tokens per slice of the feed-forward and attention output projection, 0 runs them unchunked
+        if chunk_size > 0:
+            pipe.transformer.enable_forward_chunking(chunk_size)
+        else:
+            pipe.transformer.disable_forward_chunking()
+        # blocks given like "8-23" or "0,4,10-12", empty merges in every block
+        if token_merge_ratio > 0:
+            pipe.transformer.enable_token_merging(token_merge_ratio, parse_block_indices(token_merge_blocks, len(pipe.transformer.transformer_blocks)))
+        else:
+            pipe.transformer.disable_token_merging()
+        # graphs are cached per resolution, placement and streaming of the blocks stay outside of them
+        if compile:
+            compile_transformer(pipe.transformer)
+        else:
+            uncompile_transformer(pipe.transformer)
+        # the sdpa kernels have no CPU implementation or materialize every score with the mask bias, chunk on CPU
+        if device.type == "cpu":
+            pipe.transformer.set_attention_mode("chunked", "chunked")
+        else:
+            pipe.transformer.set_attention_mode(pipe.transformer.config.sa_attention_mode, pipe.transformer.config.ca_attention_mode)
+
+        # denoise < 1 only runs the last share of the schedule
+        callback = sampler_callback(steps if denoise >= 1.0 else max(min(int(steps * denoise), steps), 1), preview_every)
         
         output = pipe(
             prompt = None,
@@ -211,18 +380,27 @@ class AllegroSampler:
             guidance_scale=guidance,
             max_sequence_length=512,
             generator = torch.Generator(device).manual_seed(seed),
-            latents = latents['samples'].transpose(0, 1).unsqueeze(0) if latents!=None and "samples" in latents and latents["samples"]!=None else None,
+            # denoise < 1 refines them, e.g. a draft from Allegro Latent Upscale, otherwise they are the initial noise
+            latents = samples,
             output_type = "latents",
-            callback = lambda s,t,l:callback(s,l[0,:,random.randint(0, l.shape[-3]-1),:,:].unsqueeze(0),t,steps) if callback else None,
+            callback = callback,
             device = device,
+            guidance_start = guidance_start,
+            guidance_end = guidance_end,
+            uncond_reuse_steps = uncond_reuse_steps,
+            split_guidance_batch = split_guidance_batch,
+            strength = denoise,
+            temporal_window = temporal_window if temporal_window > 0 else None,
+            temporal_overlap = temporal_overlap,
         ).video[0]
+        callback.flush()
+        if pipe.transformer.step_cache is not None:
+            log.info(f"Step cache reused the block residual in {pipe.transformer.step_cache.hits} of {steps} steps")
+            # drop the cached residuals, they are as large as the hidden states
+            pipe.transformer.disable_step_cache()
+        apply_residency(patcher, residency)
         
-        if pipe.transformer.device != model_management.unet_offload_device() or pipe.transformer.dtype != olddtype:
-            pipe.transformer = pipe.transformer.to(device = model_management.unet_offload_device(), dtype = olddtype)
-
-        if latents!=None and isinstance(latents, dict) and "samples" in latents and latents["samples"]!=None and (latents["samples"].device != latentsdevice or latents["samples"].dtype != latentsdtype):
-            latents["samples"] = latents["samples"].to(device = latentsdevice, dtype = latentsdtype)
-        if output!=None and output.device != latentsdevice or output.dtype != latentsdtype:
+        if output is not None and (output.device != latentsdevice or output.dtype != latentsdtype):
             output = output.to(device = latentsdevice, dtype = latentsdtype)
         
         return ({"samples":output},)
@@ -247,36 +425,23 @@ class AllegroEncoder:
         imagedevice = images.device
         imagedtype = images.dtype
         
-        olddtype = vae.dtype
-        device = model_management.vae_device()
-        dtype = model_management.vae_dtype(device, allowed_dtypes=[torch.bfloat16,])
-        if vae.device != device or vae.dtype != dtype:
-            model_management.unload_all_models()
-            model_management.soft_empty_cache()
-            if hasattr(vae, 'encoder') and hasattr(vae, 'quant_conv'):
-                vae.encoder = vae.encoder.to(device = device, dtype = dtype)
-                vae.quant_conv = vae.quant_conv.to(device = device, dtype = dtype)
-            else:
-                vae = vae.to(device = device, dtype = dtype)
-        
+        patcher, device, dtype = vae_patcher(vae, 'encoder')
+        load_patchers([patcher], vae_memory_required(vae, batch, dtype))
         if images.device != device or images.dtype != dtype:
             images = images.to(device = device, dtype = dtype)
         
-        pbar = ProgressBar( (math.floor((images.shape[-3] - vae.kernel[0]//4) / (vae.stride[0]//4)) + 1) * (math.floor((images.shape[-2] - vae.kernel[1]//8) / (vae.stride[1]//8)) + 1) * (math.floor((images.shape[-1] - vae.kernel[2]//8) / (vae.stride[2]//8)) + 1) )
-        latents = vae.encode(images.permute(0,3,1,2), local_batch_size=batch, callback=lambda s,t,l:pbar.update_absolute(s,total=t))
+        pbar = ProgressBar(vae.tile_count((images.shape[0]//4, images.shape[1]//8, images.shape[2]//8)))
+        # t,h,w,c in [0,1] -> 1,c,t,h,w in [-1,1], the range the decoder outputs
+        video = images.permute(3,0,1,2).unsqueeze(0) * 2.0 - 1.0
+        posterior = vae.encode(video, local_batch_size=batch, callback=lambda s,t,l:pbar.update_absolute(s,total=t)).latent_dist
+        # the posterior mean, scaled and laid out (c,t,h,w) like sampler outputs, for Allegro Sampler to refine with denoise < 1
+        latents = posterior.mode()[0] * vae.scale_factor
 
         if images.device != imagedevice or images.dtype != imagedtype:
             images = images.to(device = imagedevice, dtype = imagedtype)
         if latents.device != imagedevice or latents.dtype != imagedtype:
             latents = latents.to(device = imagedevice, dtype = imagedtype)
         
-        if device != model_management.vae_offload_device() or dtype != olddtype:
-            if hasattr(vae, 'encoder') and hasattr(vae, 'quant_conv'):
-                vae.encoder = vae.encoder.to(device=model_management.vae_offload_device(), dtype=olddtype)
-                vae.quant_conv = vae.quant_conv.to(device=model_management.vae_offload_device(), dtype=olddtype)
-            else:
-                vae = vae.to(device=model_management.vae_offload_device(), dtype=olddtype)
-
         return ({'samples':latents},)
 
 class AllegroDecoder:
@@ -287,6 +452,9 @@ class AllegroDecoder:
                 "latents": ("LATENT",),
                 "vae": ("VAE",),
                 "batch": ("INT",{"default":1,"min":1,"max":16}),
+            },
+            "optional": {
+                "compile": ("BOOLEAN", {"default":False}),
             }
         }
     CATEGORY = "Allegro"
@@ -294,27 +462,22 @@ class AllegroDecoder:
     RETURN_NAMES = ("images",)
     FUNCTION = "run"
 
-    def run(self, vae, latents, batch):
+    def run(self, vae, latents, batch, compile=False):
         latentsdevice = latents["samples"].device
         latentsdtype = latents["samples"].dtype
+        if compile:
+            compile_vae(vae)
+        else:
+            uncompile_vae(vae)
         #sd = pipe.state_dict()
         #parameters = calculate_parameters(sd, 'first_stage_model.decoder.') + calculate_parameters(sd, 'first_stage_model.post_quant_conv.')
-        olddtype = vae.dtype
-        device = model_management.vae_device()
-        dtype = model_management.vae_dtype(device, allowed_dtypes=[torch.bfloat16,])
-        if vae.device != device or vae.dtype != dtype:
-            model_management.unload_all_models()
-            model_management.soft_empty_cache()
-            if hasattr(vae, 'decoder') and hasattr(vae, 'post_quant_conv'):
-                vae.decoder = vae.decoder.to(device = device, dtype = dtype)                
-                vae.post_quant_conv = vae.post_quant_conv.to(device = device, dtype = dtype)
-            else:
-                vae = vae.to(device = device, dtype = dtype)
+        patcher, device, dtype = vae_patcher(vae, 'decoder')
+        load_patchers([patcher], vae_memory_required(vae, batch, dtype))
 
         if latents["samples"].device != device or latents["samples"].dtype != dtype:
             latents["samples"] = latents["samples"].to(device = device, dtype = dtype)
         
-        pbar = ProgressBar( (math.floor((latents["samples"].shape[-3] - vae.kernel[0]//4) / (vae.stride[0]//4)) + 1) * (math.floor((latents["samples"].shape[-2] - vae.kernel[1]//8) / (vae.stride[1]//8)) + 1) * (math.floor((latents["samples"].shape[-1] - vae.kernel[2]//8) / (vae.stride[2]//8)) + 1) )
+        pbar = ProgressBar(vae.tile_count(latents["samples"].shape[-3:]))
         if args.preview_method != latent_preview.LatentPreviewMethod.NoPreviews:
             callback = lambda s,t,l:pbar.update_absolute(s, total=t, preview=("JPEG", latent_preview.preview_to_image(l[0,:,random.randint(0,l.shape[-3]-1),:,:].permute(1,2,0)), args.preview_size))
         else:
@@ -326,16 +489,30 @@ class AllegroDecoder:
             latents["samples"] = latents["samples"].to(device = latentsdevice, dtype = latentsdtype)
         if images.device != latentsdevice or images.dtype != torch.float32:
             images = images.to(device = latentsdevice, dtype = torch.float32)
-
-        if device != model_management.vae_offload_device() or dtype != olddtype:
-            if hasattr(vae, 'decoder') and hasattr(vae, 'post_quant_conv'):
-                vae.decoder = vae.decoder.to(device = model_management.vae_offload_device(), dtype = olddtype)
-                vae.post_quant_conv = vae.post_quant_conv.to(device = model_management.vae_offload_device(), dtype = olddtype)
-            else:
-                vae = vae.to(device = model_management.vae_offload_device(), dtype = olddtype)
         
         return (images,)
 
+class AllegroLatentUpscale:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "latents": ("LATENT",),
+                "frames": ("INT", {"default":88}),
+                "width": ("INT", {"default":1280}),
+                "height": ("INT", {"default":720}),
+            }
+        }
+    CATEGORY = "Allegro"
+    RETURN_TYPES = ("LATENT",)
+    RETURN_NAMES = ("latents",)
+    FUNCTION = "run"
+
+    def run(self, latents, frames, width, height):
+        # sampler outputs are c,t,h,w, resized trilinearly to the latent size of the target video
+        samples = upsample_latents(latents["samples"].unsqueeze(0), frames, height, width)[0]
+        return ({"samples":samples},)
+
 class LoadAllegroTI2VModel:
     @classmethod
     def INPUT_TYPES(s):
@@ -346,6 +523,9 @@ class LoadAllegroTI2VModel:
                 "vae_path": ("STRING", {"default": ""}),
                 "text_encoder_path": ("STRING", {"default": ""}),
                 "tokenizer_path": ("STRING", {"default": ""}),
+            },
+            "optional": {
+                "quantization": (list(QUANTIZATION_MODES), {"default":"none"}),
             }
         }
     CATEGORY = "Allegro"
@@ -353,7 +533,7 @@ class LoadAllegroTI2VModel:
     RETURN_NAMES = ("pipe","vae",)
     FUNCTION = "run"
 
-    def run(self, model_path, transformer_path, vae_path, text_encoder_path, tokenizer_path):
+    def run(self, model_path, transformer_path, vae_path, text_encoder_path, tokenizer_path, quantization="none"):
         if not os.path.exists(transformer_path) or not os.path.exists(vae_path) or not os.path.exists(text_encoder_path) or not os.path.exists(text_encoder_path) or os.path.exists(tokenizer_path):
             if os.path.isabs(model_path) and os.path.exists(model_path):
                 modelfullpath = model_path
@@ -368,28 +548,8 @@ class LoadAllegroTI2VModel:
             vae_path = os.path.join(modelfullpath, "vae") if not os.path.exists(vae_path) else vae_path
             text_encoder_path = os.path.join(modelfullpath, "text_encoder") if not os.path.exists(text_encoder_path) else text_encoder_path
             tokenizer_path = os.path.join(modelfullpath, "tokenizer") if not os.path.exists(tokenizer_path) else tokenizer_path
-        pbar = ProgressBar(3)
-
-        vae = AllegroAutoencoderKL3D.from_pretrained(vae_path, torch_dtype=torch.float32)
-        vae.eval()
-        if vae.device != model_management.vae_offload_device():
-            vae = vae.to(model_management.vae_offload_device())
-        pbar.update(1)
-
-        tokenizer = T5Tokenizer.from_pretrained(tokenizer_path)
-        text_encoder = T5EncoderModel.from_pretrained(text_encoder_path, torch_dtype=torch.bfloat16)
-        text_encoder.eval()
-        if text_encoder.device != model_management.text_encoder_offload_device():
-            text_encoder = text_encoder.to(model_management.text_encoder_offload_device())
-        pbar.update(1)
-
-        scheduler = EulerAncestralDiscreteScheduler()
-        transformer = AllegroTransformerTI2V3DModel.from_pretrained(transformer_path, torch_dtype=torch.bfloat16)
-        transformer.eval()
-        if transformer.device != model_management.unet_offload_device():
-            transformer = transformer.to(model_management.unet_offload_device())
-        pipe = AllegroTI2VPipeline(vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, scheduler=scheduler, transformer=transformer)
-        pbar.update(1)
+        pipe = load_pipeline(AllegroTI2VPipeline, AllegroTransformerTI2V3DModel, transformer_path, vae_path, text_encoder_path, tokenizer_path, quantization)
+        vae = pipe.vae
 
         return (pipe,vae,)
 
@@ -406,30 +566,46 @@ class AllegroTI2VSampler:
                 "frames": ("INT", {"default":88,}),
                 "width": ("INT", {"default":1280,}),
                 "height": ("INT", {"default":720,}),
-                "steps": ("INT", {"default":100, "min": 1, "max": 200, "step": 1}),
+                "steps": ("INT", {"default":100, "min": 0, "max": 200, "step": 1}),
                 "guidance": ("FLOAT", {"default":8, "min": 0.0, "max": 20.0, "step": 0.5}),
                 "seed": ("INT", {"default":0}),
                 "low_vram_mode": ("BOOLEAN", {"default":False}),
             },
+            "optional": {
+                "scheduler": (list(SCHEDULERS), {"default":DEFAULT_SCHEDULER}),
+                "step_cache_threshold": ("FLOAT", {"default":0.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "guidance_start": ("FLOAT", {"default":0.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "guidance_end": ("FLOAT", {"default":1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "uncond_reuse_steps": ("INT", {"default":0, "min": 0, "max": 10, "step": 1}),
+                "split_guidance_batch": ("BOOLEAN", {"default":False}),
+                "chunk_size": ("INT", {"default":0, "min": 0, "max": 65536, "step": 256}),
+                "token_merge_ratio": ("FLOAT", {"default":0.0, "min": 0.0, "max": 0.75, "step": 0.05}),
+                "token_merge_blocks": ("STRING", {"default":""}),
+                "compile": ("BOOLEAN", {"default":False}),
+                "preview_every": ("INT", {"default":1, "min": 1, "max": 100, "step": 1}),
+                "residency": (RESIDENCY_POLICIES, {"default":"until memory pressure"}),
+            },
         }
     CATEGORY = "Allegro"
     RETURN_TYPES = ("LATENT",)
     RETURN_NAMES = ("latents",)
     FUNCTION = "run"
 
-    def run(self, pipe, ref_latents, ref_masks, positive, negative, frames, width, height, steps, guidance, seed, low_vram_mode):
+    def run(self, pipe, ref_latents, ref_masks, positive, negative, frames, width, height, steps, guidance, seed, low_vram_mode, residency="until memory pressure", scheduler=DEFAULT_SCHEDULER, step_cache_threshold=0.0, guidance_start=0.0, guidance_end=1.0, uncond_reuse_steps=0, split_guidance_batch=False, chunk_size=0, token_merge_ratio=0.0, token_merge_blocks="", compile=False, preview_every=1):
         latentsdevice = ref_latents["samples"].device if ref_latents and "samples" in ref_latents and hasattr(ref_latents["samples"],'device') else None
         latentsdtype = ref_latents["samples"].dtype if ref_latents and "samples" in ref_latents and hasattr(ref_latents["samples"],'dtype') else None
+        # steps of 0 picks the scheduler's recommended count
+        pipe.scheduler = make_scheduler(scheduler, pipe.scheduler.config)
+        steps = steps if steps > 0 else recommended_steps(scheduler)
         device = model_management.get_torch_device()
-        dtype = model_management.unet_dtype(device, supported_dtypes=[torch.bfloat16,])
-        olddtype = pipe.transformer.dtype
-        if pipe.transformer.device != device or pipe.transformer.dtype != dtype:
-            model_management.unload_all_models()
-            model_management.soft_empty_cache()
-            if low_vram_mode:
-                pipe.transformer = pipe.transformer.to(dtype = dtype)
-            else:
-                pipe.transformer = pipe.transformer.to(device = device, dtype = dtype)
+        dtype = transformer_run_dtype(device)
+        patcher = get_patcher(device, model_management.unet_offload_device(), dtype, transformer = pipe.transformer)
+        if low_vram_mode:
+            # blocks stay on the offload device and are streamed in one by one during the forward pass
+            unload_patcher(patcher)
+            model_management.free_memory(transformer_memory_required(pipe.transformer, frames, height, width, dtype, 1 if split_guidance_batch else 2, chunk_size) + max(model_management.module_size(block) for block in pipe.transformer.transformer_blocks), device)
+        else:
+            load_patchers([patcher], transformer_memory_required(pipe.transformer, frames, height, width, dtype, 1 if split_guidance_batch else 2, chunk_size))
 
         if ref_latents!=None and isinstance(ref_latents, dict) and "samples" in ref_latents and ref_latents["samples"]!=None and (ref_latents["samples"].device != device or ref_latents["samples"].dtype != dtype):
             ref_latents["samples"] = ref_latents["samples"].to(device = device, dtype = dtype)
@@ -444,13 +620,32 @@ class AllegroTI2VSampler:
         if negative['attention_mask'].device != device or negative['attention_mask'].dtype != dtype:
             negative['attention_mask'] = negative['attention_mask'].to(device = device, dtype = dtype)
 
-        try:
-            setattr(pipe, 'load_device', device)
-            setattr(pipe, 'model', typing.NewType('PseudoModel',typing.Generic))
-            setattr(pipe.model, 'latent_format', comfy.latent_formats.SD15())
-            callback = latent_preview.prepare_callback(pipe, steps)
-        except:
-            callback = None
+        if step_cache_threshold > 0:
+            pipe.transformer.enable_step_cache(step_cache_threshold)
+        else:
+            pipe.transformer.disable_step_cache()
+        # tokens per slice of the feed-forward and attention output projection, 0 runs them unchunked
+        if chunk_size > 0:
+            pipe.transformer.enable_forward_chunking(chunk_size)
+        else:
+            pipe.transformer.disable_forward_chunking()
+        # blocks given like "8-23" or "0,4,10-12", empty merges in every block
+        if token_merge_ratio > 0:
+            pipe.transformer.enable_token_merging(token_merge_ratio, parse_block_indices(token_merge_blocks, len(pipe.transformer.transformer_blocks)))
+        else:
+            pipe.transformer.disable_token_merging()
+        # graphs are cached per resolution, placement and streaming of the blocks stay outside of them
+        if compile:
+            compile_transformer(pipe.transformer)
+        else:
+            uncompile_transformer(pipe.transformer)
+        # the sdpa kernels have no CPU implementation or materialize every score with the mask bias, chunk on CPU
+        if device.type == "cpu":
+            pipe.transformer.set_attention_mode("chunked", "chunked")
+        else:
+            pipe.transformer.set_attention_mode(pipe.transformer.config.sa_attention_mode, pipe.transformer.config.ca_attention_mode)
+
+        callback = sampler_callback(steps, preview_every)
 
         output = pipe(
             prompt = None,
@@ -468,22 +663,29 @@ class AllegroTI2VSampler:
             generator = torch.Generator(device).manual_seed(seed),
             latents = None,
             output_type = "latents",
-            callback = lambda s,t,l:callback(s,l[0,:,random.randint(0, l.shape[-3]-1),:,:].unsqueeze(0),t,steps) if callback else None,
+            callback = callback,
             device = device,
+            guidance_start = guidance_start,
+            guidance_end = guidance_end,
+            uncond_reuse_steps = uncond_reuse_steps,
+            split_guidance_batch = split_guidance_batch,
             conditional_images = None,
             conditional_images_indices = None,
             masked_video = ref_latents["samples"],
             mask = ref_masks,
         ).video[0]
-
-        if pipe.transformer.device != model_management.unet_offload_device() or pipe.transformer.dtype != olddtype:
-            pipe.transformer = pipe.transformer.to(device = model_management.unet_offload_device(), dtype = olddtype)
+        callback.flush()
+        if pipe.transformer.step_cache is not None:
+            log.info(f"Step cache reused the block residual in {pipe.transformer.step_cache.hits} of {steps} steps")
+            # drop the cached residuals, they are as large as the hidden states
+            pipe.transformer.disable_step_cache()
+        apply_residency(patcher, residency)
 
         if ref_latents!=None and isinstance(ref_latents, dict) and "samples" in ref_latents and ref_latents["samples"]!=None and (ref_latents["samples"].device != latentsdevice or ref_latents["samples"].dtype != latentsdtype):
             ref_latents["samples"] = ref_latents["samples"].to(device = latentsdevice, dtype = latentsdtype)
         if ref_masks!=None and isinstance(ref_latents, torch.Tensor) and (ref_masks.device != latentsdevice or ref_masks.dtype != latentsdtype):
             ref_masks = ref_masks.to(device = latentsdevice, dtype = latentsdtype)
-        if output!=None and output.device != latentsdevice or output.dtype != latentsdtype:
+        if output is not None and (output.device != latentsdevice or output.dtype != latentsdtype):
             output = output.to(device = latentsdevice, dtype = latentsdtype)
 
         return ({"samples":output},)
@@ -500,28 +702,21 @@ class AllegroTI2VEncoder:
                 "batch": ("INT",{"default":1,"min":1,"max":16}),
                 "seed": ("INT", {"default":0}),
             },
+            "optional": {
+                "cache": (REFERENCE_CACHE_MODES, {"default":"memory and disk"}),
+            },
         }
     CATEGORY = "Allegro"
     RETURN_TYPES = ("LATENT","MASK","INT","INT","INT",)
     RETURN_NAMES = ("ref_latents","ref_masks","frames","width","height")
     FUNCTION = "run"
 
-    def run(self, pipe, ref_images, frames, indices, batch, seed):
+    def run(self, pipe, ref_images, frames, indices, batch, seed, cache="memory and disk"):
         imagedevice = ref_images.device
         imagedtype = ref_images.dtype
 
         vae = pipe.vae
-        olddtype = vae.dtype
-        device = model_management.vae_device()
-        dtype = model_management.vae_dtype(device, allowed_dtypes=[torch.bfloat16,])
-        if vae.device != device or vae.dtype != dtype:
-            model_management.unload_all_models()
-            model_management.soft_empty_cache()
-            if hasattr(vae, 'encoder') and hasattr(vae, 'quant_conv'):
-                vae.encoder = vae.encoder.to(device = device, dtype = dtype)
-                vae.quant_conv = vae.quant_conv.to(device = device, dtype = dtype)
-            else:
-                vae = vae.to(device = device, dtype = dtype)
+        patcher, device, dtype = vae_patcher(vae, 'encoder')
 
         if ref_images.shape[0] > frames:
             ref_images = ref_images[[int(round(i*(ref_images.shape[0]-1)/(frames-1))) for i in range(frames)]:,:,:]
@@ -534,10 +729,21 @@ class AllegroTI2VEncoder:
                         index = int(token)
                         if -frames < index < frames:
                             ref_images_indices[k] = index
+
+        key = reference_key(ref_images, ref_images_indices, frames, ref_images.shape[-3], ref_images.shape[-2], seed, vae, device, dtype) if cache != "off" else None
+        cached = reference_cache.get(key, disk=cache == "memory and disk") if key else None
+        if cached is not None:
+            log.info(f"Reusing the cached encoding of the reference images {key[:12]}")
+            mask, masked_video = cached
+            masked_video = masked_video.to(device = imagedevice, dtype = imagedtype)
+            mask = mask.to(device = imagedevice, dtype = imagedtype)
+            return ({'samples':masked_video}, mask, frames, ref_images.shape[-2], ref_images.shape[-3])
+
+        load_patchers([patcher], vae_memory_required(vae, batch, dtype))
         if ref_images.device != device or ref_images.dtype != dtype:
             ref_images = ref_images.to(device = device, dtype = dtype)
 
-        pbar = ProgressBar( (math.floor((ref_images.shape[-4] - vae.kernel[0]//4) / (vae.stride[0]//4)) + 1) * (math.floor((ref_images.shape[-3] - vae.kernel[1]//8) / (vae.stride[1]//8)) + 1) * (math.floor((ref_images.shape[-2] - vae.kernel[2]//8) / (vae.stride[2]//8)) + 1) )
+        pbar = ProgressBar(vae.tile_count((frames//4, ref_images.shape[-3]//8, ref_images.shape[-2]//8)))
         mask, masked_video = pipe.prepare_mask_masked_video(
             conditional_images = ref_images.permute(0,3,1,2), #T,H,W,C->T,C,H,W
             conditional_images_indices = ref_images_indices,
@@ -552,6 +758,8 @@ class AllegroTI2VEncoder:
             local_batch_size=batch,
         )
         #latents = vae.encode(images, callback=lambda s,t,l:pbar.update_absolute(s,total=t))
+        if key:
+            reference_cache.put(key, mask, masked_video, disk=cache == "memory and disk")
 
         if ref_images.device != imagedevice or ref_images.dtype != imagedtype:
             ref_images = ref_images.to(device = imagedevice, dtype = imagedtype)
@@ -560,19 +768,13 @@ class AllegroTI2VEncoder:
         if mask.device != imagedevice or mask.dtype != imagedtype:
             mask = mask.to(device = imagedevice, dtype = imagedtype)
 
-        if device != model_management.vae_offload_device() or dtype != olddtype:
-            if hasattr(vae, 'encoder') and hasattr(vae, 'quant_conv'):
-                vae.encoder = vae.encoder.to(device=model_management.vae_offload_device(), dtype=olddtype)
-                vae.quant_conv = vae.quant_conv.to(device=model_management.vae_offload_device(), dtype=olddtype)
-            else:
-                vae = vae.to(device=model_management.vae_offload_device(), dtype=olddtype)
-
         return ({'samples':masked_video}, mask, frames, ref_images.shape[-2], ref_images.shape[-3])
 
 NODE_CLASS_MAPPINGS = {
     "LoadAllegroModel":LoadAllegroModel,
     "AllegroSampler":AllegroSampler,
     "AllegroDecoder":AllegroDecoder,
+    "AllegroLatentUpscale":AllegroLatentUpscale,
     "AllegroEncoder":AllegroEncoder,
     "AllegroTextEncoder":AllegroTextEncoder,
     "AllegroTI2VSampler":AllegroTI2VSampler,
@@ -583,6 +785,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "LoadAllegroModel":"(Down)Load Allegro Model",
     "AllegroSampler":"Allegro Sampler",
     "AllegroDecoder":"Allegro Decoder",
+    "AllegroLatentUpscale":"Allegro Latent Upscale",
     "AllegroEncoder":"Allegro Encoder",
     "AllegroTextEncoder":"Allegro Text Encoder",
     "AllegroTI2VSampler":"Allegro TextImage2Video Sampler",